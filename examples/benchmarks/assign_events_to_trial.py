@@ -0,0 +1,21 @@
+"""
+Benchmark of ibllib.io.extractors.ephys_fpga._assign_events_to_trial for arbitrary indices,
+with 10 events per trial on average, some trials without events.
+"""
+import time
+
+import numpy as np
+
+from ibllib.io.extractors.ephys_fpga import _assign_events_to_trial
+
+rng = np.random.default_rng(42)
+print(f"{'n_trials':>10} {'n_events':>10} {'take':>6} {'time (ms)':>10} {'assigned':>10}")
+for n in [10 ** 3, 10 ** 4, 10 ** 5]:
+    t_trial_start = np.cumsum(rng.random(n) * 4 + 1)
+    t_event = np.sort(rng.uniform(t_trial_start[0], t_trial_start[-1] + 5, n * 10))
+    for take in ['first', 'last', 2, -3]:
+        t0 = time.perf_counter()
+        t_event_nans = _assign_events_to_trial(t_trial_start, t_event, take=take)
+        t = time.perf_counter() - t0
+        assigned = np.mean(~np.isnan(t_event_nans))
+        print(f"{n:>10} {t_event.size:>10} {take:>6} {t * 1e3:>10.1f} {assigned:>10.2%}")
@@ -0,0 +1,60 @@
+"""
+Benchmark of the training session extraction (ibllib.io.extractors.bpod_trials.extract_all:
+wheel and trials) on a synthetic session made of the test session trials and rotary encoder
+samples repeated, from the raw jsonable file and from the cached trials table.
+"""
+import json
+import logging
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import ibllib.io.raw_data_loaders as raw
+from ibllib.io.extractors import bpod_trials
+
+logging.getLogger('ibllib').setLevel(logging.CRITICAL)
+TEST_SESSION = Path(bpod_trials.__file__).parents[2].joinpath(
+    'tests', 'extractors', 'data', 'session_training_ge5')
+
+
+def _repeat_ssv(file_ssv, nrep, duration):
+    """Repeats the rotary encoder samples, shifting the timestamps (us) of each repetition"""
+    lines = [ln.split(' ', 1) for ln in file_ssv.read_text().splitlines() if ln.strip()]
+    with open(file_ssv, 'w') as fid:
+        for i in range(nrep):
+            for ts, rest in lines:
+                fid.write(f"{int(ts) + int(duration * 1e6) * i} {rest}\n")
+
+
+print(f"{'n_trials':>10} {'jsonable (s)':>14} {'cache (s)':>10}")
+for n in [120, 600, 2400]:
+    with tempfile.TemporaryDirectory() as td:
+        session_path = Path(td).joinpath('session')
+        shutil.copytree(TEST_SESSION, session_path)
+        raw_path = session_path.joinpath('raw_behavior_data')
+        file_jsonable = next(raw_path.glob('_iblrig_taskData.raw*.jsonable'))
+        trials = [json.loads(line) for line in file_jsonable.read_text().splitlines()]
+        # the same shift is applied to the bpod and the rotary encoder clocks
+        last_re = max(int(ln.split(' ')[0]) for ln in raw_path.joinpath(
+            '_iblrig_encoderPositions.raw.ssv').read_text().splitlines() if ln.strip())
+        duration = max(trials[-1]['behavior_data']['Trial end timestamp'], last_re / 1e6) + 1
+        with open(file_jsonable, 'w') as fid:
+            for i in range(n):
+                # shift the repeated trials so that the session times increase
+                trial = json.loads(json.dumps(trials[i % len(trials)]))
+                for k in ['Trial start timestamp', 'Trial end timestamp']:
+                    trial['behavior_data'][k] += duration * (i // len(trials))
+                fid.write(json.dumps(trial) + '\n')
+        for name in ['_iblrig_encoderPositions.raw.ssv', '_iblrig_encoderEvents.raw.ssv']:
+            _repeat_ssv(raw_path.joinpath(name), n // len(trials), duration)
+        raw.CACHE_RAW_DATA = False
+        t0 = time.perf_counter()
+        bpod_trials.extract_all(session_path, save=False)
+        t1 = time.perf_counter()
+        raw.CACHE_RAW_DATA = True
+        raw.load_trials_table(session_path)  # writes the cache
+        t2 = time.perf_counter()
+        bpod_trials.extract_all(session_path, save=False)
+        t3 = time.perf_counter()
+        print(f"{n:>10} {t1 - t0:>14.3f} {t3 - t2:>10.3f}")
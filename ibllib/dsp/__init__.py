@@ -1,2 +1,3 @@
-from .fourier import fscale, freduce, fexpand, lp, hp, bp, shift, dephas, fit_phase
+from .fourier import fscale, freduce, fexpand, lp, hp, bp, shift, dephas, fit_phase, \
+    FrequencyFilter
 from .utils import rms, WindowGenerator, rises, falls, fronts, fcn_cosine
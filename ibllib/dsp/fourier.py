@@ -2,8 +2,10 @@
 Low-level functions to work in frequency domain for n-dim arrays
 """
 
+from functools import lru_cache
+
 import numpy as np
-import scipy
+import scipy.fft
 from ibllib.dsp.utils import fcn_cosine
 
 
@@ -143,18 +145,79 @@ def hp(ts, si, b, axis=None):
     return _freq_filter(ts, si, b, axis=axis, typ='hp')
 
 
-def _freq_filter(ts, si, b, axis=None, typ='lp'):
+class FrequencyFilter:
     """
-        Wrapper for hp/lp/bp filters
+    Reusable frequency domain filter for chunked loops: the transfer function is computed once
+    per fft length, the signal being zero-padded to the next efficient fft length.
+    Real ffts are used and float32 inputs are filtered in single precision.
+    >>> hpf = FrequencyFilter(si=1 / 30000, b=[0, 1], typ='hp')
+    >>> for data in chunks:
+    >>>     data = hpf(data, axis=-1)
     """
-    if axis is None:
-        axis = ts.ndim - 1
-    ns = ts.shape[axis]
+    def __init__(self, si, b, typ='lp', ns=None):
+        """
+        :param si: sampling interval in seconds
+        :param b: cutout frequencies: 2 elements for 'lp' and 'hp', 4 elements for 'bp'
+        :param typ: 'lp', 'hp' or 'bp'
+        :param ns: (None) if provided, number of samples to precompute the transfer function for
+        """
+        self.si = si
+        self.b = tuple(b)
+        self.typ = typ
+        self._transfer_functions = {}
+        if ns is not None:
+            self.transfer_function(ns_optim_fft(ns))
+
+    def transfer_function(self, nfft, dtype=np.float64):
+        """
+        :param nfft: fft length
+        :param dtype: numpy dtype of the transfer function
+        :return: one-sided transfer function, vector of size nfft // 2 + 1
+        """
+        key = (nfft, np.dtype(dtype))
+        if key not in self._transfer_functions:
+            self._transfer_functions[key] = _transfer_function(
+                nfft, self.si, self.b, self.typ).astype(dtype)
+        return self._transfer_functions[key]
+
+    def __call__(self, ts, axis=-1):
+        """
+        :param ts: time serie
+        :param axis: axis along which to filter (last axis by default)
+        :return: filtered time serie, float32 if the input is float32
+        """
+        axis = axis % ts.ndim
+        ns = ts.shape[axis]
+        nfft = ns_optim_fft(ns)
+        dtype = np.float32 if ts.dtype == np.float32 else np.float64
+        shape = [1] * ts.ndim
+        shape[axis] = -1
+        filc = self.transfer_function(nfft, dtype=dtype).reshape(shape)
+        TS = scipy.fft.rfft(ts, n=nfft, axis=axis)
+        TS *= filc
+        out = scipy.fft.irfft(TS, n=nfft, axis=axis, overwrite_x=True)
+        return out[(slice(None),) * axis + (slice(0, ns),)]
+
+
+@lru_cache(maxsize=64)
+def _transfer_function(ns, si, b, typ):
     f = fscale(ns, si=si, one_sided=True)
     if typ == 'bp':
         filc = _freq_vector(f, b[0:2], typ='hp') * _freq_vector(f, b[2:4], typ='lp')
     else:
         filc = _freq_vector(f, b, typ=typ)
+    filc.flags.writeable = False
+    return filc
+
+
+def _freq_filter(ts, si, b, axis=None, typ='lp'):
+    """
+        Wrapper for hp/lp/bp filters
+    """
+    if axis is None:
+        axis = ts.ndim - 1
+    ns = ts.shape[axis]
+    filc = _transfer_function(ns, si, tuple(b), typ)
     if axis < (ts.ndim - 1):
         filc = filc[:, np.newaxis]
     return np.real(np.fft.ifft(np.fft.fft(ts, axis=axis) * fexpand(filc, ns, axis=0), axis=axis))
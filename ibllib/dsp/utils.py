@@ -1,8 +1,13 @@
 """
 Window generator, front detections, rms
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import os
+
 import numpy as np
-from scipy import interpolate
+from scipy import interpolate, signal
+from tqdm import tqdm
 from ibllib.misc import print_progress
 
 
@@ -35,33 +40,52 @@ def sync_timestamps(tsa, tsb, tbin=0.1, return_indices=False):
     y = np.zeros_like(x)
     x[np.int32(np.floor((tsa - tmin) / tbin))] = 1
     y[np.int32(np.floor((tsb - tmin) / tbin))] = 1
-    delta_t = (parabolic_max(np.correlate(x, y, mode='full'))[0] - x.shape[0] + 1) * tbin
+    # the correlation is computed in frequency domain and rounded to the exact integer counts
+    xcor = np.round(signal.correlate(x, y, mode='full', method='fft'))
+    delta_t = (parabolic_max(xcor)[0] - x.shape[0] + 1) * tbin
 
-    # do a first assignment at a DT threshold
+    # do a first assignment at a DT threshold, looking for the neighbours in the sorted tsb
     ib = np.zeros(tsa.shape, dtype=np.int32) - 1
     threshold = tbin
-    for m in np.arange(tsa.shape[0]):
-        dt = np.abs(tsa[m] - delta_t - tsb)
-        inds = np.where(dt < threshold)[0]
-        if inds.size == 1:
-            ib[m] = inds[0]
-        elif inds.size > 1:
-            candidates = inds[~np.isin(inds, ib[:m])]
-            if candidates.size == 1:
-                ib[m] = candidates[0]
+    isort = np.argsort(tsb, kind='stable')
+    first = np.searchsorted(tsb[isort], tsa - delta_t - threshold, side='right')
+    last = np.searchsorted(tsb[isort], tsa - delta_t + threshold, side='left')
+    iunique = (last - first) == 1
+    ib[iunique] = isort[first[iunique]]
+    # with several candidates, assign the only one not matched to a previous tsa, if any
+    first_match = np.zeros(tsb.shape, dtype=np.int64) + tsa.size
+    np.minimum.at(first_match, ib[iunique], np.where(iunique)[0])
+    for m in np.where((last - first) > 1)[0]:
+        candidates = isort[first[m]:last[m]]
+        candidates = candidates[first_match[candidates] > m]
+        if candidates.size == 1:
+            ib[m] = candidates[0]
+            first_match[candidates[0]] = min(first_match[candidates[0]], m)
 
     fcn_a2b, _ = _interp_fcn(tsa, tsb, ib)
-    # do a second assignment - this time a full matrix of candidate matches is computed
+    # do a second assignment - this time all candidate pairs below the threshold are considered
     # the most obvious matches are assigned first and then one by one
     iamiss = np.where(ib < 0)[0]
     ibmiss = np.setxor1d(np.arange(tsb.size), ib[ib >= 0])
-    dt = np.abs(fcn_a2b(tsa[iamiss]) - tsb[ibmiss][:, np.newaxis])
-    dt[dt > tbin] = np.nan
-    while ~np.all(np.isnan(dt)):
-        _b, _a = np.unravel_index(np.nanargmin(dt), dt.shape)
-        ib[iamiss[_a]] = ibmiss[_b]
-        dt[:, _a] = np.nan
-        dt[_b, :] = np.nan
+    ta, tb = (fcn_a2b(tsa[iamiss]), tsb[ibmiss])
+    isort = np.argsort(tb, kind='stable')
+    first = np.searchsorted(tb[isort], ta - tbin, side='left')
+    ncandidates = np.searchsorted(tb[isort], ta + tbin, side='right') - first
+    # candidate pairs (a, b) as indices of the iamiss and ibmiss arrays
+    _a = np.repeat(np.arange(iamiss.size), ncandidates)
+    offset = np.repeat(np.cumsum(ncandidates) - ncandidates - first, ncandidates)
+    _b = isort[np.arange(_a.size) - offset]
+    dt = np.abs(ta[_a] - tb[_b])
+    # sort by time difference, ties are resolved in the order of the indices of b then of a
+    order = np.lexsort((_a, _b, dt))
+    order = order[dt[order] <= tbin]
+    amatched = np.zeros(iamiss.size, dtype=bool)
+    bmatched = np.zeros(ibmiss.size, dtype=bool)
+    for _ai, _bi in zip(_a[order], _b[order]):
+        if amatched[_ai] or bmatched[_bi]:
+            continue
+        ib[iamiss[_ai]] = ibmiss[_bi]
+        amatched[_ai], bmatched[_bi] = (True, True)
     fcn_a2b, drift_ppm = _interp_fcn(tsa, tsb, ib)
 
     if return_indices:
@@ -265,3 +289,64 @@ class WindowGenerator(object):
         Prints progress using a terminal progress bar
         """
         print_progress(self.iw, self.nwin)
+
+    def map(self, func, reader=None, n_workers=None, ordered=True, processes=False,
+            max_inflight=None, progress=True):
+        """
+        Generator that applies a function to each window in a thread (or process) pool and yields
+        the results. The number of windows submitted and not yet yielded is bounded, so that the
+        windows are not all loaded in memory at once.
+        >>> wg = WindowGenerator(ns=sr.ns, nswin=2 ** 17, overlap=0)
+        >>> trms = np.array(list(wg.map(lambda data: rms(data.T), reader=sr)))
+        >>> sync_fronts = list(wg.map(lambda first, last: sr.read_sync(slice(first, last))))
+
+        :param func: function applied to the window data func(reader[first:last]) if a reader is
+         provided, to the window indices func(first, last) otherwise
+        :param reader: (None) array-like sliced along its first dimension, ie. spikeglx.Reader
+        :param n_workers: (None) size of the pool, defaults to the number of cpus
+        :param ordered: (True) yields results in windows order, otherwise in completion order
+        :param processes: (False) uses a process pool: the function needs to be picklable and the
+         windows data is read in the calling process
+        :param max_inflight: (None) maximum windows in flight, defaults to 2 * n_workers
+        :param progress: (True) displays a progress bar
+        :return: generator of results
+        """
+        n_workers = n_workers or os.cpu_count()
+        max_inflight = max_inflight or 2 * n_workers
+        executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(n_workers)
+        pending = deque()
+        pbar = tqdm(total=self.nwin, disable=not progress)
+
+        def _results(nmax):
+            # yields finished results until at most nmax windows are in flight
+            while len(pending) > nmax:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    pbar.update(1)
+                    yield future.result()
+
+        try:
+            for first, last in self.firstlast:
+                if reader is None:
+                    pending.append(executor.submit(func, first, last))
+                elif processes:
+                    pending.append(executor.submit(func, reader[first:last]))
+                else:
+                    pending.append(executor.submit(_apply_window, func, reader, first, last))
+                yield from _results(max_inflight - 1)
+            yield from _results(0)
+        finally:
+            # if the generator is not consumed until the end, cancel the remaining windows
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            pbar.close()
+
+
+def _apply_window(func, reader, first, last):
+    return func(reader[first:last])
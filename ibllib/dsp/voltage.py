@@ -0,0 +1,211 @@
+"""
+Streaming processing of multi-channel voltage recordings, ie. preprocessing of the AP band
+before spike sorting. The recording is processed in overlapping windows that are tapered and
+overlap-added, so that the output is continuous across windows.
+
+>>> from ibllib.dsp import voltage
+>>> sr = spikeglx.Reader(file_ap)
+>>> stages = [voltage.Filter([300, 500], typ='hp'), voltage.CommonAverageReference()]
+>>> voltage.stream_filter(sr, file_ap.parent.joinpath('preproc.ap.bin'), stages)
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from ibllib.dsp.fourier import FrequencyFilter
+from ibllib.dsp.utils import WindowGenerator, fcn_cosine
+import ibllib.io.spikeglx as spikeglx
+
+_logger = logging.getLogger('ibllib')
+
+MEMORY_BYTES = 2 ** 30  # memory budget of the processing
+OVERLAP_SAMPLES = 2 ** 10  # default overlap between windows, tapered and overlap-added
+
+
+class Filter:
+    """
+    Frequency domain filter along time, applied to each channel independently
+    """
+    per_channel = True
+    q = 1
+
+    def __init__(self, b, typ='hp'):
+        """
+        :param b: cutout frequencies in Hz: 2 elements for 'lp' and 'hp', 4 elements for 'bp'
+        :param typ: 'lp', 'hp' or 'bp'
+        """
+        self.b = b
+        self.typ = typ
+        self._filters = {}
+
+    def __call__(self, x, fs):
+        if fs not in self._filters:
+            self._filters[fs] = FrequencyFilter(1 / fs, self.b, typ=self.typ)
+        return self._filters[fs](x, axis=-1)
+
+
+class CommonAverageReference:
+    """
+    Subtracts the median (or mean) across channels at each sample
+    """
+    per_channel = False
+    q = 1
+
+    def __init__(self, operation='median'):
+        """
+        :param operation: 'median' or 'mean'
+        """
+        self.operation = operation
+
+    def __call__(self, x, fs):
+        if self.operation == 'median':
+            return x - np.median(x, axis=0)
+        return x - np.mean(x, axis=0)
+
+
+class Decimate:
+    """
+    Anti-alias low-pass filter at 80% of the new Nyquist frequency and decimation by an integer
+    factor, applied to each channel independently
+    """
+    per_channel = True
+
+    def __init__(self, q):
+        """
+        :param q: integer decimation factor
+        """
+        self.q = int(q)
+        self._filters = {}
+
+    def __call__(self, x, fs):
+        if fs not in self._filters:
+            fnyq = fs / self.q / 2
+            self._filters[fs] = FrequencyFilter(1 / fs, [fnyq * 0.8, fnyq], typ='lp')
+        return self._filters[fs](x, axis=-1)[:, ::self.q]
+
+
+def _run_stages(x, stages, fs, executor, channel_blocks):
+    """
+    Applies the stages in sequence to x (nc, ns). Consecutive per-channel stages are run on
+    blocks of channels in the thread pool, the other stages on all channels at once.
+    """
+    def _run_block(block, stages_, fs_):
+        for stage in stages_:
+            block = stage(block, fs_)
+            fs_ /= stage.q
+        return block
+
+    i = 0
+    while i < len(stages):
+        if not stages[i].per_channel:
+            x = stages[i](x, fs)
+            fs /= stages[i].q
+            i += 1
+            continue
+        # group the consecutive per channel stages and run them on blocks of channels
+        j = i
+        while j < len(stages) and stages[j].per_channel:
+            j += 1
+        blocks = executor.map(lambda ic: _run_block(x[ic], stages[i:j], fs), channel_blocks)
+        x = np.concatenate(list(blocks), axis=0)
+        fs /= np.prod([s.q for s in stages[i:j]])
+        i = j
+    return np.float32(x)
+
+
+def stream_filter(source, output_file, stages, fs=None, meta_file=None, overlap=OVERLAP_SAMPLES,
+                  memory_bytes=MEMORY_BYTES, n_workers=None, progress=True):
+    """
+    Runs a chain of processing stages over a whole recording in overlapping windows, and writes
+    the result as a flat int16 binary file with its .meta file.
+    Windows are tapered with a cosine over the overlap and overlap-added.
+    The sync traces of spikeglx files are copied (and decimated) without processing.
+
+    :param source: spikeglx.Reader, or array-like (ns, nc) in int16 units
+    :param output_file: path of the output binary file (.bin)
+    :param stages: list of stages (Filter, CommonAverageReference, Decimate or any callable
+     stage(x, fs) on arrays (nc, ns) with attributes per_channel and q)
+    :param fs: sampling frequency (Hz), only for array-like sources
+    :param meta_file: for array-like sources, optional spikeglx meta file used as template
+    :param overlap: overlap between windows in samples
+    :param memory_bytes: approximate memory used by the processing, sets the window size
+    :param n_workers: number of threads for per-channel stages, defaults to the number of cpus
+    :param progress: (True) displays a progress bar
+    :return: path of the output binary file
+    """
+    output_file = Path(output_file)
+    n_workers = n_workers or os.cpu_count()
+    q = int(np.prod([s.q for s in stages]))
+    if isinstance(source, spikeglx.Reader):
+        fs, ns, nc = source.fs, source.ns, source.nc
+        meta_file = source.file_meta_data
+        csync = spikeglx._get_sync_trace_indices_from_meta(source.meta)
+        s2v = source.channel_conversion_sample2v[source.type]
+    else:
+        if fs is None:
+            raise ValueError("The sampling frequency fs is required for array-like sources")
+        ns, nc = source.shape
+        csync = []
+        s2v = np.ones(nc, dtype=np.float32)
+    cproc = np.setdiff1d(np.arange(nc), csync)
+    # the window size and overlap are multiples of the decimation factor, the window size is set
+    # so that about 8 copies of the data window fit in memory (buffers, stages and ffts)
+    overlap = int(np.ceil(overlap / q) * q)
+    nswin = max(int(memory_bytes / 8 / 4 / nc) // q * q, 4 * overlap)
+    wg = WindowGenerator(ns=ns, nswin=nswin, overlap=overlap)
+    if isinstance(source, spikeglx.Reader):
+        windows = source.iter_chunks(nswin=nswin, overlap=overlap)
+    else:
+        windows = ((first, last, np.float32(source[first:last])) for first, last in wg.firstlast)
+    # tapers of the overlap region: the head of a window and the tail of the previous sum to 1
+    ovq = overlap // q
+    taper = np.float32(fcn_cosine([0, ovq])(np.arange(ovq) + 0.5))
+    channel_blocks = np.array_split(np.arange(cproc.size), min(n_workers, cproc.size))
+    tail = None
+    sha1 = hashlib.sha1()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, open(output_file, 'wb') as fid, \
+            tqdm(total=wg.nwin, disable=not progress) as pbar:
+        for first, last, data in windows:
+            y = _run_stages(data[:, cproc].T, stages, fs, executor, channel_blocks)
+            if first > 0:
+                y[:, :ovq] *= taper
+                y[:, :ovq] += tail
+            nkeep = y.shape[1] if last == ns else y.shape[1] - ovq
+            if last < ns:
+                tail = y[:, nkeep:] * (1 - taper)
+            out = np.zeros((nkeep, nc), dtype=np.int16)
+            out[:, cproc] = np.clip(np.round(y[:, :nkeep].T / s2v[cproc]), -32768, 32767)
+            out[:, csync] = np.round(data[::q, csync][:nkeep] / s2v[csync])
+            sha1.update(out.tobytes())
+            out.tofile(fid)
+            pbar.update(1)
+    ns_out = int(np.ceil(ns / q))
+    if meta_file is not None:
+        _write_meta_data(meta_file, output_file.with_suffix('.meta'), fs=fs / q,
+                         fileSizeBytes=ns_out * nc * 2, fileTimeSecs=ns_out / (fs / q),
+                         fileSHA1=sha1.hexdigest().upper())
+    else:
+        _logger.warning(f"{output_file}: no meta-data template provided, no .meta file written")
+    return output_file
+
+
+def _write_meta_data(meta_file, output_meta_file, fs, **kwargs):
+    """
+    Copies a spikeglx meta file, replacing the sampling rate and the values of the keys
+    provided as keyword arguments
+    """
+    md = spikeglx.read_meta_data(meta_file)
+    kwargs['imSampRate' if md.get('typeThis') == 'imec' else 'niSampRate'] = fs
+    with open(meta_file) as fid:
+        lines = fid.read().splitlines()
+    with open(output_meta_file, 'w') as fid:
+        for line in lines:
+            key = line.split('=')[0]
+            if key in kwargs:
+                line = f'{key}={kwargs[key]}'
+            fid.write(line + '\n')
@@ -1,8 +1,10 @@
 """
 Quality control of raw Neuropixel electrophysiology data.
 """
+from functools import partial
 from pathlib import Path
 import logging
+import os
 import shutil
 
 import numpy as np
@@ -16,7 +18,7 @@ from ibllib.ephys import sync_probes
 from ibllib.io import spikeglx, raw_data_loaders
 import ibllib.dsp as dsp
 from ibllib.io.extractors import ephys_fpga, training_wheel
-from ibllib.misc import print_progress
+from ibllib.misc import run_with_log_prefix, spawn_pool
 from phylib.io import model
 
 
@@ -24,20 +26,26 @@ _logger = logging.getLogger('ibllib')
 
 RMS_WIN_LENGTH_SECS = 3
 WELCH_WIN_LENGTH_SAMPLES = 1024
+RMS_CHECKPOINT_WINDOWS = 50  # the rmsmap progress is saved every n windows
+RMS_PROGRESS_LOGS = 10  # number of progress logs of the rmsmap of a file
+RMS_ACCUMULATORS = ['TRMS', 'nsamples', 'spectral_density', 'mean', 'peak']
 NCH_WAVEFORMS = 32  # number of channels to be saved in templates.waveforms and channels.waveforms
 
 
-def rmsmap(fbin):
+def rmsmap(fbin, checkpoint_file=None):
     """
-    Computes RMS map in time domain and spectra for each channel of Neuropixel probe
+    Computes RMS map in time domain and spectra for each channel of Neuropixel probe, and per
+    channel statistics over the whole file, in a single pass over the data
 
     :param fbin: binary file in spike glx format (will look for attached metatdata)
     :type fbin: str or pathlib.Path
+    :param checkpoint_file: (None) if provided, the computation state is saved in this file every
+     few windows, and a previous interrupted computation is resumed from it
     :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
-     and frequency scales
+     and frequency scales, the mean of the raw signal ('mean') and the peak absolute amplitude
+     of the high-passed signal ('peak') per channel
     """
-    if not isinstance(fbin, spikeglx.Reader):
-        sglx = spikeglx.Reader(fbin)
+    sglx = fbin if isinstance(fbin, spikeglx.Reader) else spikeglx.Reader(fbin)
     rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
     # the window generator will generates window indices
     wingen = dsp.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
@@ -47,28 +55,71 @@ def rmsmap(fbin):
            'fscale': dsp.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
     win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    for first, last in wingen.firstlast:
-        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
+    # the mean is accumulated as a sum of the samples and normalized after the last window
+    win['mean'] = np.zeros((sglx.nc,))
+    win['peak'] = np.zeros((sglx.nc,))
+    iw0 = 0
+    if checkpoint_file is not None:
+        iw0 = _load_rmsmap_checkpoint(checkpoint_file, sglx, wingen, win)
+    # loop through the whole session, the next window is read while the current one is processed
+    windows = sglx.iter_chunks(nswin=wingen.nswin, overlap=0, first_window=iw0)
+    for iw, (first, last, D) in enumerate(windows, start=iw0):
+        win['mean'] += np.sum(D, axis=0, dtype=np.float64)
         # remove low frequency noise below 1 Hz
-        D = dsp.hp(D, 1 / sglx.fs, [0, 1])
-        iw = wingen.iw
+        D = dsp.hp(D.transpose(), 1 / sglx.fs, [0, 1])
         win['TRMS'][iw, :] = dsp.rms(D)
+        np.maximum(win['peak'], np.max(np.abs(D), axis=1), out=win['peak'])
         win['nsamples'][iw] = D.shape[1]
         # the last window may be smaller than what is needed for welch
-        if last - first < WELCH_WIN_LENGTH_SAMPLES:
-            continue
-        # compute a smoothed spectrum using welch method
-        _, w = signal.welch(D, fs=sglx.fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                            detrend='constant', return_onesided=True, scaling='density', axis=-1)
-        win['spectral_density'] += w.T
-        # print at least every 20 windows
-        if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-            print_progress(iw, wingen.nwin)
+        if last - first >= WELCH_WIN_LENGTH_SAMPLES:
+            # compute a smoothed spectrum using welch method
+            _, w = signal.welch(D, fs=sglx.fs, window='hann',
+                                nperseg=WELCH_WIN_LENGTH_SAMPLES, detrend='constant',
+                                return_onesided=True, scaling='density', axis=-1)
+            win['spectral_density'] += w.T
+        if checkpoint_file is not None and (iw + 1) % RMS_CHECKPOINT_WINDOWS == 0:
+            _save_rmsmap_checkpoint(checkpoint_file, sglx, wingen, win, iw + 1)
+        _log_progress(sglx.file_bin, iw, wingen.nwin)
+    win['mean'] /= max(np.sum(win['nsamples']), 1)
     return win
 
 
-def extract_rmsmap(fbin, out_folder=None, overwrite=False):
+def _log_progress(file_bin, iw, nwin):
+    """Logs the rmsmap progress RMS_PROGRESS_LOGS times per file, through the ibllib logger so
+    that the progress of the worker processes reaches the parent"""
+    step = max(nwin // RMS_PROGRESS_LOGS, 1)
+    if (iw + 1) % step == 0 or iw + 1 == nwin:
+        _logger.info(f"{Path(file_bin).name}: QC window {iw + 1}/{nwin}")
+
+
+def _save_rmsmap_checkpoint(checkpoint_file, sglx, wingen, win, iw):
+    checkpoint_file = Path(checkpoint_file)
+    file_tmp = checkpoint_file.with_suffix('.part')
+    with open(file_tmp, 'wb') as fid:
+        np.savez(fid, iw=iw, file_name=sglx.file_bin.name, nbytes=sglx.nbytes,
+                 nswin=wingen.nswin, **{k: win[k] for k in RMS_ACCUMULATORS})
+    file_tmp.replace(checkpoint_file)
+
+
+def _load_rmsmap_checkpoint(checkpoint_file, sglx, wingen, win):
+    """
+    Restores the rmsmap accumulators from a checkpoint file in place
+    :return: index of the first window left to compute, 0 if there is no valid checkpoint
+    """
+    if not Path(checkpoint_file).exists():
+        return 0
+    with np.load(checkpoint_file) as cp:
+        if (cp['file_name'] != sglx.file_bin.name or cp['nbytes'] != sglx.nbytes or
+                cp['nswin'] != wingen.nswin or not set(RMS_ACCUMULATORS) <= set(cp.files)):
+            _logger.warning(f"{checkpoint_file} doesn't match {sglx.file_bin}, ignoring it")
+            return 0
+        for k in RMS_ACCUMULATORS:
+            win[k][:] = cp[k]
+        _logger.info(f"Resuming QC of {sglx.file_bin} from window {int(cp['iw'])}")
+        return int(cp['iw'])
+
+
+def extract_rmsmap(fbin, out_folder=None, overwrite=False, checkpoint=True):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
@@ -76,7 +127,8 @@ def extract_rmsmap(fbin, out_folder=None, overwrite=False):
     :param out_folder: folder in which to store output ALF files. Default uses the folder in which
      the `fbin` file lives.
     :param overwrite: do not re-extract if all ALF files already exist
-    :param label: string or list of strings that will be appended to the filename before extension
+    :param checkpoint: (True) saves the progress in the output folder so that an interrupted
+     computation resumes where it stopped
     :return: None
     """
     _logger.info(f"Computing QC for {fbin}")
@@ -94,10 +146,11 @@ def extract_rmsmap(fbin, out_folder=None, overwrite=False):
         _logger.warning(f'{fbin.name} QC already exists, skipping. Use overwrite option.')
         return files_time + files_freq
     # crunch numbers
-    rms = rmsmap(fbin)
-    # output ALF files, single precision with the optional label as suffix before extension
     if not out_folder.exists():
         out_folder.mkdir()
+    checkpoint_file = out_folder.joinpath(f'{Path(fbin).stem}.rmsmap_checkpoint.npz')
+    rms = rmsmap(sglx, checkpoint_file=checkpoint_file if checkpoint else None)
+    # output ALF files, single precision with the optional label as suffix before extension
     tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
     fdict = {'power': rms['spectral_density'].astype(np.single),
              'freqs': rms['fscale'].astype(np.single)}
@@ -105,25 +158,37 @@ def extract_rmsmap(fbin, out_folder=None, overwrite=False):
         out_folder, object=alf_object_time, dico=tdict, namespace='iblqc')
     out_freq = alf.io.save_object_npy(
         out_folder, object=alf_object_freq, dico=fdict, namespace='iblqc')
+    checkpoint_file.unlink(missing_ok=True)
     return out_time + out_freq
 
 
-def raw_qc_session(session_path, overwrite=False):
+def raw_qc_session(session_path, overwrite=False, n_workers=None):
     """
     Wrapper that exectutes QC from a session folder and outputs the results whithin the same folder
     as the original raw data.
     :param session_path: path of the session (Subject/yyyy-mm-dd/number
     :param overwrite: bool (False) Force means overwriting an existing QC file
+    :param n_workers: (None) number of ap/lf files processed in parallel, each in its own
+     process, defaults to all files up to the number of cpus
     :return: None
     """
     efiles = spikeglx.glob_ephys_files(session_path)
-    qc_files = []
+    files, labels = ([], [])
     for efile in efiles:
-        if efile.get('ap') and efile.ap.exists():
-            qc_files.extend(extract_rmsmap(efile.ap, out_folder=None, overwrite=overwrite))
-        if efile.get('lf') and efile.lf.exists():
-            qc_files.extend(extract_rmsmap(efile.lf, out_folder=None, overwrite=overwrite))
-    return qc_files
+        for band in ['ap', 'lf']:
+            if efile.get(band) and efile[band].exists():
+                files.append(efile[band])
+                labels.append(f'{efile.label} {band}'.strip())
+    n_workers = n_workers or min(max(len(files), 1), os.cpu_count())
+    _extract_rmsmap = partial(extract_rmsmap, out_folder=None, overwrite=overwrite)
+    if n_workers == 1:
+        qc_files = list(map(_extract_rmsmap, files))
+    else:
+        # the logs of the worker processes are forwarded to the parent, labelled per file
+        with spawn_pool(n_workers) as executor:
+            qc_files = list(executor.map(
+                run_with_log_prefix, labels, [_extract_rmsmap] * len(files), files))
+    return [f for files_ in qc_files for f in files_]
 
 
 def validate_ttl_test(ses_path, display=False):
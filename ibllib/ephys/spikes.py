@@ -134,8 +134,9 @@ def sync_spike_sorting(ap_file, out_path):
     # patch the spikes.times files manually
     st_file = out_path.joinpath('spikes.times.npy')
     spike_samples = np.load(out_path.joinpath('spikes.samples.npy'))
-    interp_times = apply_sync(sync_file, spike_samples / _sr(ap_file), forward=True)
-    np.save(st_file, interp_times)
+    spike_times = spike_samples / _sr(ap_file)
+    apply_sync(sync_file, spike_times, forward=True, out=spike_times)
+    np.save(st_file, spike_times)
     # get the list of output files
     out_files.extend([f for f in out_path.glob("*.*") if
                       f.name.startswith(('channels.', 'clusters.', 'spikes.', 'templates.',
@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import logging
+from pathlib import Path
 
 import matplotlib.axes
 import matplotlib.pyplot as plt
@@ -7,29 +10,281 @@ from scipy.interpolate import interp1d
 
 import alf.io
 from brainbox.core import Bunch
+from ibllib.dsp.utils import sync_timestamps
 from ibllib.exceptions import Neuropixel3BSyncFrontsNonMatching
 import ibllib.io.spikeglx as spikeglx
-from ibllib.io.extractors.ephys_fpga import _get_sync_fronts, get_ibl_sync_map
+from ibllib.io.extractors.ephys_fpga import _get_sync_fronts, get_ibl_sync_map, SyncIndex
 
 _logger = logging.getLogger('ibllib')
 
 
-def apply_sync(sync_file, times, forward=True):
+CLOCK_CHUNK_SIZE = 2 ** 22  # number of times converted at once by the clock converters
+
+
+def apply_sync(sync_file, times, forward=True, out=None):
     """
     :param sync_file: probe sync file (usually of the form _iblrig_ephysData.raw.imec1.sync.npy)
     :param times: times in seconds to interpolate
     :param forward: if True goes from probe time to session time, from session time to probe time
     otherwise
+    :param out: (None) float64 output array, may be times itself for an in-place conversion
     :return: interpolated times
     """
-    sync_points = np.load(sync_file)
-    if forward:
-        fcn = interp1d(sync_points[:, 0],
-                       sync_points[:, 1], fill_value='extrapolate')
-    else:
-        fcn = interp1d(sync_points[:, 1],
-                       sync_points[:, 0], fill_value='extrapolate')
-    return fcn(times)
+    converter = ClockConverter.from_file(sync_file)
+    return converter.forward(times, out=out) if forward else converter.inverse(times, out=out)
+
+
+class ClockConverter:
+    """
+    Piecewise linear mapping between the probe clock and the session clock, from the sync points
+    array (n, 2) of [probe times, session times]. Times outside of the sync points are
+    extrapolated linearly from the first and last segments.
+    >>> converter = ClockConverter.from_file(sync_file)
+    >>> session_times = converter.forward(probe_times)
+    >>> converter.inverse(session_times, out=session_times)  # in-place conversion
+    """
+
+    def __init__(self, sync_points):
+        sync_points = np.array(sync_points, dtype=np.float64)
+        self.probe_times, self.session_times = (sync_points[:, 0], sync_points[:, 1])
+        for a in (self.probe_times, self.session_times):
+            a.flags.writeable = False
+
+    @staticmethod
+    def from_file(sync_file):
+        """
+        Returns the converter of a sync file, memoized until the file is modified
+        :param sync_file: probe sync file (usually of the form _spikeglx_ephysData.*.sync.npy)
+        :return: ClockConverter
+        """
+        sync_file = Path(sync_file).resolve()
+        return _load_clock_converter(sync_file, sync_file.stat().st_mtime_ns)
+
+    def forward(self, times, out=None):
+        """
+        :param times: probe times in seconds
+        :param out: (None) float64 output array, may be times itself for an in-place conversion
+        :return: session times in seconds
+        """
+        return self._convert(times, self.probe_times, self.session_times, out=out)
+
+    def inverse(self, times, out=None):
+        """
+        :param times: session times in seconds
+        :param out: (None) float64 output array, may be times itself for an in-place conversion
+        :return: probe times in seconds
+        """
+        return self._convert(times, self.session_times, self.probe_times, out=out)
+
+    @staticmethod
+    def _convert(x, xp, fp, out=None):
+        scalar = np.isscalar(x)
+        x = np.asarray(x)
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float64)
+        if not (x.flags.c_contiguous and out.flags.c_contiguous):
+            out[...] = ClockConverter._convert(np.ascontiguousarray(x), xp, fp)
+            return out
+        # slopes of the first and last segments for the extrapolation
+        s0, s1 = ((fp[1] - fp[0]) / (xp[1] - xp[0]), (fp[-1] - fp[-2]) / (xp[-1] - xp[-2]))
+        # processes by chunks to bound the temporary memory for large arrays
+        xf, of = (x.reshape(-1), out.reshape(-1))
+        for first in range(0, xf.size, CLOCK_CHUNK_SIZE):
+            xc = xf[first:first + CLOCK_CHUNK_SIZE]
+            yc = np.interp(xc, xp, fp)
+            ilo, ihi = (np.where(xc < xp[0])[0], np.where(xc > xp[-1])[0])
+            yc[ilo] = (xc[ilo] - xp[0]) * s0 + fp[0]
+            yc[ihi] = (xc[ihi] - xp[-1]) * s1 + fp[-1]
+            of[first:first + CLOCK_CHUNK_SIZE] = yc
+        return out[()] if scalar else out
+
+
+@lru_cache(maxsize=64)
+def _load_clock_converter(sync_file, mtime_ns):
+    return ClockConverter(np.load(sync_file))
+
+
+class TimeBase:
+    """
+    Session-wide registry of the clocks of a session (Bpod, probes), each mapped to the reference
+    clock of the session: the FPGA ('fpga', ie. the nidq for 3B and the main probe for 3A).
+    The mappings are fitted once and persisted as sync files of [clock times, reference times]:
+        - probes: _spikeglx_ephysData*.sync.npy registered by sync_probes.sync()
+        - bpod: alf/_ibl_bpod.sync.npy output by the FPGA trials extraction
+    Conversions between any two clocks are composed through the reference clock.
+    >>> tb = TimeBase(session_path)
+    >>> bpod_times = tb.convert(spike_times, 'probe00', 'bpod')
+    """
+    REFERENCE = 'fpga'
+
+    def __init__(self, session_path):
+        self.session_path = Path(session_path)
+        self._clocks = {}
+
+    def sync_file(self, label):
+        """
+        :param label: clock label, 'bpod' or probe label (ie. 'probe00')
+        :return: path of the sync file of the clock, None if the probe is not found
+        """
+        if label == 'bpod':
+            return self.session_path.joinpath('alf', '_ibl_bpod.sync.npy')
+        for ef in spikeglx.glob_ephys_files(self.session_path, ext='meta', bin_exists=False):
+            if ef.label == label:
+                return _probe_sync_file(ef, 'ap' if ef.get('ap') else 'lf')
+
+    def register(self, label, sync_points, save=True):
+        """
+        Registers the mapping of a clock to the reference clock
+        :param label: clock label, 'bpod' or probe label (ie. 'probe00')
+        :param sync_points: array (n, 2) of [clock times, reference times]
+        :param save: (True) writes the sync file
+        :return: path of the sync file if saved, None otherwise
+        """
+        self._clocks[label] = ClockConverter(sync_points)
+        if save:
+            return self.save(label)
+
+    def save(self, label):
+        """
+        Writes the sync file of a registered clock
+        :param label: clock label
+        :return: path of the sync file
+        """
+        sync_file = self.sync_file(label)
+        sync_file.parent.mkdir(exist_ok=True, parents=True)
+        converter = self._clocks[label]
+        np.save(sync_file, np.c_[converter.probe_times, converter.session_times])
+        return sync_file
+
+    def fit(self, label, times, ref_times, save=True):
+        """
+        Fits the mapping of a clock to the reference clock from events timestamped on both
+        clocks, some events possibly missing on either clock (see dsp.utils.sync_timestamps)
+        :param label: clock label
+        :param times: event times on the clock
+        :param ref_times: event times on the reference clock
+        :param save: (True) writes the sync file
+        :return: drift in ppm, indices of the matched events in times and ref_times
+        """
+        _, drift_ppm, ia, ib = sync_timestamps(times, ref_times, return_indices=True)
+        self.register(label, np.c_[times[ia], ref_times[ib]], save=save)
+        return drift_ppm, ia, ib
+
+    def converter(self, label):
+        """
+        :param label: clock label
+        :return: ClockConverter of the clock to the reference clock
+        """
+        if label not in self._clocks:
+            sync_file = self.sync_file(label)
+            if sync_file is None or not sync_file.exists():
+                raise FileNotFoundError(f"No sync file found for {label} clock in "
+                                        f"{self.session_path}")
+            self._clocks[label] = ClockConverter.from_file(sync_file)
+        return self._clocks[label]
+
+    def convert(self, times, src, dst, out=None):
+        """
+        :param times: times in seconds on the src clock
+        :param src: source clock label, 'fpga', 'bpod' or probe label
+        :param dst: destination clock label, 'fpga', 'bpod' or probe label
+        :param out: (None) float64 output array, may be times itself for an in-place conversion
+        :return: times in seconds on the dst clock
+        """
+        steps = []
+        if src != dst and src != self.REFERENCE:
+            steps.append(self.converter(src).forward)
+        if src != dst and dst != self.REFERENCE:
+            steps.append(self.converter(dst).inverse)
+        if not steps:
+            if out is None:
+                return np.array(times, dtype=np.float64)[()]
+            out[...] = times
+            return out
+        for step in steps:
+            times = step(times, out=out)
+            # the following steps convert the intermediate result in place
+            out = None if np.isscalar(times) else times
+        return times
+
+
+class SessionReader:
+    """
+    Reads the raw ephys data of several probes of a session in session time, using the sync
+    files output by the probe synchronization (one _spikeglx_ephysData*.sync.npy per probe).
+    The reads of the different probes are run concurrently.
+    >>> ssr = SessionReader(session_path, band='lf')
+    >>> data, times = ssr.read(1200, 1201, labels=['probe00', 'probe01'])
+    >>> data['probe00'].shape, times['probe00'].shape  # (2500, 385), (2500,)
+    """
+    def __init__(self, session_path, band='ap', labels=None):
+        """
+        :param session_path: session folder, the raw ephys files are looked for recursively
+        :param band: 'ap' or 'lf'
+        :param labels: (None) list of probe labels to open (ie. 'probe00'), defaults to all
+        """
+        self.band = band
+        self.readers = {}
+        self._clocks = {}
+        # without the binary files check, so that probes with only the lf band are found
+        ephys_files = spikeglx.glob_ephys_files(session_path, bin_exists=False)
+        for ef in sorted(ephys_files, key=lambda ef: ef.label):
+            if ef.get(band) is None or not ef[band].exists():
+                continue
+            if labels is not None and ef.label not in labels:
+                continue
+            sync_file = _probe_sync_file(ef, band)
+            if not sync_file.exists():
+                raise FileNotFoundError(f"{sync_file} not found: run sync_probes.sync() first")
+            self.readers[ef.label] = spikeglx.Reader(ef[band])
+            self._clocks[ef.label] = ClockConverter.from_file(sync_file)
+
+    @property
+    def labels(self):
+        return list(self.readers.keys())
+
+    def time2sample(self, label, times):
+        """
+        :param label: probe label
+        :param times: session times in seconds
+        :return: sample indices in the probe file, rounded to the nearest sample
+        """
+        probe_times = self._clocks[label].inverse(times)
+        return np.int64(np.round(probe_times * self.readers[label].fs))
+
+    def sample2time(self, label, samples):
+        """
+        :param label: probe label
+        :param samples: sample indices in the probe file
+        :return: session times in seconds
+        """
+        return self._clocks[label].forward(np.asarray(samples) / self.readers[label].fs)
+
+    def read(self, t0, t1, labels=None, csel=slice(None)):
+        """
+        Reads the samples of each probe between two session times, the probes being read
+        concurrently. As probe clocks drift, the number of samples may differ across probes.
+        :param t0: start session time in seconds
+        :param t1: stop session time in seconds (excluded)
+        :param labels: (None) list of probe labels, defaults to all probes
+        :param csel: channel slice or indices, or dictionary of those with labels as keys
+        :return: data: dictionary of float32 arrays (ns, nc) in Volts with labels as keys
+        :return: times: dictionary of the session times of the samples with labels as keys
+        """
+        labels = self.labels if labels is None else labels
+
+        def _read(label):
+            sr = self.readers[label]
+            first, last = np.clip(self.time2sample(label, [t0, t1]), 0, sr.ns)
+            channels = csel.get(label, slice(None)) if isinstance(csel, dict) else csel
+            data = sr.read(slice(first, last), csel=channels, sync=False)
+            return data, self.sample2time(label, np.arange(first, last))
+
+        with ThreadPoolExecutor(max_workers=max(1, len(labels))) as executor:
+            results = list(executor.map(_read, labels))
+        data = Bunch({label: res[0] for label, res in zip(labels, results)})
+        times = Bunch({label: res[1] for label, res in zip(labels, results)})
+        return data, times
 
 
 def sync(ses_path, **kwargs):
@@ -57,29 +312,30 @@ def version3A(ses_path, display=True, type='smooth', tol=2.1):
     :return: bool True on a a successful sync
     """
     ephys_files = spikeglx.glob_ephys_files(ses_path, ext='meta', bin_exists=False)
+    timebase = TimeBase(ses_path)
     nprobes = len(ephys_files)
     if nprobes == 1:
         timestamps = np.array([[0., 0.], [1., 1.]])
         sr = _get_sr(ephys_files[0])
-        out_files = _save_timestamps_npy(ephys_files[0], timestamps, sr)
+        out_files = _save_timestamps_npy(ephys_files[0], timestamps, sr, timebase)
         return True, out_files
 
     def get_sync_fronts(auxiliary_name):
         d = Bunch({'times': [], 'nsync': np.zeros(nprobes, )})
         # auxiliary_name: frame2ttl or right_camera
         for ind, ephys_file in enumerate(ephys_files):
-            sync = alf.io.load_object(
-                ephys_file.ap.parent, 'sync', namespace='spikeglx', short_keys=True)
+            sync = SyncIndex(alf.io.load_object(
+                ephys_file.ap.parent, 'sync', namespace='spikeglx', short_keys=True))
             sync_map = get_ibl_sync_map(ephys_file, '3A')
             # exits if sync label not found for current probe
             if auxiliary_name not in sync_map:
                 return
-            isync = np.in1d(sync['channels'], np.array([sync_map[auxiliary_name]]))
+            fronts = sync.fronts(sync_map[auxiliary_name])
             # only returns syncs if we get fronts for all probes
-            if np.all(~isync):
+            if fronts.times.size == 0:
                 return
             d.nsync[ind] = len(sync.channels)
-            d['times'].append(sync['times'][isync])
+            d['times'].append(fronts.times)
         return d
 
     d = get_sync_fronts('frame2ttl')
@@ -108,7 +364,7 @@ def version3A(ses_path, display=True, type='smooth', tol=2.1):
             timestamps, qc = sync_probe_front_times(d.times[:, ind], d.times[:, iref], sr,
                                                     display=display, type=type, tol=tol)
             qc_all &= qc
-        out_files = _save_timestamps_npy(ephys_file, timestamps, sr)
+        out_files = _save_timestamps_npy(ephys_file, timestamps, sr, timebase)
     return qc_all, out_files
 
 
@@ -124,8 +380,10 @@ def version3B(ses_path, display=True, type=None, tol=2.5):
     """
     DEFAULT_TYPE = 'smooth'
     ephys_files = spikeglx.glob_ephys_files(ses_path, ext='meta', bin_exists=False)
+    timebase = TimeBase(ses_path)
     for ef in ephys_files:
-        ef['sync'] = alf.io.load_object(ef.path, 'sync', namespace='spikeglx', short_keys=True)
+        ef['sync'] = SyncIndex(alf.io.load_object(
+            ef.path, 'sync', namespace='spikeglx', short_keys=True))
         ef['sync_map'] = get_ibl_sync_map(ef, '3B')
     nidq_file = [ef for ef in ephys_files if ef.get('nidq')]
     ephys_files = [ef for ef in ephys_files if not ef.get('nidq')]
@@ -153,7 +411,7 @@ def version3B(ses_path, display=True, type=None, tol=2.5):
         timestamps, qc = sync_probe_front_times(sync_probe.times, sync_nidq.times, sr,
                                                 display=display, type=type_probe, tol=tol)
         qc_all &= qc
-        out_files.extend(_save_timestamps_npy(ef, timestamps, sr))
+        out_files.extend(_save_timestamps_npy(ef, timestamps, sr, timebase))
     return qc_all, out_files
 
 
@@ -234,16 +492,26 @@ def sync_probe_front_times(t, tref, sr, display=False, type='smooth', tol=2.0):
     return sync_points, qc
 
 
+def _probe_sync_file(ephys_file, band='ap'):
+    """
+    :param ephys_file: ephys files of a probe (see spikeglx.glob_ephys_files)
+    :param band: 'ap' or 'lf', band of the file the sync file name is derived from
+    :return: path of the probe sync file (_spikeglx_ephysData*.sync.npy)
+    """
+    file_band = ephys_file[band]
+    return file_band.parent.joinpath(file_band.name.replace(f'.{band}.', '.sync.')
+                                     ).with_suffix('.npy')
+
+
 def _get_sr(ephys_file):
     meta = spikeglx.read_meta_data(ephys_file.ap.with_suffix('.meta'))
     return spikeglx._get_fs_from_meta(meta)
 
 
-def _save_timestamps_npy(ephys_file, tself_tref, sr):
-    # this is the file with self_time_secs, ref_time_secs output
-    file_sync = ephys_file.ap.parent.joinpath(ephys_file.ap.name.replace('.ap.', '.sync.')
-                                              ).with_suffix('.npy')
-    np.save(file_sync, tself_tref)
+def _save_timestamps_npy(ephys_file, tself_tref, sr, timebase):
+    # the probe clock is registered in the session time base, that writes the sync file with
+    # self_time_secs, ref_time_secs
+    file_sync = timebase.register(ephys_file.label, tself_tref)
     # this is the timestamps file
     file_ts = ephys_file.ap.parent.joinpath(ephys_file.ap.name.replace('.ap.', '.timestamps.')
                                             ).with_suffix('.npy')
@@ -5,9 +5,12 @@ processed data from raw hardware files and optionally save them.
 
 import abc
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
 import logging
+import os
 from pathlib import Path
+import threading
 
 import numpy as np
 import pandas as pd
@@ -27,12 +30,15 @@ class BaseExtractor(abc.ABC):
     -   save_names is a list or a string of filenames, there should be one per dataset
     -   set save_names to None for a dataset that doesn't need saving (could be set dynamically
     in the _extract method)
+    -   input_names lists the var_names of other extractors that the _extract method accepts as
+    keyword arguments, see run_extractor_classes
     :param session_path: Absolute path of session folder
     :type session_path: str
     """
 
     session_path = None
     save_names = None
+    input_names = ()
     default_path = Path("alf")  # relative to session
 
     def __init__(self, session_path=None):
@@ -107,24 +113,61 @@ class BaseBpodTrialsExtractor(BaseExtractor):
     :param settings
     """
 
-    bpod_trials = None
     settings = None
+    run_cache = None  # RunCache shared by the extractors of a run, see run_extractor_classes
+    _bpod_trials = None
+    _trials_table = None
 
-    def extract(self, bpod_trials=None, settings=None, **kwargs):
+    def _load(self, name, fcn):
+        """Loads an input once per run of extractors if the extractor is part of a run"""
+        return fcn() if self.run_cache is None else self.run_cache.get(name, fcn)
+
+    @property
+    def bpod_trials(self):
+        """Bpod trials from the jsonable, loaded on first access"""
+        if self._bpod_trials is None:
+            self._bpod_trials = self._load(
+                'bpod_trials', lambda: raw.load_data(self.session_path))
+        return self._bpod_trials
+
+    @bpod_trials.setter
+    def bpod_trials(self, value):
+        self._bpod_trials = value
+
+    @property
+    def trials_table(self):
+        """
+        Columnar trials table (see raw_data_loaders.TrialsTable) built from the bpod trials if
+        provided, otherwise loaded from the session cache, on first access
+        """
+        if self._trials_table is None:
+            if self._bpod_trials is None:
+                self._trials_table = self._load(
+                    'trials_table', lambda: raw.load_trials_table(self.session_path))
+            else:
+                self._trials_table = self._load(
+                    'trials_table', lambda: raw.TrialsTable.from_trials(self._bpod_trials))
+        return self._trials_table
+
+    @trials_table.setter
+    def trials_table(self, value):
+        self._trials_table = value
+
+    def extract(self, bpod_trials=None, settings=None, trials_table=None, **kwargs):
         """
         :param: bpod_trials (optional) bpod trials from jsonable in a dictionary
         :param: settings (optional) bpod iblrig settings json file in a dictionary
+        :param: trials_table (optional) raw_data_loaders.TrialsTable of the bpod trials
         :param: save (bool) write output ALF files, defaults to False
         :param: path_out (pathlib.Path) output path (defaults to `{session_path}/alf`)
         :return: numpy.ndarray or list of ndarrays, list of filenames
         :rtype: dtype('float64')
         """
         self.bpod_trials = bpod_trials
+        self.trials_table = trials_table
         self.settings = settings
-        if self.bpod_trials is None:
-            self.bpod_trials = raw.load_data(self.session_path)
         if not self.settings:
-            self.settings = raw.load_settings(self.session_path)
+            self.settings = self._load('settings', lambda: raw.load_settings(self.session_path))
         if self.settings is None:
             self.settings = {"IBLRIG_VERSION_TAG": "100.0.0"}
         elif self.settings["IBLRIG_VERSION_TAG"] == "":
@@ -132,12 +175,43 @@ class BaseBpodTrialsExtractor(BaseExtractor):
         return super(BaseBpodTrialsExtractor, self).extract(**kwargs)
 
 
-def run_extractor_classes(classes, session_path=None, **kwargs):
+class RunCache:
+    """
+    Inputs loaded once and shared by the extractors of a run (bpod trials, settings...)
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, fcn):
+        """
+        :param name: input name
+        :param fcn: function without argument loading the input, called on first request only
+        :return: input value
+        """
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = fcn()
+            return self._values[name]
+
+
+def _get_output(classe, out, name):
+    if isinstance(classe.var_names, str):
+        return out
+    return out[classe.var_names.index(name)]
+
+
+def run_extractor_classes(classes, session_path=None, n_workers=None, **kwargs):
     """
-    Run a set of extractors with the same inputs
+    Run a set of extractors with the same inputs.
+    The extractors run concurrently in a thread pool. An extractor that lists outputs of other
+    extractors of the set in its input_names runs after them, and gets those outputs as keyword
+    arguments. The inputs loaded by the extractors are shared through a RunCache.
     :param classes: list of Extractor class
     :param save: True/False
     :param path_out: (defaults to alf path)
+    :param n_workers: number of threads, defaults to one per extractor up to the number of cpus
     :param kwargs: extractor arguments (session_path...)
     :return: dictionary of arrays, list of files
     """
@@ -149,8 +223,39 @@ def run_extractor_classes(classes, session_path=None, **kwargs):
         iter(classes)
     except TypeError:
         classes = [classes]
-    for classe in classes:
-        out, fil = classe(session_path=session_path).extract(**kwargs)
+    classes = list(classes)
+    # builds the dependency graph from the declared inputs
+    producers = {}
+    for i, classe in enumerate(classes):
+        var_names = [classe.var_names] if isinstance(classe.var_names, str) else classe.var_names
+        producers.update({k: i for k in var_names})
+    inputs = [{k: producers[k] for k in classe.input_names if producers.get(k, i) != i}
+              for i, classe in enumerate(classes)]
+    results = [None] * len(classes)
+    run_cache = RunCache()
+
+    def _run(i):
+        extractor = classes[i](session_path=session_path)
+        extractor.run_cache = run_cache
+        upstream = {k: _get_output(classes[j], results[j][0], k) for k, j in inputs[i].items()}
+        return extractor.extract(**{**kwargs, **upstream})
+
+    n_workers = n_workers or min(len(classes), os.cpu_count() or 1)
+    pending, running = (set(range(len(classes))), {})
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as executor:
+        while pending or running:
+            ready = [i for i in sorted(pending) if all(results[j] is not None
+                                                       for j in inputs[i].values())]
+            if not ready and not running:
+                raise ValueError(f"Circular inputs between extractors "
+                                 f"{[classes[i].__name__ for i in pending]}")
+            for i in ready:
+                pending.remove(i)
+                running[executor.submit(_run, i)] = i
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    for classe, (out, fil) in zip(classes, results):
         if isinstance(fil, list):
             files.extend(fil)
         elif fil is not None:
@@ -6,7 +6,7 @@ from ibllib.io.extractors.training_trials import (
     CameraTimestamps, Choice, FeedbackTimes, FeedbackType, GoCueTimes, GoCueTriggerTimes,
     IncludedTrials, Intervals, ItiDuration, ProbabilityLeft, ResponseTimes, RewardVolume,
     StimOnTimes, StimOnTriggerTimes, StimOnOffFreezeTimes, ItiInTimes, StimOffTriggerTimes,
-    StimFreezeTriggerTimes, ErrorCueTriggerTimes, LaserBool)
+    StimFreezeTriggerTimes, ErrorCueTriggerTimes, LaserBool, _trials_table)
 from ibllib.misc import version
 
 
@@ -18,31 +18,42 @@ class ContrastLR(BaseBpodTrialsExtractor):
     var_names = ('contrastLeft', 'contrastRight')
 
     def _extract(self):
-        contrastLeft = np.array([t['contrast'] if np.sign(
-            t['position']) < 0 else np.nan for t in self.bpod_trials])
-        contrastRight = np.array([t['contrast'] if np.sign(
-            t['position']) > 0 else np.nan for t in self.bpod_trials])
+        side = np.sign(self.trials_table.fields['position'])
+        contrast = self.trials_table.fields['contrast']
+        contrastLeft = np.where(side < 0, contrast, np.nan)
+        contrastRight = np.where(side > 0, contrast, np.nan)
         return contrastLeft, contrastRight
 
 
-def extract_all(session_path, save=False, bpod_trials=False, settings=False):
-    if not bpod_trials:
-        bpod_trials = raw.load_data(session_path)
-    if not settings:
-        settings = raw.load_settings(session_path)
-    if settings is None or settings['IBLRIG_VERSION_TAG'] == '':
-        settings = {'IBLRIG_VERSION_TAG': '100.0.0'}
+def extractor_classes(settings):
+    """
+    Trials extractor classes for the iblrig version of the session
+    :param settings: bpod iblrig settings json file in a dictionary
+    :return: list of extractor classes
+    """
     base = [FeedbackType, ContrastLR, ProbabilityLeft, Choice, RewardVolume,
             FeedbackTimes, Intervals, ResponseTimes, GoCueTriggerTimes, GoCueTimes,
             CameraTimestamps, LaserBool]
-
     # Version specific extractions
-    if version.ge(settings['IBLRIG_VERSION_TAG'], '5.0.0'):
+    if version.ge(settings['IBLRIG_VERSION_TAG'] or '100.0.0', '5.0.0'):
         base.extend([StimOnTriggerTimes, IncludedTrials, StimOnOffFreezeTimes, ItiInTimes,
                      StimOffTriggerTimes, StimFreezeTriggerTimes, ErrorCueTriggerTimes])
     else:
         base.extend([ItiDuration, StimOnTimes])
+    return base
+
+
+def extract_all(session_path, save=False, bpod_trials=False, settings=False,
+                trials_table=None):
+    # the trials table is built once and shared by all extractors
+    if trials_table is None:
+        trials_table = _trials_table(session_path, bpod_trials)
+    if not settings:
+        settings = raw.load_settings(session_path)
+    if settings is None or settings['IBLRIG_VERSION_TAG'] == '':
+        settings = {'IBLRIG_VERSION_TAG': '100.0.0'}
 
     out, fil = run_extractor_classes(
-        base, save=save, session_path=session_path, bpod_trials=bpod_trials, settings=settings)
+        extractor_classes(settings), save=save, session_path=session_path,
+        bpod_trials=bpod_trials or None, trials_table=trials_table, settings=settings)
     return out, fil
@@ -3,6 +3,7 @@ This module will extract the Bpod trials and wheel data based on the task protoc
 i.e. habituation, training or biased.
 """
 import logging
+from collections import OrderedDict
 
 from ibllib.io.extractors import habituation_trials, training_trials, biased_trials, training_wheel
 import ibllib.io.extractors.base
@@ -11,45 +12,50 @@ import ibllib.io.raw_data_loaders as rawio
 _logger = logging.getLogger('ibllib')
 
 
-def extract_all(session_path, save=True, bpod_trials=None, settings=None):
+def extract_all(session_path, save=True, bpod_trials=None, settings=None, trials_table=None):
     """
-    Extracts a training session from its path.  NB: Wheel must be extracted first in order to
-    extract trials.firstMovement_times.
+    Extracts a training session from its path.  NB: the wheel and trials extractors run together
+    so that trials.firstMovement_times is computed from the extracted go cue and feedback times.
     :param session_path: the path to the session to be extracted
     :param save: if true a subset of the extracted data are saved as ALF
-    :param bpod_trials: list of Bpod trial data
+    :param bpod_trials: list of Bpod trial data, loaded only by the extractors that need it
     :param settings: the Bpod session settings
+    :param trials_table: raw_data_loaders.TrialsTable of the Bpod trials, built from bpod_trials
+     if provided, otherwise loaded from the session cache
     :return: trials: Bunch/dict of trials
     :return: wheel: Bunch/dict of wheel positions
     :return: out_Files: list of output files
     """
     extractor_type = ibllib.io.extractors.base.get_session_extractor_type(session_path)
     _logger.info(f"Extracting {session_path} as {extractor_type}")
-    bpod_trials = bpod_trials or rawio.load_data(session_path)
     settings = settings or rawio.load_settings(session_path)
     if extractor_type == 'training':
         _logger.info('training session on ' + settings['PYBPOD_BOARD'])
-        wheel, files_wheel = training_wheel.extract_all(
-            session_path, bpod_trials=bpod_trials, settings=settings, save=save)
-        trials, files_trials = training_trials.extract_all(
-            session_path, bpod_trials=bpod_trials, settings=settings, save=save)
+        classes = training_trials.extractor_classes(settings)
     elif extractor_type == 'biased' or extractor_type == 'ephys':
         _logger.info('biased session on ' + settings['PYBPOD_BOARD'])
-        wheel, files_wheel = training_wheel.extract_all(
-            session_path, bpod_trials=bpod_trials, settings=settings, save=save)
-        trials, files_trials = biased_trials.extract_all(
-            session_path, bpod_trials=bpod_trials, settings=settings, save=save)
+        classes = biased_trials.extractor_classes(settings)
     elif extractor_type == 'habituation':
         from ibllib.misc import version
         _logger.info('habituation session on ' + settings['PYBPOD_BOARD'])
         if version.le(settings['IBLRIG_VERSION_TAG'], '5.0.0'):
             _logger.warning("No extraction of legacy habituation sessions")
             return None, None, None
-        trials, files_trials = habituation_trials.extract_all(
+        bpod_trials = bpod_trials or rawio.load_data(session_path)
+        trials, files = habituation_trials.extract_all(
             session_path, bpod_trials=bpod_trials, settings=settings, save=save)
-        wheel = None
-        files_wheel = []
+        _logger.info('session extracted \n')  # timing info in log
+        return trials, None, files if save else None
     else:
         raise ValueError(f"No extractor for task {extractor_type}")
+    if trials_table is None:
+        # the table is built once and shared by the wheel and trials extractors
+        trials_table = (rawio.TrialsTable.from_trials(bpod_trials) if bpod_trials
+                        else rawio.load_trials_table(session_path))
+    # a single run: Wheel gets the go cue and feedback times from the trials extractors
+    trials, files = ibllib.io.extractors.base.run_extractor_classes(
+        classes + [training_wheel.Wheel], session_path=session_path, save=save,
+        bpod_trials=bpod_trials or None, trials_table=trials_table, settings=settings)
+    wheel = OrderedDict((k, trials.pop(k)) for k in training_wheel.Wheel.var_names)
     _logger.info('session extracted \n')  # timing info in log
-    return trials, wheel, (files_trials + files_wheel) if save else None
+    return trials, wheel, files if save else None
@@ -2,9 +2,14 @@
 Complete FPGA data extraction depends on Bpod extraction
 """
 from collections import OrderedDict
+from collections.abc import Mapping
+import hashlib
+import importlib
+import inspect
 import logging
+import os
 from pathlib import Path, PureWindowsPath
-import uuid
+import zipfile
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -14,6 +19,7 @@ import alf.io
 from brainbox.core import Bunch
 import ibllib.dsp as dsp
 import ibllib.exceptions as err
+from ibllib.misc import run_with_log_prefix, spawn_pool
 from ibllib.io import raw_data_loaders, spikeglx
 from ibllib.io.extractors import biased_trials
 from ibllib.io.extractors.base import (
@@ -27,11 +33,29 @@ import ibllib.plots as plots
 _logger = logging.getLogger('ibllib')
 
 SYNC_BATCH_SIZE_SECS = 100  # number of samples to read at once in bin file for sync
+SYNC_N_WORKERS = 4  # number of windows of the bin file processed concurrently for sync
+SYNC_N_FILES = 4  # maximum number of bin files extracted concurrently for sync
 WHEEL_RADIUS_CM = 1  # stay in radians
 WHEEL_TICKS = 1024
 
 BPOD_FPGA_DRIFT_THRESHOLD_PPM = 150
 
+# local folder of the checkpoints of the FPGA extraction stages, None disables the checkpoints.
+# The checkpoints of a session are in {root}/{subject}/{date}/{number}, never in the session
+FPGA_STAGES_CACHE_ROOT = None
+# version of each stage of the FPGA extraction: bump it to invalidate the checkpoints after a fix
+# outside of ibllib (changes of the ibllib version and of the stage modules below are detected)
+FPGA_STAGES_VERSION = {'bpod': 1, 'behaviour_sync': 1, 'alignment': 1, 'wheel': 1}
+# modules called by each stage of the FPGA extraction, their source is part of the stage key
+FPGA_STAGES_MODULES = {
+    'bpod': ['ibllib.io.extractors.ephys_fpga', 'ibllib.io.extractors.biased_trials',
+             'ibllib.io.extractors.training_trials', 'ibllib.io.extractors.base',
+             'ibllib.io.raw_data_loaders', 'ibllib.io.jsonable'],
+    'behaviour_sync': ['ibllib.io.extractors.ephys_fpga'],
+    'alignment': ['ibllib.io.extractors.ephys_fpga', 'ibllib.ephys.sync_probes'],
+    'wheel': ['ibllib.io.extractors.ephys_fpga', 'ibllib.io.extractors.training_wheel'],
+}
+
 CHMAPS = {'3A':
           {'ap':
            {'left_camera': 2,
@@ -95,30 +119,23 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
     else:
         raw_ephys_apfile = Path(raw_ephys_apfile)
         sr = spikeglx.Reader(raw_ephys_apfile)
-    # if no output, need a temp folder to swap for big files
     if not output_path:
         output_path = raw_ephys_apfile.parent
-    file_ftcp = Path(output_path).joinpath(f'fronts_times_channel_polarity{str(uuid.uuid4())}.bin')
 
-    # loop over chunks of the raw ephys file
-    wg = dsp.WindowGenerator(sr.ns, int(SYNC_BATCH_SIZE_SECS * sr.fs), overlap=1)
-    fid_ftcp = open(file_ftcp, 'wb')
-    for sl in wg.slice:
-        ss = sr.read_sync(sl)
+    def _window_fronts(first, last):
+        ss = sr.read_sync(slice(first, last))
         ind, fronts = dsp.fronts(ss, axis=0)
-        # a = sr.read_sync_analog(sl)
-        sav = np.c_[(ind[0, :] + sl.start) / sr.fs, ind[1, :], fronts.astype(np.double)]
-        sav.tofile(fid_ftcp)
-        # print progress
-        wg.print_progress()
-    # close temp file, read from it and delete
-    fid_ftcp.close()
-    tim_chan_pol = np.fromfile(str(file_ftcp))
-    tim_chan_pol = tim_chan_pol.reshape((int(tim_chan_pol.size / 3), 3))
-    file_ftcp.unlink()
-    sync = {'times': tim_chan_pol[:, 0],
-            'channels': tim_chan_pol[:, 1],
-            'polarities': tim_chan_pol[:, 2]}
+        return ind[0, :] + first, ind[1, :], fronts
+
+    # loop over chunks of the raw ephys file, the fronts are detected concurrently in windows
+    wg = dsp.WindowGenerator(sr.ns, int(SYNC_BATCH_SIZE_SECS * sr.fs), overlap=1)
+    fronts = _FrontsBuffer()
+    for samples, channels, polarities in wg.map(_window_fronts, n_workers=SYNC_N_WORKERS):
+        fronts.append(samples, channels, polarities)
+    fronts = fronts.data
+    sync = {'times': fronts['sample'] / sr.fs,
+            'channels': fronts['channel'].astype(np.double),
+            'polarities': fronts['polarity'].astype(np.double)}
     if save:
         out_files = alf.io.save_object_npy(output_path, sync, '_spikeglx_sync', parts=parts)
         return Bunch(sync), out_files
@@ -126,6 +143,32 @@ def _sync_to_alf(raw_ephys_apfile, output_path=None, save=False, parts=''):
         return Bunch(sync)
 
 
+class _FrontsBuffer:
+    """
+    Growable buffer of sync fronts stored as sample indices, channels and polarities, 10 bytes
+    per front. The capacity doubles when full so that appends are amortized.
+    """
+    dtype = np.dtype([('sample', np.int64), ('channel', np.uint8), ('polarity', np.int8)])
+
+    def __init__(self, capacity=2 ** 16):
+        self._data = np.zeros(capacity, dtype=self.dtype)
+        self.size = 0
+
+    def append(self, samples, channels, polarities):
+        n = samples.size
+        if self.size + n > self._data.size:
+            data = np.zeros(max(self._data.size * 2, self.size + n), dtype=self.dtype)
+            data[:self.size] = self._data[:self.size]
+            self._data = data
+        chunk = self._data[self.size:self.size + n]
+        chunk['sample'], chunk['channel'], chunk['polarity'] = (samples, channels, polarities)
+        self.size += n
+
+    @property
+    def data(self):
+        return self._data[:self.size]
+
+
 def _assign_events_bpod(bpod_t, bpod_polarities, ignore_first_valve=True):
     """
     From detected fronts on the bpod sync traces, outputs the synchronisation events
@@ -262,6 +305,7 @@ def _assign_events_to_trial(t_trial_start, t_event, take='last'):
     :param t_trial_start: numpy vector of trial start times
     :param t_event: numpy vector of event times to assign to trials
     :param take: 'last' or 'first' (optional, default 'last'): index to take in case of duplicates
+     or integer index within each trial events (negative from the end)
     :return: numpy array of event times with the same shape of trial start.
     """
     # make sure the events are sorted
@@ -285,17 +329,75 @@ def _assign_events_to_trial(t_trial_start, t_event, take='last'):
         iall, iu = np.unique(ind, return_index=True)
         t_event_nans[iall] = t_event[iu]
     else:  # if the index is arbitrary, needs to be numeric (could be negative if from the end)
-        iall = np.unique(ind)
+        # the trial indices are sorted: get the first element and the number of events per trial
+        ifirst = np.r_[0, np.where(np.diff(ind) != 0)[0] + 1] if ind.size else np.zeros(0, int)
+        iall, counts = (ind[ifirst], np.diff(np.r_[ifirst, ind.size]))
         minsize = take + 1 if take >= 0 else - take
         # for each trial, take the takenth element if there are enough values in trial
-        for iu in iall:
-            match = t_event[iu == ind]
-            if len(match) >= minsize:
-                t_event_nans[iu] = match[take]
+        sel = counts >= minsize
+        itake = ifirst + take if take >= 0 else ifirst + counts + take
+        t_event_nans[iall[sel]] = t_event[itake[sel]]
     return t_event_nans
 
 
+class SyncIndex(Mapping):
+    """
+    Read-only view of a sync dictionary ('times', 'channels', 'polarities') indexed per channel.
+    The fronts are grouped by channel once, keeping their time order within each channel, so that
+    the channel and time window queries are binary searches returning slices without copies.
+    Assumes the sync times are sorted, as output by the sync extraction.
+
+    >>> sync = SyncIndex(alf.io.load_object(path, 'sync', namespace='spikeglx', short_keys=True))
+    >>> bpod = sync.fronts(chmap['bpod'], tmax=tmax)
+    """
+
+    def __init__(self, sync):
+        self._sync = sync
+        order = np.argsort(sync['channels'], kind='stable')
+        channels = sync['channels'][order]
+        self._times = sync['times'][order]
+        self._polarities = sync['polarities'][order]
+        self._channels, first = np.unique(channels, return_index=True)
+        self._bounds = np.r_[first, channels.size]
+
+    def __getitem__(self, key):
+        return self._sync[key]
+
+    def __getattr__(self, key):
+        # dot syntax access to the sync arrays as for the Bunch
+        if key.startswith('_') or key not in self._sync:
+            raise AttributeError(key)
+        return self._sync[key]
+
+    def __iter__(self):
+        return iter(self._sync)
+
+    def __len__(self):
+        return len(self._sync)
+
+    def fronts(self, channel_nb, tmin=None, tmax=None):
+        """
+        :param channel_nb: sync channel number
+        :param tmin: (None) if set, only returns fronts at or after tmin
+        :param tmax: (None) if set, only returns fronts at or before tmax
+        :return: Bunch with 'times' and 'polarities' of the fronts on the channel
+        """
+        ic = np.searchsorted(self._channels, channel_nb)
+        if ic == self._channels.size or self._channels[ic] != channel_nb:
+            i0, i1 = (0, 0)
+        else:
+            i0, i1 = self._bounds[ic:ic + 2]
+        times = self._times[i0:i1]
+        # keep the truth value tests of _get_sync_fronts for the time bounds
+        first = np.searchsorted(times, tmin, side='left') if tmin else 0
+        last = np.searchsorted(times, tmax, side='right') if tmax else times.size
+        return Bunch({'times': self._times[i0 + first:i0 + last],
+                      'polarities': self._polarities[i0 + first:i0 + last]})
+
+
 def _get_sync_fronts(sync, channel_nb, tmin=None, tmax=None):
+    if isinstance(sync, SyncIndex):
+        return sync.fronts(channel_nb, tmin=tmin, tmax=tmax)
     selection = sync['channels'] == channel_nb
     selection = np.logical_and(selection, sync['times'] <= tmax) if tmax else selection
     selection = np.logical_and(selection, sync['times'] >= tmin) if tmin else selection
@@ -313,6 +415,7 @@ def extract_camera_sync(sync, chmap=None):
     """
     # NB: should we check we opencv the expected number of frames ?
     assert(chmap)
+    sync = sync if isinstance(sync, SyncIndex) else SyncIndex(sync)
     sr = _get_sync_fronts(sync, chmap['right_camera'])
     sl = _get_sync_fronts(sync, chmap['left_camera'])
     sb = _get_sync_fronts(sync, chmap['body_camera'])
@@ -331,6 +434,7 @@ def extract_wheel_sync(sync, chmap=None):
     :return: timestamps (np.array)
     :return: positions (np.array)
     """
+    sync = sync if isinstance(sync, SyncIndex) else SyncIndex(sync)
     wheel = {}
     channela = _get_sync_fronts(sync, chmap['rotary_encoder_0'])
     channelb = _get_sync_fronts(sync, chmap['rotary_encoder_1'])
@@ -351,6 +455,7 @@ def extract_behaviour_sync(sync, chmap=None, display=False, bpod_trials=None, tm
     defaults to False
     :return: trials dictionary
     """
+    sync = sync if isinstance(sync, SyncIndex) else SyncIndex(sync)
     bpod = _get_sync_fronts(sync, chmap['bpod'], tmax=tmax)
     if bpod.times.size == 0:
         raise err.SyncBpodFpgaException('No Bpod event found in FPGA. No behaviour extraction. '
@@ -432,41 +537,79 @@ def extract_behaviour_sync(sync, chmap=None, display=False, bpod_trials=None, tm
     return trials
 
 
-def extract_sync(session_path, overwrite=False, ephys_files=None):
+def extract_sync(session_path, overwrite=False, ephys_files=None, n_workers=None):
     """
     Reads ephys binary file (s) and extract sync within the binary file folder
     Assumes ephys data is within a `raw_ephys_data` folder
+    The binary files are extracted concurrently, each in its own process
 
     :param session_path: '/path/to/subject/yyyy-mm-dd/001'
     :param overwrite: Bool on re-extraction, forces overwrite instead of loading existing files
+    :param n_workers: (None) number of files extracted concurrently, defaults to the number of
+     files to extract up to SYNC_N_FILES and the number of cpus
     :return: list of sync dictionaries
     """
     session_path = Path(session_path)
     if not ephys_files:
         ephys_files = spikeglx.glob_ephys_files(session_path)
+    ephys_files = [efi for efi in ephys_files if efi.get('ap', efi.get('nidq', None))]
+    to_extract = [not overwrite and alf.io.exists(
+        efi.get('ap', efi.get('nidq')).parent, **_sync_alfname(efi.label)) for efi in ephys_files]
+    to_extract = [i for i, exists in enumerate(to_extract) if not exists]
+    n_workers = n_workers or min(max(len(to_extract), 1), SYNC_N_FILES, os.cpu_count())
+    futures = {}
+    if n_workers > 1 and len(to_extract) > 1:
+        # the logs of the worker processes are forwarded to the parent, labelled per probe
+        with spawn_pool(n_workers) as executor:
+            for i in to_extract:
+                futures[i] = executor.submit(
+                    run_with_log_prefix, ephys_files[i].label or 'nidq', _extract_sync_file,
+                    ephys_files[i].get('ap', ephys_files[i].get('nidq')), ephys_files[i].label)
     syncs = []
     outputs = []
-    for efi in ephys_files:
+    error = None
+    for i, efi in enumerate(ephys_files):
         bin_file = efi.get('ap', efi.get('nidq', None))
-        if not bin_file:
+        alfname = _sync_alfname(efi.label)
+        try:
+            if i in futures:
+                sync, out_files = futures[i].result()
+            elif i in to_extract:
+                sync, out_files = _extract_sync_file(bin_file, efi.label)
+            else:
+                _logger.warning(f'Skipping raw sync: SGLX sync found for probe {efi.label} !')
+                sync = alf.io.load_object(bin_file.parent, **alfname)
+                out_files, _ = alf.io._ls(bin_file.parent, **alfname)
+        except Exception as e:
+            # the other files extractions complete before the first error is raised
+            _logger.error(f'Sync extraction failed for probe {efi.label}: {bin_file}, {e}')
+            error = error or e
             continue
-        alfname = dict(object='sync', namespace='spikeglx')
-        if efi.label:
-            alfname['extra'] = efi.label
-        file_exists = alf.io.exists(bin_file.parent, **alfname)
-        if not overwrite and file_exists:
-            _logger.warning(f'Skipping raw sync: SGLX sync found for probe {efi.label} !')
-            sync = alf.io.load_object(bin_file.parent, **alfname)
-            out_files, _ = alf.io._ls(bin_file.parent, **alfname)
-        else:
-            sr = spikeglx.Reader(bin_file)
-            sync, out_files = _sync_to_alf(sr, bin_file.parent, save=True, parts=efi.label)
         outputs.extend(out_files)
         syncs.extend([sync])
-
+    if error:
+        raise error
     return syncs, outputs
 
 
+def _sync_alfname(label):
+    alfname = dict(object='sync', namespace='spikeglx')
+    if label:
+        alfname['extra'] = label
+    return alfname
+
+
+def _extract_sync_file(bin_file, label):
+    """
+    Extracts and saves the sync of a single binary file, run in a worker process by extract_sync
+    """
+    _logger.info(f'Extracting sync for probe {label}: {bin_file}')
+    sr = spikeglx.Reader(bin_file)
+    sync, out_files = _sync_to_alf(sr, bin_file.parent, save=True, parts=label)
+    _logger.info(f'Extracted {sync.times.size} sync fronts for probe {label}: {bin_file}')
+    return sync, out_files
+
+
 def _get_all_probes_sync(session_path, bin_exists=True):
     # round-up of all bin ephys files in the session, infer revision and get sync map
     ephys_files = spikeglx.glob_ephys_files(session_path, bin_exists=bin_exists)
@@ -483,7 +626,7 @@ def get_main_probe_sync(session_path, bin_exists=False):
     From 3A or 3B multiprobe session, returns the main probe (3A) or nidq sync pulses
     with the attached channel map (default chmap if none)
     :param session_path:
-    :return:
+    :return: SyncIndex of the sync pulses, channel map dictionary
     """
     ephys_files = _get_all_probes_sync(session_path, bin_exists=bin_exists)
     if not ephys_files:
@@ -496,11 +639,171 @@ def get_main_probe_sync(session_path, bin_exists=False):
         # the sync master is the nidq breakout box
         sync_box_ind = np.argmax([1 if ef.get('nidq') else 0 for ef in ephys_files])
 
-    sync = ephys_files[sync_box_ind].sync
+    sync = SyncIndex(ephys_files[sync_box_ind].sync)
     sync_chmap = ephys_files[sync_box_ind].sync_map
     return sync, sync_chmap
 
 
+class StageCache:
+    """
+    Checkpoints of the stages of the FPGA extraction. The output of a stage, a (nested) dictionary
+    of arrays, is saved in {cache_dir}/{stage}.npz along with the key of the stage: a sha1 of the
+    stage version, of the ibllib version, of the code of the stage function and of the modules it
+    calls (see FPGA_STAGES_MODULES) and of the content of its dependencies.
+    A stage is re-computed only if its key changed, so that a re-run after a failure or a fix only
+    re-computes the invalidated stages.
+    >>> cache = StageCache(Path.home().joinpath('fpga_stages', 'ZM_1150', '2019-05-07', '001'))
+    >>> wheel = cache.run('wheel', _wheel_stage, [sync_key, chmap], sync, chmap)
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: folder of the checkpoints, if None the stages are always computed
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+
+    @staticmethod
+    def hash(*objects):
+        """
+        Content hash of arrays, scalars, strings, files (Path) and nested dictionaries or lists
+        :return: sha1 hex digest
+        """
+        sha1 = hashlib.sha1()
+
+        def _update(obj):
+            if isinstance(obj, Mapping):
+                sha1.update(b'{')
+                for k in sorted(obj.keys()):
+                    sha1.update(repr(k).encode())
+                    _update(obj[k])
+                sha1.update(b'}')
+            elif isinstance(obj, (list, tuple)):
+                sha1.update(b'[')
+                for o in obj:
+                    _update(o)
+                sha1.update(b']')
+            elif isinstance(obj, np.ndarray):
+                sha1.update(f'{obj.dtype.str}{obj.shape}'.encode())
+                sha1.update(np.ascontiguousarray(obj).tobytes())
+            elif isinstance(obj, Path):
+                sha1.update(obj.name.encode())
+                with open(obj, 'rb') as fid:
+                    for chunk in iter(lambda: fid.read(2 ** 20), b''):
+                        sha1.update(chunk)
+            else:
+                sha1.update(repr(obj).encode())
+        _update(objects)
+        return sha1.hexdigest()
+
+    def run(self, stage, fcn, depends, *args, **kwargs):
+        """
+        Loads the stage output from its checkpoint if valid, otherwise computes and saves it
+        :param stage: name of the stage, see FPGA_STAGES_VERSION
+        :param fcn: stage function returning a dictionary of arrays (or None), may be nested
+        :param depends: list of the objects the output depends on, hashed to compute the key
+        :param args, kwargs: arguments of the stage function
+        :return: Bunch of the stage output
+        """
+        if self.cache_dir is None:
+            return fcn(*args, **kwargs)
+        from ibllib.misc import version
+        modules = [Path(inspect.getsourcefile(importlib.import_module(m)))
+                   for m in FPGA_STAGES_MODULES.get(stage, [])]
+        key = self.hash(stage, FPGA_STAGES_VERSION.get(stage), version.ibllib(),
+                        inspect.getsource(fcn), modules, depends)
+        cache_file = self.cache_dir.joinpath(f'{stage}.npz')
+        if cache_file.exists():
+            try:
+                with np.load(cache_file) as npz:
+                    if str(npz['key']) == key:
+                        _logger.info(f'FPGA extraction stage {stage} loaded from {cache_file}')
+                        return self._unflatten(npz)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                _logger.warning(f'Could not read the FPGA extraction checkpoint {cache_file}')
+        out = fcn(*args, **kwargs)
+        arrays = self._flatten(out)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # writes then renames so that an interrupted run leaves no partial checkpoint
+            part_file = cache_file.with_suffix('.part')
+            with open(part_file, 'wb') as fid:
+                np.savez(fid, key=key, **arrays)
+            os.replace(part_file, cache_file)
+        except OSError:
+            _logger.warning(f'Could not write the FPGA extraction checkpoint {cache_file}')
+        return out
+
+    @staticmethod
+    def _flatten(out, prefix=''):
+        """Flattens nested dictionaries to npz keys 'out/key/subkey', None values to 'none/key'"""
+        arrays = {}
+        for k, v in out.items():
+            if isinstance(v, Mapping):
+                arrays.update(StageCache._flatten(v, prefix=f'{prefix}{k}/'))
+            elif v is None:
+                arrays[f'none/{prefix}{k}'] = np.array([])
+            else:
+                arrays[f'out/{prefix}{k}'] = np.asarray(v)
+        return arrays
+
+    @staticmethod
+    def _unflatten(npz):
+        out = Bunch()
+        for name in npz.files:
+            kind, *keys = name.split('/')
+            if kind not in ('out', 'none'):
+                continue
+            d = out
+            for k in keys[:-1]:
+                d = d.setdefault(k, Bunch())
+            d[keys[-1]] = npz[name][()] if kind == 'out' else None
+        return out
+
+
+def _bpod_stage_depends(session_path):
+    """
+    Dependencies of the Bpod stage: name, modification time and size of the raw Bpod files it
+    reads, the task data and the task settings
+    """
+    raw_path = Path(session_path).joinpath('raw_behavior_data')
+    files = sorted(raw_path.glob('_iblrig_taskData.raw*.jsonable'))
+    files += sorted(raw_path.glob('_iblrig_taskSettings.raw*.json'))
+    return [(f.name, f.stat().st_mtime_ns, f.stat().st_size) for f in files]
+
+
+def _bpod_stage(session_path):
+    """
+    FPGA extraction stage: Bpod trials and pre-generated session values, in Bpod time
+    """
+    trials_table = raw_data_loaders.load_trials_table(session_path)
+    assert trials_table is not None, "No task trials data in raw_behavior_data - Exit"
+    bpod_trials, _ = biased_trials.extract_all(
+        session_path=session_path, save=False, trials_table=trials_table)
+    bpod_trials['intervals_bpod'] = np.copy(bpod_trials['intervals'])
+    # get ('probabilityLeft', 'contrastLeft', 'contrastRight') from the custom ephys extractors
+    pclcr, _ = ProbaContrasts(session_path).extract(trials_table=trials_table, save=False)
+    return {'trials': bpod_trials, 'pregenerated': dict(zip(ProbaContrasts.var_names, pclcr))}
+
+
+def _alignment_stage(session_path, bpod_start, fpga_start):
+    """
+    FPGA extraction stage: fit of the Bpod clock to the FPGA clock from the trials start times
+    """
+    from ibllib.ephys.sync_probes import TimeBase
+    drift_ppm, ibpod, ifpga = TimeBase(session_path).fit(
+        'bpod', bpod_start, fpga_start, save=False)
+    return {'sync_points': np.c_[bpod_start[ibpod], fpga_start[ifpga]], 'drift_ppm': drift_ppm,
+            'ibpod': ibpod, 'ifpga': ifpga}
+
+
+def _wheel_stage(sync, chmap):
+    """
+    FPGA extraction stage: wheel positions and movements in FPGA time
+    """
+    ts, pos = extract_wheel_sync(sync=sync, chmap=chmap)
+    return {'timestamps': ts, 'position': pos, 'moves': extract_wheel_moves(ts, pos)}
+
+
 class ProbaContrasts(BaseBpodTrialsExtractor):
     """
     Bpod pre-generated values for probabilityLeft, contrastLR, phase, quiescence
@@ -514,7 +817,7 @@ class ProbaContrasts(BaseBpodTrialsExtractor):
         """Extracts positions, contrasts, quiescent delay, stimulus phase and probability left
         from pregenerated session files.
         Optional: saves alf contrastLR and probabilityLeft npy files"""
-        pe = self.get_pregenerated_events(self.bpod_trials, self.settings)
+        pe = self.get_pregenerated_events(self.trials_table, self.settings)
         return [pe[k] for k in sorted(pe.keys())]
 
     @staticmethod
@@ -564,7 +867,7 @@ class CameraTimestamps(BaseExtractor):
                   '_ibl_bodyCamera.times.npy']
     var_names = ['right_camera_timestamps', 'left_camera_timestamps', 'body_camera_timestamps']
 
-    def _extract(self, sync=None, chmap=None):
+    def _extract(self, sync=None, chmap=None, **kwargs):
         ts = extract_camera_sync(sync=sync, chmap=chmap)
         return ts['right_camera'], ts['left_camera'], ts['body_camera']
 
@@ -593,26 +896,50 @@ class FpgaTrials(BaseExtractor):
         """An extractor for all ephys trial data, in FPGA time"""
         super().__init__(*args, **kwargs)
         self.bpod2fpga = None
-
-    def _extract(self, sync=None, chmap=None, **kwargs):
-        """Extracts ephys trials by combining Bpod and FPGA sync pulses"""
+        self.timebase = None
+
+    def extract(self, save=False, path_out=None, **kwargs):
+        """
+        On top of the trials, saves the Bpod to FPGA clock fit in the session time base
+        (see ibllib.ephys.sync_probes.TimeBase)
+        """
+        out, files = super().extract(save=save, path_out=path_out, **kwargs)
+        if save:
+            files.append(self.timebase.save('bpod'))
+        return out, files
+
+    def _extract(self, sync=None, chmap=None, cache_dir=None, **kwargs):
+        """
+        Extracts ephys trials by combining Bpod and FPGA sync pulses
+        :param cache_dir: (None) folder of the stage checkpoints (see StageCache), if None all
+         stages are computed
+        """
         # extract the behaviour data from bpod
         if sync is None or chmap is None:
             _sync, _chmap = get_main_probe_sync(self.session_path, bin_exists=False)
             sync = sync or _sync
             chmap = chmap or _chmap
+        cache = StageCache(cache_dir)
+        sync_key = StageCache.hash(sync) if cache.cache_dir else None
         # load the bpod data and performs a biased choice world training extraction
-        bpod_raw = raw_data_loaders.load_data(self.session_path)
-        assert bpod_raw is not None, "No task trials data in raw_behavior_data - Exit"
-        bpod_trials, _ = biased_trials.extract_all(
-            session_path=self.session_path, save=False, bpod_trials=bpod_raw)
-        bpod_trials['intervals_bpod'] = np.copy(bpod_trials['intervals'])
-        fpga_trials = extract_behaviour_sync(sync=sync, chmap=chmap, bpod_trials=bpod_trials,
-                                             tmax=bpod_trials['intervals'][-1, -1] + 60)
-        # checks consistency and compute dt with bpod
-        self.bpod2fpga, drift_ppm, ibpod, ifpga = dsp.utils.sync_timestamps(
-            bpod_trials['intervals_bpod'][:, 0], fpga_trials.pop('intervals')[:, 0],
-            return_indices=True)
+        bpod_key = _bpod_stage_depends(self.session_path) if cache.cache_dir else None
+        bpod = cache.run('bpod', _bpod_stage, bpod_key, self.session_path)
+        bpod_trials = bpod['trials']
+        tmax = bpod_trials['intervals'][-1, -1] + 60
+        bpod_intervals = {'intervals_bpod': bpod_trials['intervals_bpod']}
+        fpga_trials = cache.run('behaviour_sync', extract_behaviour_sync,
+                                [sync_key, chmap, bpod_intervals, tmax],
+                                sync=sync, chmap=chmap, bpod_trials=bpod_intervals, tmax=tmax)
+        # checks consistency and compute dt with bpod, the fit is registered in the time base
+        from ibllib.ephys.sync_probes import TimeBase
+        bpod_start = bpod_trials['intervals_bpod'][:, 0]
+        fpga_start = fpga_trials.pop('intervals')[:, 0]
+        alignment = cache.run('alignment', _alignment_stage, [bpod_start, fpga_start],
+                              self.session_path, bpod_start, fpga_start)
+        drift_ppm, ibpod, ifpga = (alignment['drift_ppm'], alignment['ibpod'], alignment['ifpga'])
+        self.timebase = TimeBase(self.session_path)
+        self.timebase.register('bpod', alignment['sync_points'], save=False)
+        self.bpod2fpga = lambda times: self.timebase.convert(times, 'bpod', TimeBase.REFERENCE)
         nbpod = bpod_trials['intervals_bpod'].shape[0]
         npfga = fpga_trials['feedback_times'].shape[0]
         nsync = len(ibpod)
@@ -626,19 +953,17 @@ class FpgaTrials(BaseExtractor):
         bpod_rsync_fields = ['intervals', 'response_times', 'goCueTrigger_times',
                              'stimOnTrigger_times', 'stimOffTrigger_times',
                              'stimFreezeTrigger_times', 'errorCueTrigger_times']
-        # get ('probabilityLeft', 'contrastLeft', 'contrastRight') from the custom ephys extractors
-        pclcr, _ = ProbaContrasts(self.session_path).extract(bpod_trials=bpod_raw, save=False)
         # build trials output
         out = OrderedDict()
-        out.update({k: pclcr[i][ibpod] for i, k in enumerate(ProbaContrasts.var_names)})
+        out.update({k: bpod['pregenerated'][k][ibpod] for k in ProbaContrasts.var_names})
         out.update({k: bpod_trials[k][ibpod] for k in bpod_fields})
         out.update({k: self.bpod2fpga(bpod_trials[k][ibpod]) for k in bpod_rsync_fields})
         out.update({k: fpga_trials[k][ifpga] for k in sorted(fpga_trials.keys())})
 
         # extract the wheel data
         from ibllib.io.extractors.training_wheel import extract_first_movement_times
-        ts, pos = extract_wheel_sync(sync=sync, chmap=chmap)
-        moves = extract_wheel_moves(ts, pos)
+        wheel = cache.run('wheel', _wheel_stage, [sync_key, chmap], sync, chmap)
+        ts, pos, moves = (wheel['timestamps'], wheel['position'], wheel['moves'])
         settings = raw_data_loaders.load_settings(session_path=self.session_path)
         min_qt = settings.get('QUIESCENT_PERIOD', None)
         first_move_onsets, *_ = extract_first_movement_times(moves, out, min_qt=min_qt)
@@ -648,19 +973,25 @@ class FpgaTrials(BaseExtractor):
         return [out[k] for k in out] + [ts, pos, moves['intervals'], moves['peakAmplitude']]
 
 
-def extract_all(session_path, save=True, bin_exists=False):
+def extract_all(session_path, save=True, bin_exists=False, cache_dir=None):
     """
     For the IBL ephys task, reads ephys binary file and extract:
         -   sync
         -   wheel
         -   behaviour
         -   video time stamps
+    Optionally, the outputs of the trials extraction stages are checkpointed (see StageCache) so
+    that a re-run only re-computes the stages invalidated by new data or code.
     :param session_path: '/path/to/subject/yyyy-mm-dd/001'
     :param save: Bool, defaults to False
+    :param cache_dir: local folder of the stage checkpoints, outside of the session folder.
+     Defaults to the session folder in FPGA_STAGES_CACHE_ROOT if set, False to compute all stages
     :return: outputs, files
     """
+    if cache_dir is None and FPGA_STAGES_CACHE_ROOT:
+        cache_dir = Path(FPGA_STAGES_CACHE_ROOT).joinpath(*Path(session_path).parts[-3:])
     sync, chmap = get_main_probe_sync(session_path, bin_exists=bin_exists)
     outputs, files = run_extractor_classes(
         [CameraTimestamps, FpgaTrials], session_path=session_path,
-        save=save, sync=sync, chmap=chmap)
+        save=save, sync=sync, chmap=chmap, cache_dir=cache_dir or None)
     return outputs, files
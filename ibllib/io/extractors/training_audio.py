@@ -4,6 +4,7 @@ from pathlib import Path
 import logging
 
 import numpy as np
+import scipy.fft
 from scipy import signal
 from scipy.io import wavfile
 
@@ -16,7 +17,9 @@ logger_ = logging.getLogger('ibllib')
 NS_WIN = 2 ** 18  # 2 ** np.ceil(np.log2(1 * fs))
 OVERLAP = NS_WIN / 2
 NS_WELCH = 512
+NWIN_BATCH = 32  # number of windows processed at once by the welchogram
 FTONE = 5000
+READY_TONE_THRESHOLD = 0.8  # minimum amplitude ratio of the tone band over 0.1 sec
 UNIT = 'dBFS'  # dBFS or dbSPL
 READY_TONE_SPL = 85
 
@@ -26,15 +29,25 @@ def _running_mean(x, N):
     return (cumsum[N:] - cumsum[:-N]) / N
 
 
-def _detect_ready_tone(w, fs):
-    # get envelope of DC free signal and envelope of BP signal around freq of interest
-    h = np.abs(signal.hilbert(w - np.median(w)))
-    fh = np.abs(signal.hilbert(dsp.bp(w, si=1 / fs, b=FTONE * np.array([0.9, 0.95, 1.15, 1.1]))))
-    dtect = _running_mean(fh / (h + 1e-3), int(fs * 0.1)) > 0.8
+def _detect_ready_tone(pxx, fs, nperseg):
+    """
+    Detects the ready tones onsets from the periodograms of the half-overlapping segments of a
+    signal (see _periodograms): the amplitude of the band around the tone frequency relative to
+    the whole spectrum, averaged over 0.1 sec, rises above READY_TONE_THRESHOLD.
+    :param pxx: periodograms (nsegments, nperseg // 2 + 1)
+    :param fs: sampling frequency (Hz)
+    :param nperseg: n samples of each segment
+    :return: indices of the segments at the tones onsets
+    """
+    fscale = dsp.fscale(nperseg, 1 / fs, one_sided=True)
+    band = np.logical_and(fscale >= FTONE * 0.9, fscale <= FTONE * 1.15)
+    total = np.sum(pxx[:, 1:], axis=1, dtype=np.float64)
+    ratio = np.sqrt(np.sum(pxx[:, band], axis=1, dtype=np.float64) / np.maximum(total, 1e-12))
+    nseg = int(fs * 0.1 / (nperseg // 2))
+    if ratio.size <= nseg:
+        return np.array([], dtype=int)
+    dtect = _running_mean(ratio, nseg) > READY_TONE_THRESHOLD
     return np.where(np.diff(dtect.astype(int)) == 1)[0]
-    # tone = np.sin(2 * np.pi * FTONE * np.arange(0, fs * 0.1) / fs)
-    # tone = tone / np.sum(tone ** 2)
-    # xc = np.abs(signal.hilbert(signal.correlate(w - np.mean(w), tone)))
 
 
 def _get_conversion_factor(unit=UNIT, ready_tone_spl=READY_TONE_SPL):
@@ -57,14 +70,17 @@ def _get_conversion_factor(unit=UNIT, ready_tone_spl=READY_TONE_SPL):
 
 def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
     """
-    Computes a spectrogram on a very large audio file.
+    Computes a spectrogram on a very large audio file, and detects the ready tones onsets.
+    The Welch segments of all windows are computed by blocks of windows, with one real fft
+    per block in single precision, each segment being computed once even if it is shared by
+    overlapping windows. The ready tones are detected on the same segments spectra.
 
     :param fs: sampling frequency (Hz)
     :param wav: wav signal (vector or memmap)
     :param nswin: n samples of the sliding window
     :param overlap: n samples of the overlap between windows
     :param nperseg: n samples for the computation of the spectrogram
-    :return: tscale, fscale, downsampled_spectrogram
+    :return: tscale, fscale, downsampled_spectrogram, ready tones onsets (secs)
     """
     ns = wav.shape[0]
     window_generator = dsp.WindowGenerator(ns=ns, nswin=nswin, overlap=overlap)
@@ -73,23 +89,30 @@ def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
     W = np.zeros((nwin, len(fscale)))
     tscale = window_generator.tscale(fs=fs)
     detect = []
-    for first, last in window_generator.firstlast:
-        # load the current window into memory
-        w = np.float64(wav[first:last]) * _get_conversion_factor()
-        # detection of ready tones
-        a = [d + first for d in _detect_ready_tone(w, fs)]
-        if len(a):
-            detect += a
-        # the last window may not allow a pwelch
-        if (last - first) < nperseg:
+    # welch segments overlap by half: the segments are shared by the windows of a block only if
+    # the windows start on the segments grid, otherwise the windows are computed one by one
+    hop = nperseg // 2
+    nsstep = window_generator.nswin - window_generator.overlap
+    nwin_batch = NWIN_BATCH if nsstep % hop == 0 else 1
+    firstlast = list(window_generator.firstlast)
+    for iw0 in range(0, nwin, nwin_batch):
+        iw1 = min(iw0 + nwin_batch, nwin)
+        first, last = (firstlast[iw0][0], firstlast[iw1 - 1][1])
+        if last - first < nperseg:
             continue
-        # compute PSD estimate for the current window
-        iw = window_generator.iw
-        _, W[iw, :] = signal.welch(w, fs=fs, window='hanning', nperseg=nperseg, axis=-1,
-                                   detrend='constant', return_onesided=True, scaling='density')
-        if (iw % 50) == 0:
-            window_generator.print_progress()
-    window_generator.print_progress()
+        pxx = _periodograms(wav[first:last], fs, nperseg)
+        # detection of ready tones, the blocks overlap so a tone is whole in one of them at least
+        detect += [first + iseg * hop for iseg in _detect_ready_tone(pxx, fs, nperseg)]
+        # the welch estimate of a window is the mean of its segments periodograms
+        cumpxx = np.r_[np.zeros((1, pxx.shape[1])), np.cumsum(pxx, axis=0, dtype=np.float64)]
+        for iw in range(iw0, iw1):
+            nseg = (firstlast[iw][1] - firstlast[iw][0] - nperseg) // hop + 1
+            if nseg < 1:  # the last window may not allow a pwelch
+                continue
+            iseg = (firstlast[iw][0] - first) // hop
+            W[iw, :] = (cumpxx[iseg + nseg] - cumpxx[iseg]) / nseg
+        window_generator.iw = iw1 - 1
+        window_generator.print_progress()
     # the onset detection may have duplicates with sliding window, average them and remove
     detect = np.sort(np.array(detect)) / fs
     ind = np.where(np.diff(detect) < 0.1)[0]
@@ -98,6 +121,27 @@ def welchogram(fs, wav, nswin=NS_WIN, overlap=OVERLAP, nperseg=NS_WELCH):
     return tscale, fscale, W, detect
 
 
+def _periodograms(w, fs, nperseg):
+    """
+    Periodograms of the half-overlapping segments of a signal, as computed by scipy.signal.welch
+    with a hann window, constant detrending and a one-sided density scaling.
+    :param w: signal vector
+    :param fs: sampling frequency (Hz)
+    :param nperseg: n samples of each segment
+    :return: float32 array (nsegments, nperseg // 2 + 1)
+    """
+    w = np.float32(w) * np.float32(_get_conversion_factor())
+    hop = nperseg // 2
+    nseg = (w.size - nperseg) // hop + 1
+    segments = np.lib.stride_tricks.as_strided(
+        w, shape=(nseg, nperseg), strides=(w.strides[0] * hop, w.strides[0]), writeable=False)
+    win = np.float32(signal.get_window('hann', nperseg))
+    segments = (segments - np.mean(segments, axis=1, keepdims=True)) * win
+    pxx = np.abs(scipy.fft.rfft(segments, axis=1)) ** 2 / np.float32(fs * np.sum(win ** 2))
+    pxx[:, 1:-1 if nperseg % 2 == 0 else None] *= 2
+    return pxx
+
+
 def extract_sound(ses_path, save=True, force=False, delete=False):
     """
     Simple audio features extraction for ambient sound characterization.
@@ -123,14 +167,14 @@ def extract_sound(ses_path, save=True, force=False, delete=False):
         logger_.warning(f"Wav file doesn't exist: {wav_file}")
         return []
     # crunch the wav file
-    fs, wav = wavfile.read(wav_file, mmap=False)
+    fs, wav = wavfile.read(wav_file, mmap=True)
     if len(wav) == 0:
         status = _fix_wav_file(wav_file)
         if status != 0:
             logger_.error(f"WAV Header empty. Sox couldn't fix it, Abort. {wav_file}")
             return
         else:
-            fs, wav = wavfile.read(wav_file, mmap=False)
+            fs, wav = wavfile.read(wav_file, mmap=True)
     tscale, fscale, W, detect = welchogram(fs, wav)
     # save files
     if save:
@@ -27,17 +27,14 @@ class FeedbackType(BaseBpodTrialsExtractor):
     var_names = 'feedbackType'
 
     def _extract(self):
-        feedbackType = np.empty(len(self.bpod_trials))
+        table = self.trials_table
+        feedbackType = np.empty(len(table))
         feedbackType.fill(np.nan)
-        reward = []
-        error = []
-        no_go = []
-        for t in self.bpod_trials:
-            reward.append(~np.isnan(t['behavior_data']['States timestamps']['reward'][0][0]))
-            error.append(~np.isnan(t['behavior_data']['States timestamps']['error'][0][0]))
-            no_go.append(~np.isnan(t['behavior_data']['States timestamps']['no_go'][0][0]))
-
-        if not all(np.sum([reward, error, no_go], axis=0) == np.ones(len(self.bpod_trials))):
+        reward = ~np.isnan(table.state('reward')[:, 0])
+        error = ~np.isnan(table.state('error')[:, 0])
+        no_go = ~np.isnan(table.state('no_go')[:, 0])
+
+        if not all(np.sum([reward, error, no_go], axis=0) == np.ones(len(table))):
             raise ValueError
 
         feedbackType[reward] = 1
@@ -58,10 +55,10 @@ class ContrastLR(BaseBpodTrialsExtractor):
     var_names = ('contrastLeft', 'contrastRight')
 
     def _extract(self):
-        contrastLeft = np.array([t['contrast']['value'] if np.sign(
-            t['position']) < 0 else np.nan for t in self.bpod_trials])
-        contrastRight = np.array([t['contrast']['value'] if np.sign(
-            t['position']) > 0 else np.nan for t in self.bpod_trials])
+        side = np.sign(self.trials_table.fields['position'])
+        contrast = self.trials_table.fields['contrast']
+        contrastLeft = np.where(side < 0, contrast, np.nan)
+        contrastRight = np.where(side > 0, contrast, np.nan)
 
         return contrastLeft, contrastRight
 
@@ -71,7 +68,7 @@ class ProbabilityLeft(BaseBpodTrialsExtractor):
     var_names = 'probabilityLeft'
 
     def _extract(self):
-        return np.array([t['stim_probability_left'] for t in self.bpod_trials])
+        return self.trials_table.fields['stim_probability_left'].copy()
 
 
 class Choice(BaseBpodTrialsExtractor):
@@ -92,11 +89,9 @@ class Choice(BaseBpodTrialsExtractor):
     var_names = 'choice'
 
     def _extract(self):
-        sitm_side = np.array([np.sign(t['position']) for t in self.bpod_trials])
-        trial_correct = np.array([t['trial_correct'] for t in self.bpod_trials])
-        trial_nogo = np.array(
-            [~np.isnan(t['behavior_data']['States timestamps']['no_go'][0][0])
-             for t in self.bpod_trials])
+        sitm_side = np.sign(self.trials_table.fields['position'])
+        trial_correct = self.trials_table.fields['trial_correct']
+        trial_nogo = ~np.isnan(self.trials_table.state('no_go')[:, 0])
         choice = sitm_side.copy()
         choice[trial_correct] = -choice[trial_correct]
         choice[trial_nogo] = 0
@@ -118,18 +113,11 @@ class RepNum(BaseBpodTrialsExtractor):
     var_names = 'repNum'
 
     def _extract(self):
-        trial_repeated = np.array(
-            [t['contrast']['type'] == 'RepeatContrast' for t in self.bpod_trials])
-        trial_repeated = trial_repeated.astype(int)
-        repNum = trial_repeated.copy()
-        c = 0
-        for i in range(len(trial_repeated)):
-            if trial_repeated[i] == 0:
-                c = 0
-                repNum[i] = 0
-                continue
-            c += 1
-            repNum[i] = c
+        trial_repeated = self.trials_table.fields['contrast_type'] == 'RepeatContrast'
+        # count the trials since the last non-repeated trial
+        itrial = np.arange(trial_repeated.size)
+        ilast = np.maximum.accumulate(np.where(trial_repeated, -1, itrial))
+        repNum = (itrial - ilast).astype(int)
         return repNum
 
 
@@ -144,10 +132,10 @@ class RewardVolume(BaseBpodTrialsExtractor):
     var_names = 'rewardVolume'
 
     def _extract(self):
-        trial_volume = [x['reward_amount']
-                        if x['trial_correct'] else 0 for x in self.bpod_trials]
-        reward_volume = np.array(trial_volume).astype(np.float64)
-        assert len(reward_volume) == len(self.bpod_trials)
+        fields = self.trials_table.fields
+        reward_volume = np.where(
+            fields['trial_correct'], fields['reward_amount'], 0).astype(np.float64)
+        assert len(reward_volume) == len(self.trials_table)
         return reward_volume
 
 
@@ -165,44 +153,41 @@ class FeedbackTimes(BaseBpodTrialsExtractor):
 
     @staticmethod
     def get_feedback_times_lt5(session_path, data=False):
-        if not data:
-            data = raw.load_data(session_path)
-        rw_times = [tr['behavior_data']['States timestamps']['reward'][0][0]
-                    for tr in data]
-        err_times = [tr['behavior_data']['States timestamps']['error'][0][0]
-                     for tr in data]
-        nogo_times = [tr['behavior_data']['States timestamps']['no_go'][0][0]
-                      for tr in data]
+        """
+        :param session_path: Absolute path of session folder
+        :param data: (optional) bpod trials list or raw_data_loaders.TrialsTable
+        """
+        table = _trials_table(session_path, data)
+        rw_times = table.state('reward')[:, 0]
+        err_times = table.state('error')[:, 0]
+        nogo_times = table.state('no_go')[:, 0]
         assert sum(np.isnan(rw_times) &
                    np.isnan(err_times) & np.isnan(nogo_times)) == 0
-        merge = np.array([np.array(times)[~np.isnan(times)] for times in
-                          zip(rw_times, err_times, nogo_times)]).squeeze()
+        # the 3 states are mutually exclusive, keep the one that was visited
+        merge = np.where(~np.isnan(rw_times), rw_times,
+                         np.where(~np.isnan(err_times), err_times, nogo_times))
 
-        return np.array(merge)
+        return merge
 
     @staticmethod
     def get_feedback_times_ge5(session_path, data=False):
         # ger err and no go trig times -- look for BNC2High of trial -- verify
         # only 2 onset times go tone and noise, select 2nd/-1 OR select the one
         # that is grater than the nogo or err trial onset time
-        if not data:
-            data = raw.load_data(session_path)
-        missed_bnc2 = 0
-        rw_times, err_sound_times, merge = [np.zeros([len(data), ]) for _ in range(3)]
-
-        for ind, tr in enumerate(data):
-            st = tr['behavior_data']['Events timestamps'].get('BNC2High', None)
-            if not st:
-                st = np.array([np.nan, np.nan])
-                missed_bnc2 += 1
-            # xonar soundcard duplicates events, remove consecutive events too close together
-            st = np.delete(st, np.where(np.diff(st) < 0.020)[0] + 1)
-            rw_times[ind] = tr['behavior_data']['States timestamps']['reward'][0][0]
-            # get the error sound only if the reward is nan
-            err_sound_times[ind] = st[-1] if st.size >= 2 and np.isnan(rw_times[ind]) else np.nan
-        if missed_bnc2 == len(data):
+        table = _trials_table(session_path, data)
+        st, offsets = table.events.get(
+            'BNC2High', (np.zeros(0), np.zeros(len(table) + 1, dtype=np.int64)))
+        itrial = np.repeat(np.arange(len(table)), np.diff(offsets))
+        # xonar soundcard duplicates events, remove consecutive events too close together
+        keep = np.r_[True, ~((np.diff(st) < 0.020) & (np.diff(itrial) == 0))][:st.size]
+        counts = np.bincount(itrial[keep], minlength=len(table))
+        rw_times = table.state('reward')[:, 0]
+        # get the error sound only if the reward is nan, trials without BNC2High have no sound
+        err_sound_times = raw.ragged_take(st[keep], np.r_[0, np.cumsum(counts)], -1)
+        err_sound_times[(counts < 2) | ~np.isnan(rw_times)] = np.nan
+        if np.all(np.diff(offsets) == 0):
             _logger.warning('No BNC2 for feedback times, filling error trials NaNs')
-        merge *= np.nan
+        merge = np.zeros(len(table)) * np.nan
         merge[~np.isnan(rw_times)] = rw_times[~np.isnan(rw_times)]
         merge[~np.isnan(err_sound_times)] = err_sound_times[~np.isnan(err_sound_times)]
 
@@ -211,9 +196,9 @@ class FeedbackTimes(BaseBpodTrialsExtractor):
     def _extract(self):
         # Version check
         if version.ge(self.settings['IBLRIG_VERSION_TAG'], '5.0.0'):
-            merge = self.get_feedback_times_ge5(self.session_path, data=self.bpod_trials)
+            merge = self.get_feedback_times_ge5(self.session_path, data=self.trials_table)
         else:
-            merge = self.get_feedback_times_lt5(self.session_path, data=self.bpod_trials)
+            merge = self.get_feedback_times_lt5(self.session_path, data=self.trials_table)
         return np.array(merge)
 
 
@@ -229,9 +214,8 @@ class Intervals(BaseBpodTrialsExtractor):
     var_names = 'intervals'
 
     def _extract(self):
-        starts = [t['behavior_data']['Trial start timestamp'] for t in self.bpod_trials]
-        ends = [t['behavior_data']['Trial end timestamp'] for t in self.bpod_trials]
-        return np.array([starts, ends]).T
+        fields = self.trials_table.fields
+        return np.c_[fields['trial_start'], fields['trial_end']]
 
 
 class ResponseTimes(BaseBpodTrialsExtractor):
@@ -245,8 +229,7 @@ class ResponseTimes(BaseBpodTrialsExtractor):
     var_names = 'response_times'
 
     def _extract(self):
-        rt = np.array([tr['behavior_data']['States timestamps']['closed_loop'][0][1]
-                       for tr in self.bpod_trials])
+        rt = self.trials_table.state('closed_loop')[:, 1].copy()
         return rt
 
 
@@ -259,11 +242,14 @@ class ItiDuration(BaseBpodTrialsExtractor):
     """
     save_names = '_ibl_trials.itiDuration.npy'
     var_names = 'iti_dur'
-
-    def _extract(self):
-        rt, _ = ResponseTimes(self.session_path).extract(
-            save=False, bpod_trials=self.bpod_trials, settings=self.settings)
-        ends = np.array([t['behavior_data']['Trial end timestamp'] for t in self.bpod_trials])
+    input_names = ('response_times',)
+
+    def _extract(self, response_times=None):
+        rt = response_times
+        if rt is None:
+            rt, _ = ResponseTimes(self.session_path).extract(
+                save=False, trials_table=self.trials_table, settings=self.settings)
+        ends = self.trials_table.fields['trial_end']
         iti_dur = ends - rt
         return iti_dur
 
@@ -282,11 +268,9 @@ class GoCueTriggerTimes(BaseBpodTrialsExtractor):
 
     def _extract(self):
         if version.ge(self.settings['IBLRIG_VERSION_TAG'], '5.0.0'):
-            goCue = np.array([tr['behavior_data']['States timestamps']
-                              ['play_tone'][0][0] for tr in self.bpod_trials])
+            goCue = self.trials_table.state('play_tone')[:, 0].copy()
         else:
-            goCue = np.array([tr['behavior_data']['States timestamps']
-                             ['closed_loop'][0][0] for tr in self.bpod_trials])
+            goCue = self.trials_table.state('closed_loop')[:, 0].copy()
         return goCue
 
 
@@ -295,18 +279,15 @@ class TrialType(BaseBpodTrialsExtractor):
     var_name = 'trial_type'
 
     def _extract(self):
-        trial_type = []
-        for tr in self.bpod_trials:
-            if ~np.isnan(tr["behavior_data"]["States timestamps"]["reward"][0][0]):
-                trial_type.append(1)
-            elif ~np.isnan(tr["behavior_data"]["States timestamps"]["error"][0][0]):
-                trial_type.append(-1)
-            elif ~np.isnan(tr["behavior_data"]["States timestamps"]["no_go"][0][0]):
-                trial_type.append(0)
-            else:
-                _logger.warning("Trial is not in set {-1, 0, 1}, appending NaN to trialType")
-                trial_type.append(np.nan)
-        return np.array(trial_type)
+        table = self.trials_table
+        trial_type = np.select(
+            [~np.isnan(table.state(state)[:, 0]) for state in ('reward', 'error', 'no_go')],
+            [1, -1, 0], default=np.nan)
+        nnan = np.sum(np.isnan(trial_type))
+        if nnan:
+            _logger.warning(f"{nnan} trials not in set {{-1, 0, 1}}, appending NaN to trialType")
+            return trial_type
+        return trial_type.astype(int)
 
 
 class GoCueTimes(BaseBpodTrialsExtractor):
@@ -323,20 +304,10 @@ class GoCueTimes(BaseBpodTrialsExtractor):
     var_names = 'goCue_times'
 
     def _extract(self):
-        go_cue_times = np.zeros([len(self.bpod_trials), ])
-        for ind, tr in enumerate(self.bpod_trials):
-            if raw.get_port_events(tr, 'BNC2'):
-                bnchigh = tr['behavior_data']['Events timestamps'].get('BNC2High', None)
-                if bnchigh:
-                    go_cue_times[ind] = bnchigh[0]
-                    continue
-                bnclow = tr['behavior_data']['Events timestamps'].get('BNC2Low', None)
-                if bnclow:
-                    go_cue_times[ind] = bnclow[0] - 0.1
-                    continue
-                go_cue_times[ind] = np.nan
-            else:
-                go_cue_times[ind] = np.nan
+        # first BNC2 rising front, or first falling front minus the 100 ms of the tone
+        bnchigh = self.trials_table.event('BNC2High', 0)
+        bnclow = self.trials_table.event('BNC2Low', 0) - 0.1
+        go_cue_times = np.where(np.isnan(bnchigh), bnclow, bnchigh)
 
         nmissing = np.sum(np.isnan(go_cue_times))
         # Check if all stim_syncs have failed to be detected
@@ -357,19 +328,19 @@ class IncludedTrials(BaseBpodTrialsExtractor):
     def _extract(self):
         if version.ge(self.settings['IBLRIG_VERSION_TAG'], '5.0.0'):
             trials_included = self.get_included_trials_ge5(
-                data=self.bpod_trials, settings=self.settings)
+                data=self.trials_table, settings=self.settings)
         else:
-            trials_included = self.get_included_trials_lt5(data=self.bpod_trials)
+            trials_included = self.get_included_trials_lt5(data=self.trials_table)
         return trials_included
 
     @staticmethod
     def get_included_trials_lt5(data=False):
-        trials_included = np.array([True for t in data])
+        trials_included = np.ones(len(data), dtype=bool)
         return trials_included
 
     @staticmethod
     def get_included_trials_ge5(data=False, settings=False):
-        trials_included = np.array([True for t in data])
+        trials_included = np.ones(len(data), dtype=bool)
         if ('SUBJECT_DISENGAGED_TRIGGERED' in settings.keys() and settings[
                 'SUBJECT_DISENGAGED_TRIGGERED'] is not False):
             idx = settings['SUBJECT_DISENGAGED_TRIALNUM'] - 1
@@ -382,12 +353,9 @@ class ItiInTimes(BaseBpodTrialsExtractor):
 
     def _extract(self):
         if parse_version(self.settings["IBLRIG_VERSION_TAG"]) < parse_version("5.0.0"):
-            iti_in = np.ones(len(self.bpod_trials)) * np.nan
+            iti_in = np.ones(len(self.trials_table)) * np.nan
         else:
-            iti_in = np.array(
-                [tr["behavior_data"]["States timestamps"]
-                 ["exit_state"][0][0] for tr in self.bpod_trials]
-            )
+            iti_in = self.trials_table.state("exit_state")[:, 0].copy()
         return iti_in
 
 
@@ -395,14 +363,9 @@ class ErrorCueTriggerTimes(BaseBpodTrialsExtractor):
     var_names = 'errorCueTrigger_times'
 
     def _extract(self):
-        errorCueTrigger_times = np.zeros(len(self.bpod_trials)) * np.nan
-        for i, tr in enumerate(self.bpod_trials):
-            nogo = tr["behavior_data"]["States timestamps"]["no_go"][0][0]
-            error = tr["behavior_data"]["States timestamps"]["error"][0][0]
-            if np.all(~np.isnan(nogo)):
-                errorCueTrigger_times[i] = nogo
-            elif np.all(~np.isnan(error)):
-                errorCueTrigger_times[i] = error
+        nogo = self.trials_table.state("no_go")[:, 0]
+        error = self.trials_table.state("error")[:, 0]
+        errorCueTrigger_times = np.where(np.isnan(nogo), error, nogo)
         return errorCueTrigger_times
 
 
@@ -410,43 +373,17 @@ class StimFreezeTriggerTimes(BaseBpodTrialsExtractor):
     var_names = 'stimFreezeTrigger_times'
 
     def _extract(self):
+        table = self.trials_table
         if parse_version(self.settings["IBLRIG_VERSION_TAG"]) < parse_version("6.2.5"):
-            return np.ones(len(self.bpod_trials)) * np.nan
-        freeze_reward = np.array(
-            [
-                True
-                if np.all(~np.isnan(tr["behavior_data"]["States timestamps"]["freeze_reward"][0]))
-                else False
-                for tr in self.bpod_trials
-            ]
-        )
-        freeze_error = np.array(
-            [
-                True
-                if np.all(~np.isnan(tr["behavior_data"]["States timestamps"]["freeze_error"][0]))
-                else False
-                for tr in self.bpod_trials
-            ]
-        )
-        no_go = np.array(
-            [
-                True
-                if np.all(~np.isnan(tr["behavior_data"]["States timestamps"]["no_go"][0]))
-                else False
-                for tr in self.bpod_trials
-            ]
-        )
+            return np.ones(len(table)) * np.nan
+        freeze_reward = np.all(~np.isnan(table.state("freeze_reward")), axis=1)
+        freeze_error = np.all(~np.isnan(table.state("freeze_error")), axis=1)
+        no_go = np.all(~np.isnan(table.state("no_go")), axis=1)
         assert (np.sum(freeze_error) + np.sum(freeze_reward) +
-                np.sum(no_go) == len(self.bpod_trials))
-        stimFreezeTrigger = np.array([])
-        for r, e, n, tr in zip(freeze_reward, freeze_error, no_go, self.bpod_trials):
-            if n:
-                stimFreezeTrigger = np.append(stimFreezeTrigger, np.nan)
-                continue
-            state = "freeze_reward" if r else "freeze_error"
-            stimFreezeTrigger = np.append(
-                stimFreezeTrigger, tr["behavior_data"]["States timestamps"][state][0][0]
-            )
+                np.sum(no_go) == len(table))
+        stimFreezeTrigger = np.where(freeze_reward, table.state("freeze_reward")[:, 0],
+                                     table.state("freeze_error")[:, 0])
+        stimFreezeTrigger[no_go] = np.nan
         return stimFreezeTrigger
 
 
@@ -461,17 +398,12 @@ class StimOffTriggerTimes(BaseBpodTrialsExtractor):
         else:
             stim_off_trigger_state = "trial_start"
 
-        stimOffTrigger_times = np.array(
-            [tr["behavior_data"]["States timestamps"][stim_off_trigger_state][0][0]
-             for tr in self.bpod_trials]
-        )
+        stimOffTrigger_times = self.trials_table.state(stim_off_trigger_state)[:, 0].copy()
         # If pre version 5.0.0 no specific nogo Off trigger was given, just return trial_starts
         if stim_off_trigger_state == "trial_start":
             return stimOffTrigger_times
 
-        no_goTrigger_times = np.array(
-            [tr["behavior_data"]["States timestamps"]["no_go"][0][0] for tr in self.bpod_trials]
-        )
+        no_goTrigger_times = self.trials_table.state("no_go")[:, 0]
         # Stim off trigs are either in their own state or in the no_go state if the
         # mouse did not move, if the stim_off_trigger_state always exist
         # (exit_state or trial_start)
@@ -492,9 +424,8 @@ class StimOnTriggerTimes(BaseBpodTrialsExtractor):
 
     def _extract(self):
         # Get the stim_on_state that triggers the onset of the stim
-        stim_on_state = np.array([tr['behavior_data']['States timestamps']
-                                 ['stim_on'][0] for tr in self.bpod_trials])
-        return stim_on_state[:, 0].T
+        stim_on_state = self.trials_table.state('stim_on')
+        return stim_on_state[:, 0].copy()
 
 
 class StimOnTimes(BaseBpodTrialsExtractor):
@@ -511,9 +442,9 @@ class StimOnTimes(BaseBpodTrialsExtractor):
         """
         # Version check
         if version.ge(self.settings['IBLRIG_VERSION_TAG'], '5.0.0'):
-            stimOn_times = self.get_stimOn_times_ge5(self.session_path, data=self.bpod_trials)
+            stimOn_times = self.get_stimOn_times_ge5(self.session_path, data=self.trials_table)
         else:
-            stimOn_times = self.get_stimOn_times_lt5(self.session_path, data=self.bpod_trials)
+            stimOn_times = self.get_stimOn_times_lt5(self.session_path, data=self.trials_table)
         return np.array(stimOn_times)
 
     @staticmethod
@@ -528,23 +459,17 @@ class StimOnTimes(BaseBpodTrialsExtractor):
         Substitute that trial's missing or incorrect value with a NaN.
         return stimOn_times
         """
-        if not data:
-            data = raw.load_data(session_path)
+        table = _trials_table(session_path, data)
         # Get all stim_sync events detected
-        stim_sync_all = [raw.get_port_events(tr, 'BNC1') for tr in data]
-        stim_sync_all = [np.array(x) for x in stim_sync_all]
+        sync, offsets = table.port_events('BNC1')
+        itrial = np.repeat(np.arange(len(table)), np.diff(offsets))
         # Get the stim_on_state that triggers the onset of the stim
-        stim_on_state = np.array([tr['behavior_data']['States timestamps']
-                                 ['stim_on'][0] for tr in data])
-
-        stimOn_times = np.array([])
-        for sync, on, off in zip(
-                stim_sync_all, stim_on_state[:, 0], stim_on_state[:, 1]):
-            pulse = sync[np.where(np.bitwise_and((sync > on), (sync <= off)))]
-            if pulse.size == 0:
-                stimOn_times = np.append(stimOn_times, np.nan)
-            else:
-                stimOn_times = np.append(stimOn_times, pulse)
+        stim_on_state = table.state('stim_on')
+        # keep all the pulses within the stim_on state, NaN for the trials without pulse
+        ipulse = (sync > stim_on_state[itrial, 0]) & (sync <= stim_on_state[itrial, 1])
+        imissing = np.where(np.bincount(itrial[ipulse], minlength=len(table)) == 0)[0]
+        order = np.argsort(np.r_[itrial[ipulse], imissing], kind='stable')
+        stimOn_times = np.r_[sync[ipulse], np.zeros(imissing.size) * np.nan][order]
 
         nmissing = np.sum(np.isnan(stimOn_times))
         # Check if all stim_syncs have failed to be detected
@@ -566,37 +491,16 @@ class StimOnTimes(BaseBpodTrialsExtractor):
         Screen is not displaying anything until then.
         (Frame changes are in BNC1High and BNC1Low)
         """
-        if not data:
-            data = raw.load_data(session_path)
-        stim_on = []
-        bnc_h = []
-        bnc_l = []
-        for tr in data:
-            stim_on.append(tr['behavior_data']['States timestamps']['stim_on'][0][0])
-            if 'BNC1High' in tr['behavior_data']['Events timestamps'].keys():
-                bnc_h.append(np.array(tr['behavior_data']
-                                      ['Events timestamps']['BNC1High']))
-            else:
-                bnc_h.append(np.array([np.NINF]))
-            if 'BNC1Low' in tr['behavior_data']['Events timestamps'].keys():
-                bnc_l.append(np.array(tr['behavior_data']
-                                      ['Events timestamps']['BNC1Low']))
-            else:
-                bnc_l.append(np.array([np.NINF]))
-
-        stim_on = np.array(stim_on)
-        bnc_h = np.array(bnc_h)
-        bnc_l = np.array(bnc_l)
-
-        count_missing = 0
-        stimOn_times = np.zeros_like(stim_on)
-        for i in range(len(stim_on)):
-            hl = np.sort(np.concatenate([bnc_h[i], bnc_l[i]]))
-            stot = hl[hl > stim_on[i]]
-            if np.size(stot) == 0:
-                stot = np.array([np.nan])
-                count_missing += 1
-            stimOn_times[i] = stot[0]
+        table = _trials_table(session_path, data)
+        stim_on = table.state('stim_on')[:, 0]
+        hl, offsets = table.port_events('BNC1')
+        itrial = np.repeat(np.arange(len(table)), np.diff(offsets))
+        # first frame change after the stim_on state start
+        iafter = np.where(hl > stim_on[itrial])[0]
+        itrials, ifirst = np.unique(itrial[iafter], return_index=True)
+        stimOn_times = np.zeros_like(stim_on) * np.nan
+        stimOn_times[itrials] = hl[iafter[ifirst]]
+        count_missing = np.sum(np.isnan(stimOn_times))
 
         if np.all(np.isnan(stimOn_times)):
             _logger.error(f'{session_path}: Missing ALL BNC1 TTLs ({count_missing} trials)')
@@ -613,29 +517,22 @@ class StimOnOffFreezeTimes(BaseBpodTrialsExtractor):
     """
     save_names = ["_ibl_trials.stimOn_times.npy", None, None]
     var_names = ['stimOn_times', 'stimOff_times', 'stimFreeze_times']
-
-    def _extract(self):
-        choice = Choice(self.session_path).extract(
-            bpod_trials=self.bpod_trials, settings=self.settings, save=False
-        )[0]
-        f2TTL = [raw.get_port_events(tr, name="BNC1") for tr in self.bpod_trials]
-
-        stimOn_times = np.array([])
-        stimOff_times = np.array([])
-        stimFreeze_times = np.array([])
-        for tr in f2TTL:
-            if tr and len(tr) == 2:
-                stimOn_times = np.append(stimOn_times, tr[0])
-                stimOff_times = np.append(stimOff_times, tr[-1])
-                stimFreeze_times = np.append(stimFreeze_times, np.nan)
-            elif tr and len(tr) >= 3:
-                stimOn_times = np.append(stimOn_times, tr[0])
-                stimOff_times = np.append(stimOff_times, tr[-1])
-                stimFreeze_times = np.append(stimFreeze_times, tr[-2])
-            else:
-                stimOn_times = np.append(stimOn_times, np.nan)
-                stimOff_times = np.append(stimOff_times, np.nan)
-                stimFreeze_times = np.append(stimFreeze_times, np.nan)
+    input_names = ('choice',)
+
+    def _extract(self, choice=None):
+        if choice is None:
+            choice = Choice(self.session_path).extract(
+                trials_table=self.trials_table, settings=self.settings, save=False
+            )[0]
+        f2TTL, offsets = self.trials_table.port_events(name="BNC1")
+        # the first and last fronts are on and off, the penultimate front is the freeze if any
+        nttl = np.diff(offsets)
+        stimOn_times = raw.ragged_take(f2TTL, offsets, 0)
+        stimOff_times = raw.ragged_take(f2TTL, offsets, -1)
+        stimFreeze_times = raw.ragged_take(f2TTL, offsets, -2)
+        stimOn_times[nttl < 2] = np.nan
+        stimOff_times[nttl < 2] = np.nan
+        stimFreeze_times[nttl < 3] = np.nan
 
         # In no_go trials no stimFreeze happens jsut stim Off
         stimFreeze_times[choice == 0] = np.nan
@@ -659,39 +556,38 @@ class CameraTimestamps(BaseBpodTrialsExtractor):
     var_names = 'camera_timestamps'
 
     def _extract(self):
-        ntrials = len(self.bpod_trials)
-
-        cam_times = []
-        n_frames = 0
-        n_out_of_sync = 0
-        for ind in np.arange(ntrials):
-            # get upgoing and downgoing fronts
-            pin = np.array(self.bpod_trials[ind]['behavior_data']
-                           ['Events timestamps'].get('Port1In'))
-            pout = np.array(self.bpod_trials[ind]['behavior_data']
-                            ['Events timestamps'].get('Port1Out'))
-            # some trials at startup may not have the camera working, discard
-            if np.all(pin) is None:
-                continue
-            # if the trial starts in the middle of a square, discard the first downgoing front
-            if pout[0] < pin[0]:
-                pout = pout[1:]
-            # same if the last sample is during an upgoing front, always
-            # put size as it happens last
-            pin = pin[:pout.size]
-            frate = np.median(np.diff(pin))
-            if ind > 0:
-                """
-                assert that the pulses have the same length and that we don't miss frames during
-                the trial, the refresh rate of bpod is 100us
-                """
-                test1 = np.all(np.abs(1 - (pin - pout) / np.median(pin - pout)) < 0.1)
-                test2 = np.all(np.abs(np.diff(pin) - frate) <= 0.00011)
-                if not all([test1, test2]):
-                    n_out_of_sync += 1
-            # grow a list of cam times for ech trial
-            cam_times.append(pin)
-            n_frames += pin.size
+        table = self.trials_table
+        # get upgoing and downgoing fronts
+        no_event = (np.zeros(0), np.zeros(len(table) + 1, dtype=np.int64))
+        pins, in_offsets = table.events.get('Port1In', no_event)
+        pouts, out_offsets = table.events.get('Port1Out', no_event)
+        # some trials at startup may not have the camera working, discard
+        itrials = np.where(np.diff(in_offsets) > 0)[0]
+        in_first, out_first = (in_offsets[itrials], out_offsets[itrials])
+        # if the trial starts in the middle of a square, discard the first downgoing front
+        out_first = out_first + (pouts[np.minimum(out_first, pouts.size - 1)] < pins[in_first])
+        # same if the last sample is during an upgoing front, always
+        # put size as it happens last
+        nfronts = np.minimum(in_offsets[itrials + 1] - in_first,
+                             out_offsets[itrials + 1] - out_first)
+        igroup = np.repeat(np.arange(itrials.size), nfronts)
+        ifront = np.arange(igroup.size) - np.repeat(np.cumsum(nfronts) - nfronts, nfronts)
+        pin = pins[in_first[igroup] + ifront]
+        pout = pouts[out_first[igroup] + ifront]
+        cam_times = np.split(pin, np.cumsum(nfronts)[:-1]) if itrials.size else []
+        n_frames = pin.size
+        dpin, idpin = (np.diff(pin)[np.diff(igroup) == 0], igroup[1:][np.diff(igroup) == 0])
+        frates = _group_median(dpin, idpin, itrials.size)
+        """
+        assert that the pulses have the same length and that we don't miss frames during
+        the trial, the refresh rate of bpod is 100us
+        """
+        width = pin - pout
+        test1 = np.abs(1 - width / _group_median(width, igroup, itrials.size)[igroup]) < 0.1
+        test2 = np.abs(dpin - frates[idpin]) <= 0.00011
+        out_of_sync = (np.bincount(igroup[~test1], minlength=itrials.size) +
+                       np.bincount(idpin[~test2], minlength=itrials.size)) > 0
+        n_out_of_sync = np.sum(out_of_sync[itrials > 0])
 
         if n_out_of_sync > 0:
             _logger.warning(f"{n_out_of_sync} trials with bpod camera frame times not within"
@@ -699,7 +595,7 @@ class CameraTimestamps(BaseBpodTrialsExtractor):
 
         t_first_frame = np.array([c[0] for c in cam_times])
         t_last_frame = np.array([c[-1] for c in cam_times])
-        frate = 1 / np.nanmedian(np.array([np.median(np.diff(c)) for c in cam_times]))
+        frate = 1 / np.nanmedian(frates)
         intertrial_duration = t_first_frame[1:] - t_last_frame[:-1]
         intertrial_missed_frames = np.int32(np.round(intertrial_duration * frate)) - 1
 
@@ -742,29 +638,72 @@ class LaserBool(BaseBpodTrialsExtractor):
     var_names = 'laser_stimulation'
 
     def _extract(self):
-        laser = np.array([np.float(t.get('laser_stimulation', np.NaN)) for t in self.bpod_trials])
+        laser = self.trials_table.fields['laser_stimulation'].copy()
         if np.all(np.isnan(laser)):
             self.save_names = None  # this prevents the file from being saved
         return laser
 
 
-def extract_all(session_path, save=False, bpod_trials=None, settings=None):
-    if not bpod_trials:
-        bpod_trials = raw.load_data(session_path)
-    if not settings:
-        settings = raw.load_settings(session_path)
-    if settings is None or settings['IBLRIG_VERSION_TAG'] == '':
-        settings = {'IBLRIG_VERSION_TAG': '100.0.0'}
+def _group_median(values, groups, ngroups):
+    """
+    Median of the values for each group, equivalent to np.median on each group
+    :param values: array of values
+    :param groups: array of group indices (same size as values)
+    :param ngroups: number of groups
+    :return: array (ngroups,) of medians, NaN for empty groups
+    """
+    values = values[np.lexsort((values, groups))]
+    counts = np.bincount(groups, minlength=ngroups)
+    first = np.cumsum(counts) - counts
+    median = np.zeros(ngroups) * np.nan
+    sel = counts > 0
+    ilow, ihigh = (first + (counts - 1) // 2, first + counts // 2)
+    median[sel] = (values[ilow[sel]] + values[ihigh[sel]]) / 2
+    return median
+
+
+def _trials_table(session_path, data=False):
+    """
+    Columnar trials table from the bpod trials list if provided, or from the session
+    :param session_path: Absolute path of session folder
+    :param data: (optional) bpod trials list or raw_data_loaders.TrialsTable
+    :return: raw_data_loaders.TrialsTable
+    """
+    if isinstance(data, raw.TrialsTable):
+        return data
+    if not data:
+        return raw.load_trials_table(session_path)
+    return raw.TrialsTable.from_trials(data)
 
+
+def extractor_classes(settings):
+    """
+    Trials extractor classes for the iblrig version of the session
+    :param settings: bpod iblrig settings json file in a dictionary
+    :return: list of extractor classes
+    """
     base = [FeedbackType, ContrastLR, ProbabilityLeft, Choice, RepNum, RewardVolume, LaserBool,
             FeedbackTimes, Intervals, ResponseTimes, GoCueTriggerTimes, GoCueTimes]
     # Version check
-    if version.ge(settings['IBLRIG_VERSION_TAG'], '5.0.0'):
+    if version.ge(settings['IBLRIG_VERSION_TAG'] or '100.0.0', '5.0.0'):
         base.extend([StimOnTriggerTimes, CameraTimestamps, StimOnOffFreezeTimes, ItiInTimes,
                      StimOffTriggerTimes, StimFreezeTriggerTimes, ErrorCueTriggerTimes])
     else:
         base.extend([IncludedTrials, ItiDuration, StimOnTimes])
+    return base
+
+
+def extract_all(session_path, save=False, bpod_trials=None, settings=None,
+                trials_table=None):
+    # the trials table is built once and shared by all extractors
+    if trials_table is None:
+        trials_table = _trials_table(session_path, bpod_trials)
+    if not settings:
+        settings = raw.load_settings(session_path)
+    if settings is None or settings['IBLRIG_VERSION_TAG'] == '':
+        settings = {'IBLRIG_VERSION_TAG': '100.0.0'}
 
     out, fil = run_extractor_classes(
-        base, save=save, session_path=session_path, bpod_trials=bpod_trials, settings=settings)
+        extractor_classes(settings), save=save, session_path=session_path,
+        bpod_trials=bpod_trials or None, trials_table=trials_table, settings=settings)
     return out, fil
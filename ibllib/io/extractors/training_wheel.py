@@ -18,7 +18,9 @@ THRESHOLD_CONSECUTIVE_SAMPLES = 0
 EPS = 7. / 3 - 4. / 3 - 1
 
 
-def get_trial_start_times(session_path, data=None):
+def get_trial_start_times(session_path, data=None, trials_table=None):
+    if trials_table is not None:
+        return trials_table.state('trial_start')[:, 0]
     if not data:
         data = raw.load_data(session_path)
     trial_start_times = []
@@ -28,21 +30,24 @@ def get_trial_start_times(session_path, data=None):
     return np.array(trial_start_times)
 
 
-def sync_rotary_encoder(session_path, bpod_data=None, re_events=None):
-    if not bpod_data:
-        bpod_data = raw.load_data(session_path)
+def sync_rotary_encoder(session_path, bpod_data=None, re_events=None, trials_table=None):
     evt = re_events or raw.load_encoder_events(session_path)
     # we work with stim_on (2) and closed_loop (3) states for the synchronization with bpod
     tre = evt.re_ts.values / 1e6  # convert to seconds
     # the first trial on the rotary encoder is a dud
     rote = {'stim_on': tre[evt.sm_ev == 2][:-1],
             'closed_loop': tre[evt.sm_ev == 3][:-1]}
-    bpod = {
-        'stim_on': np.array([tr['behavior_data']['States timestamps']
-                             ['stim_on'][0][0] for tr in bpod_data]),
-        'closed_loop': np.array([tr['behavior_data']['States timestamps']
-                                 ['closed_loop'][0][0] for tr in bpod_data]),
-    }
+    if trials_table is not None:
+        bpod = {k: trials_table.state(k)[:, 0] for k in rote}
+    else:
+        if not bpod_data:
+            bpod_data = raw.load_data(session_path)
+        bpod = {
+            'stim_on': np.array([tr['behavior_data']['States timestamps']
+                                 ['stim_on'][0][0] for tr in bpod_data]),
+            'closed_loop': np.array([tr['behavior_data']['States timestamps']
+                                     ['closed_loop'][0][0] for tr in bpod_data]),
+        }
     if rote['closed_loop'].size <= 1:
         raise err.SyncBpodWheelException("Not enough Rotary Encoder events to perform wheel"
                                          " synchronization. Wheel data not extracted")
@@ -86,19 +91,22 @@ def sync_rotary_encoder(session_path, bpod_data=None, re_events=None):
     return interpolate.interp1d(re, bp, fill_value="extrapolate")
 
 
-def get_wheel_position(session_path, bp_data=None, display=False):
+def get_wheel_position(session_path, bp_data=None, display=False, trials_table=None):
     """
     Gets wheel timestamps and position from Bpod data. Position is in radian (constant above for
     radius is 1) mathematical convention.
     :param session_path:
-    :param bp_data (optional): bpod trials read from jsonable file
+    :param bp_data (optional): bpod trials read from jsonable file, loaded only if needed for
+     the state machine reset compensation
     :param display (optional): (bool)
+    :param trials_table (optional): raw_data_loaders.TrialsTable of the bpod trials
     :return: timestamps (np.array)
     :return: positions (np.array)
     """
     status = 0
-    if not bp_data:
-        bp_data = raw.load_data(session_path)
+    if trials_table is None:
+        trials_table = (raw.TrialsTable.from_trials(bp_data) if bp_data
+                        else raw.load_trials_table(session_path))
     df = raw.load_encoder_positions(session_path)
     if df is None:
         _logger.error('No wheel data for ' + str(session_path))
@@ -108,13 +116,13 @@ def get_wheel_position(session_path, bp_data=None, display=False):
     data['re_ts'] = df.re_ts.values
     data['re_pos'] = df.re_pos.values * -1  # anti-clockwise is positive in our output
     data['re_pos'] = data['re_pos'] / 1024 * 2 * np.pi  # convert positions to radians
-    trial_starts = get_trial_start_times(session_path)
+    trial_starts = get_trial_start_times(session_path, trials_table=trials_table)
     # need a flag if the data resolution is 1ms due to the old version of rotary encoder firmware
     if np.all(np.mod(data['re_ts'], 1e3) == 0):
         status = 1
     data['re_ts'] = data['re_ts'] / 1e6  # convert ts to seconds
     # # get the converter function to translate re_ts into behavior times
-    re2bpod = sync_rotary_encoder(session_path)
+    re2bpod = sync_rotary_encoder(session_path, trials_table=trials_table)
     data['re_ts'] = re2bpod(data['re_ts'])
 
     def get_reset_trace_compensation_with_state_machine_times():
@@ -161,6 +169,8 @@ def get_wheel_position(session_path, bp_data=None, display=False):
     # attempt to get the resets properly unless the unit is ms which means precision is
     # not good enough to match SM times to wheel samples time
     if not status:
+        # the resets need all the state occurrences, only available from the raw trials
+        bp_data = bp_data or raw.load_data(session_path, fields=['behavior_data'])
         tr_dc, status = get_reset_trace_compensation_with_state_machine_times()
 
     # if something was wrong or went wrong agnostic way of getting resets: just get zeros values
@@ -209,7 +219,7 @@ def get_wheel_position(session_path, bp_data=None, display=False):
         import matplotlib.pyplot as plt
         plt.figure()
         ax = plt.axes()
-        tstart = get_trial_start_times(session_path)
+        tstart = trial_starts
         tts = np.c_[tstart, tstart, tstart + np.nan].flatten()
         vts = np.c_[tstart * 0 + 100, tstart * 0 - 100, tstart + np.nan].flatten()
         ax.plot(tts, vts, label='Trial starts')
@@ -383,16 +393,21 @@ class Wheel(BaseBpodTrialsExtractor):
     var_names = ('wheel_timestamps', 'wheel_position', 'wheel_moves_intervals',
                  'wheel_moves_peak_amplitude', 'peakVelocity_times', 'firstMovement_times',
                  'is_final_movement')
+    input_names = ('goCue_times', 'feedback_times')
 
-    def _extract(self):
-        ts, pos = get_wheel_position(self.session_path, self.bpod_trials)
+    def _extract(self, goCue_times=None, feedback_times=None):
+        # the bpod trials are loaded by get_wheel_position only if the resets need them
+        ts, pos = get_wheel_position(self.session_path, self._bpod_trials,
+                                     trials_table=self.trials_table)
         moves = extract_wheel_moves(ts, pos)
 
         # need some trial based info to output the first movement times
-        goCue_times, _ = training_trials.GoCueTimes(self.session_path).extract(
-            save=False, bpod_trials=self.bpod_trials, settings=self.settings)
-        feedback_times, _ = training_trials.FeedbackTimes(self.session_path).extract(
-            save=False, bpod_trials=self.bpod_trials, settings=self.settings)
+        if goCue_times is None:
+            goCue_times, _ = training_trials.GoCueTimes(self.session_path).extract(
+                save=False, trials_table=self.trials_table, settings=self.settings)
+        if feedback_times is None:
+            feedback_times, _ = training_trials.FeedbackTimes(self.session_path).extract(
+                save=False, trials_table=self.trials_table, settings=self.settings)
         trials = {'goCue_times': goCue_times, 'feedback_times': feedback_times}
         min_qt = self.settings.get('QUIESCENT_PERIOD', None)
 
@@ -402,6 +417,7 @@ class Wheel(BaseBpodTrialsExtractor):
         return output
 
 
-def extract_all(session_path, bpod_trials=None, settings=None, save=False):
+def extract_all(session_path, bpod_trials=None, settings=None, save=False, trials_table=None):
     return run_extractor_classes(Wheel, save=save, session_path=session_path,
-                                 bpod_trials=bpod_trials, settings=settings)
+                                 bpod_trials=bpod_trials, trials_table=trials_table,
+                                 settings=settings)
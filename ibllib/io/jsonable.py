@@ -1,4 +1,15 @@
 import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+_logger = logging.getLogger('ibllib')
+
+INDEX_CHUNK_SIZE = 2 ** 24  # bytes read at once when indexing the lines of a file
+_DECODER = json.JSONDecoder()
+# scans the values skipped by the projected reads, the json objects are dropped, not built
+_SKIPPER = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
 
 
 def read(file):
@@ -9,6 +20,110 @@ def read(file):
     return data
 
 
+def _index_file(file):
+    file = Path(file)
+    return file.parent.joinpath(f".{file.name}.index.npy")
+
+
+def index(file, save=True):
+    """
+    Byte offsets of the lines of a jsonable file. The index is saved in a hidden file next to
+    the jsonable file and re-computed only if the jsonable file is modified.
+    :param file: jsonable file
+    :param save: (True) write the index file
+    :return: int64 array (nlines + 1,) of line offsets, the last one being the file size
+    """
+    file = Path(file)
+    stat = file.stat()
+    stamp = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    index_file = _index_file(file)
+    if index_file.exists():
+        try:
+            cached = np.load(index_file)
+            if np.array_equal(cached[:2], stamp):
+                return cached[2:]
+        except (OSError, ValueError):
+            _logger.warning(f"Could not read the jsonable index file {index_file}")
+    ends = []
+    with open(file, 'rb') as f:
+        pos = 0
+        while True:
+            chunk = f.read(INDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            ends.append(np.where(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))[0] + pos + 1)
+            pos += len(chunk)
+    ends = np.concatenate([np.zeros(0, dtype=np.int64)] + ends).astype(np.int64)
+    # the last line may not end with a new line character
+    if ends.size == 0 or ends[-1] != stat.st_size:
+        ends = np.r_[ends, stat.st_size] if stat.st_size else ends
+    offsets = np.r_[0, ends].astype(np.int64)
+    if save:
+        try:
+            np.save(index_file, np.r_[stamp, offsets])
+        except OSError:
+            _logger.warning(f"Could not write the jsonable index file {index_file}")
+    return offsets
+
+
+def _project(line, fields):
+    """
+    Decodes the top level values of a json object line until all the fields are found and
+    keeps only the fields. The other values are scanned by a decoder that drops the objects
+    instead of building the nested dictionaries
+    :param line: json object string
+    :param fields: set of top level keys
+    :return: dictionary of the fields found in the object
+    """
+    out = {}
+    i = _skip_whitespace(line, line.index('{') + 1)
+    while len(out) < len(fields) and line[i] != '}':
+        key, i = json.decoder.scanstring(line, i + 1)
+        i = _skip_whitespace(line, line.index(':', i) + 1)
+        if key in fields:
+            out[key], i = _DECODER.raw_decode(line, i)
+        else:
+            # the C scanner is faster than any python level scan to skip the unwanted values
+            _, i = _SKIPPER.raw_decode(line, i)
+        i = _skip_whitespace(line, i)
+        if line[i] == ',':
+            i = _skip_whitespace(line, i + 1)
+    return out
+
+
+def _skip_whitespace(line, i):
+    while line[i] in ' \t\r\n':
+        i += 1
+    return i
+
+
+def read_iter(file, fields=None, start=None, stop=None):
+    """
+    Iterates over the records of a jsonable file without loading the whole file. If start or
+    stop are provided, seeks directly to the first record using the line index (see index)
+
+    >>> positions = [tr['position'] for tr in jsonable.read_iter(file, fields=['position'])]
+
+    :param file: jsonable file
+    :param fields: (optional) list of top level keys to decode, the other keys are skipped
+    :param start: (optional) index of the first record, negative from the end of file
+    :param stop: (optional) index after the last record, negative from the end of file
+    :return: generator of dictionaries
+    """
+    fields = None if fields is None else set(fields)
+    with open(file, 'rb') as f:
+        if start is None and stop is None:
+            lines = f
+        else:
+            offsets = index(file)
+            start, stop, _ = slice(start, stop).indices(offsets.size - 1)
+            f.seek(offsets[start])
+            lines = (f.readline() for _ in range(start, stop))
+        for line in lines:
+            line = line.decode()
+            yield json.loads(line) if fields is None else _project(line, fields)
+
+
 def _write(file, data, mode):
     with open(file, mode) as f:
         for obj in data:
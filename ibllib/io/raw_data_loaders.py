@@ -7,9 +7,12 @@ Raw Data Loader functions for PyBpod rig
 
 Module contains one loader function per raw datafile
 """
+import functools
 import json
 import logging
+import warnings
 import wave
+import zipfile
 from datetime import datetime
 from pathlib import Path
 from typing import Union
@@ -22,6 +25,12 @@ from ibllib.misc import version
 
 _logger = logging.getLogger('ibllib')
 
+CACHE_RAW_DATA = True  # set to False to disable the caches written next to the raw data files
+TRIALS_TABLE_CACHE = '.taskData.table.npz'  # cache of the trials table next to the task data
+TRIALS_TABLE_VERSION = 1  # bump on changes of TrialsTable.FIELDS or parsing, voids the caches
+WHEEL_CACHE_SUFFIX = '.npz'  # cleaned wheel data cached in .{raw file name}.npz
+WHEEL_CACHE_VERSION = 1  # bump on changes of the wheel parsing or grooming, voids the caches
+
 
 def trial_times_to_times(raw_trial):
     """
@@ -74,7 +83,7 @@ def load_bpod(session_path):
     return load_settings(session_path), load_data(session_path)
 
 
-def load_data(session_path: Union[str, Path], time='absolute'):
+def load_data(session_path: Union[str, Path], time='absolute', fields=None):
     """
     Load PyBpod data files (.jsonable).
 
@@ -83,6 +92,8 @@ def load_data(session_path: Union[str, Path], time='absolute'):
 
     :param session_path: Absolute path of session folder
     :type session_path: str, Path
+    :param fields: (optional) list of the trial keys to decode, the others are skipped. Absolute
+     times require 'behavior_data'
     :return: A list of len ntrials each trial being a dictionary
     :rtype: list of dicts
     """
@@ -94,12 +105,206 @@ def load_data(session_path: Union[str, Path], time='absolute'):
     if not path:
         _logger.warning("No data loaded: could not find raw data file")
         return None
-    data = jsonable.read(path)
+    data = jsonable.read(path) if fields is None else list(jsonable.read_iter(path, fields))
     if time == 'absolute':
         data = [trial_times_to_times(t) for t in data]
     return data
 
 
+class TrialsTable:
+    """
+    Columnar table of the PyBpod trials data (absolute times) parsed once from the list of trials
+    dictionaries, so that the extractors work on arrays rather than on the nested dictionaries:
+        -   fields: one array per trial field (position, contrast, trial_correct...)
+        -   states: one array (ntrials, 2) per state, start and end of its first occurrence
+        -   events: ragged arrays per event, the timestamps of all trials concatenated and
+            the offsets of each trial (ntrials + 1)
+
+    >>> table = TrialsTable.from_trials(load_data(session_path))
+    >>> response_times = table.state('closed_loop')[:, 1]
+    >>> go_cue_times = table.event('BNC2High', 0)  # NaN for trials without BNC2High event
+    """
+    FIELDS = {
+        'trial_start': lambda t: t['behavior_data']['Trial start timestamp'],
+        'trial_end': lambda t: t['behavior_data']['Trial end timestamp'],
+        'position': lambda t: t.get('position', np.nan),
+        'trial_correct': lambda t: t.get('trial_correct', np.nan),
+        'contrast': lambda t: t['contrast']['value'] if isinstance(
+            t.get('contrast'), dict) else t.get('contrast', np.nan),
+        'contrast_type': lambda t: t['contrast'].get('type', '') if isinstance(
+            t.get('contrast'), dict) else '',
+        'stim_probability_left': lambda t: t.get('stim_probability_left', np.nan),
+        'reward_amount': lambda t: t.get('reward_amount', np.nan),
+        'laser_stimulation': lambda t: float(t.get('laser_stimulation', np.nan)),
+    }
+    # trial keys read by FIELDS and from_trials, the only ones decoded from the jsonable file
+    KEYS = ('behavior_data', 'position', 'trial_correct', 'contrast', 'stim_probability_left',
+            'reward_amount', 'laser_stimulation')
+
+    def __init__(self, fields, states, events):
+        """
+        :param fields: dictionary of arrays (ntrials,)
+        :param states: dictionary of arrays (ntrials, 2)
+        :param events: dictionary of tuples (timestamps, offsets)
+        """
+        self.fields = fields
+        self.states = states
+        self.events = events
+
+    def __len__(self):
+        return self.fields['trial_start'].size
+
+    @staticmethod
+    def from_trials(data):
+        """
+        :param data: list of trials dictionaries as output by load_data
+        :return: TrialsTable
+        """
+        fields = {k: np.array([fcn(t) for t in data]) for k, fcn in TrialsTable.FIELDS.items()}
+        states, events = ({}, {})
+        for i, t in enumerate(data):
+            for k, v in t['behavior_data']['States timestamps'].items():
+                if k not in states:
+                    states[k] = np.zeros((len(data), 2)) * np.nan
+                states[k][i, :] = v[0]
+            for k, v in t['behavior_data']['Events timestamps'].items():
+                events.setdefault(k, ([], np.zeros(len(data), dtype=np.int64)))
+                events[k][0].extend(v)
+                events[k][1][i] = len(v)
+        events = {k: (np.array(v, dtype=np.float64), np.r_[0, np.cumsum(n)])
+                  for k, (v, n) in events.items()}
+        return TrialsTable(fields, states, events)
+
+    @staticmethod
+    def load(file_npz):
+        """
+        :param file_npz: npz file written by TrialsTable.save
+        :return: TrialsTable
+        """
+        fields, states, events = ({}, {}, {})
+        with np.load(file_npz) as npz:
+            for k in npz.files:
+                if '/' not in k:
+                    continue
+                kind, name = k.split('/', 1)
+                if kind == 'fields':
+                    fields[name] = npz[k]
+                elif kind == 'states':
+                    states[name] = npz[k]
+                elif kind == 'events':
+                    events[name] = (npz[k], npz[f'offsets/{name}'])
+        return TrialsTable(fields, states, events)
+
+    def save(self, file_npz, **kwargs):
+        """
+        :param file_npz: output npz file
+        :param kwargs: additional arrays to save in the file
+        """
+        arrays = {f'fields/{k}': v for k, v in self.fields.items()}
+        arrays.update({f'states/{k}': v for k, v in self.states.items()})
+        arrays.update({f'events/{k}': v for k, (v, _) in self.events.items()})
+        arrays.update({f'offsets/{k}': o for k, (_, o) in self.events.items()})
+        np.savez(file_npz, **arrays, **kwargs)
+
+    def state(self, name):
+        """
+        :param name: state name
+        :return: array (ntrials, 2) of the start and end of the first occurrence of the state,
+         NaN for trials where the state was not visited
+        """
+        return self.states.get(name, np.zeros((len(self), 2)) * np.nan)
+
+    def port_events(self, name=''):
+        """
+        Ragged timestamps of the events whose name contains name, sorted within each trial
+        as for get_port_events
+        :param name: name of event, defaults to ''
+        :return: timestamps, offsets (ntrials + 1)
+        """
+        keys = [k for k in self.events if name in k]
+        if len(keys) == 1:
+            return self.events[keys[0]]
+        values = np.concatenate([np.zeros(0)] + [self.events[k][0] for k in keys])
+        itrial = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            np.repeat(np.arange(len(self)), np.diff(self.events[k][1])) for k in keys])
+        order = np.lexsort((values, itrial))
+        offsets = np.r_[0, np.cumsum(np.bincount(itrial, minlength=len(self)))]
+        return values[order], offsets
+
+    def event(self, name, take=0, port=False):
+        """
+        :param name: event name
+        :param take: index of the event within each trial, negative from the last event
+        :param port: (False) if True, uses all events whose name contains name (see port_events)
+        :return: array (ntrials,) of event times, NaN for trials without enough events
+        """
+        values, offsets = self.port_events(name) if port else self.events.get(
+            name, (np.zeros(0), np.zeros(len(self) + 1, dtype=np.int64)))
+        return ragged_take(values, offsets, take)
+
+    def count(self, name, port=False):
+        """
+        :param name: event name
+        :param port: (False) if True, counts all events whose name contains name
+        :return: array (ntrials,) of the number of events per trial
+        """
+        if port:
+            return np.diff(self.port_events(name)[1])
+        return np.diff(self.events[name][1]) if name in self.events else np.zeros(
+            len(self), dtype=np.int64)
+
+
+def ragged_take(values, offsets, take):
+    """
+    Takes one element per row of a ragged array
+    :param values: concatenated values of all rows
+    :param offsets: offsets of the rows in values (nrows + 1)
+    :param take: index of the element within each row, negative from the end of the row
+    :return: array (nrows,) of elements, NaN for rows without enough elements
+    """
+    counts = np.diff(offsets)
+    out = np.zeros(counts.size) * np.nan
+    sel = counts >= (take + 1 if take >= 0 else - take)
+    itake = offsets[:-1] + take if take >= 0 else offsets[1:] + take
+    out[sel] = values[itake[sel]]
+    return out
+
+
+def load_trials_table(session_path: Union[str, Path]):
+    """
+    Load the PyBpod data file (.jsonable) as a columnar TrialsTable.
+    The table is cached next to the data file and re-parsed only if the data file is modified,
+    unless CACHE_RAW_DATA is False.
+
+    :param session_path: Absolute path of session folder
+    :return: TrialsTable, None if the data file is not found
+    """
+    path = Path(session_path).joinpath("raw_behavior_data")
+    path = next(path.glob("_iblrig_taskData.raw*.jsonable"), None)
+    if not path:
+        _logger.warning("No data loaded: could not find raw data file")
+        return None
+    if not CACHE_RAW_DATA:
+        return TrialsTable.from_trials(load_data(session_path, fields=TrialsTable.KEYS))
+    stat = path.stat()
+    stamp = np.array([stat.st_mtime_ns, stat.st_size, TRIALS_TABLE_VERSION])
+    cache_file = path.parent.joinpath(TRIALS_TABLE_CACHE)
+    if cache_file.exists():
+        try:
+            with np.load(cache_file) as npz:
+                cached = np.array_equal(npz.get('source'), stamp)
+            if cached:
+                return TrialsTable.load(cache_file)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            _logger.warning(f"Could not read the trials table cache {cache_file}")
+    table = TrialsTable.from_trials(load_data(session_path, fields=TrialsTable.KEYS))
+    try:
+        table.save(cache_file, source=stamp)
+    except OSError:
+        _logger.warning(f"Could not write the trials table cache {cache_file}")
+    return table
+
+
 def load_settings(session_path: Union[str, Path]):
     """
     Load PyBpod Settings files (.json).
@@ -188,6 +393,98 @@ def _load_encoder_ssv_file(file_path, **kwargs):
     return pd.read_csv(file_path, sep=' ', header=None, error_bad_lines=False, **kwargs)
 
 
+def _parse_encoder_ssv_ge5(file_path, names):
+    """
+    Numeric parser for the iblrig >= 5 encoder files, where each line is 2 integers separated by
+    a single space, and optionally followed by a space.
+    :param file_path: encoder positions or events raw file
+    :param names: names of the 2 columns
+    :return: dictionary of int64 arrays, None if the file doesn't follow the format exactly
+    """
+    buf = np.fromfile(file_path, dtype=np.uint8)
+    inl = np.flatnonzero(buf == ord('\n'))
+    isp = np.flatnonzero(buf == ord(' '))
+    if inl.size == 0 or inl[-1] != buf.size - 1 or isp.size not in (inl.size, inl.size * 2):
+        return
+    # position of the first and last character of each line
+    first = np.r_[0, inl[:-1] + 1]
+    last = inl - 1 - (buf[inl - 1] == ord('\r'))
+    isp = isp.reshape(inl.size, -1)
+    if np.any(isp[:, 0] <= first) or np.any(isp[:, -1] > last):
+        return
+    # either a separator followed by a trailing space, or a single separator
+    if isp.shape[1] == 2 and (np.any(isp[:, 1] != last) or np.any(np.diff(isp, axis=1) == 1)):
+        return
+    if isp.shape[1] == 1 and np.any(isp[:, 0] == last):
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = np.fromstring(buf.tobytes(), dtype=np.int64, sep=' ')
+    if values.size != inl.size * 2:
+        return
+    return {names[0]: values[0::2], names[1]: values[1::2]}
+
+
+def _groom_wheel_data_ge5_fast(columns):
+    """
+    Equivalent of _groom_wheel_data_ge5 for clean data (see _parse_encoder_ssv_ge5)
+    :param columns: dictionary of 2 int64 arrays, the first one being the rotary encoder times
+    :return: dataframe, None if the data needs the full grooming (clock resets, swaps...)
+    """
+    (name_ts, re_ts), (name, values) = columns.items()
+    # drops the duplicate rows, keeping the first one
+    isort = np.lexsort((values, re_ts))
+    dup = np.r_[False, (np.diff(re_ts[isort]) == 0) & (np.diff(values[isort]) == 0)]
+    index = np.sort(isort[~dup])
+    re_ts = re_ts[index].astype(np.double)
+    if np.any(np.diff(re_ts) < 0):
+        return
+    if (re_ts[-1] - re_ts[0]) / 1e6 < 20:
+        _logger.warning('Rotary encoder reset logs events in ms instead of us: ' +
+                        'RE firmware needs upgrading and wheel velocity is potentially inaccurate')
+        re_ts = re_ts * 1000
+    return pd.DataFrame({'index': index, name_ts: re_ts, name: values[index]})
+
+
+def _wheel_file_cache(loader):
+    """
+    Decorator of the wheel raw file loaders, the cleaned dataframe is cached next to the raw file
+    in a hidden npz file, and re-computed only if the raw file is modified, unless
+    CACHE_RAW_DATA is False.
+    """
+    @functools.wraps(loader)
+    def cached_loader(file_path):
+        file_path = Path(file_path)
+        if not CACHE_RAW_DATA:
+            return loader(file_path)
+        stat = file_path.stat()
+        stamp = np.array([stat.st_mtime_ns, stat.st_size, WHEEL_CACHE_VERSION])
+        cache_file = file_path.parent.joinpath(f".{file_path.name}{WHEEL_CACHE_SUFFIX}")
+        if cache_file.exists():
+            try:
+                with np.load(cache_file) as npz:
+                    if np.array_equal(npz['source'], stamp) and npz['loader'] == loader.__name__:
+                        index = npz['index']
+                        if index.size and np.all(np.diff(index) == 1):
+                            index = pd.RangeIndex(index[0], index[0] + index.size)
+                        return pd.DataFrame({c: npz[f'columns/{c}'] for c in npz['columns']},
+                                            index=index)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                _logger.warning(f"Could not read the wheel cache {cache_file}")
+        data = loader(file_path)
+        # strings are saved as unicode arrays so that the cache loads without pickle
+        arrays = {f'columns/{c}': data[c].values.astype(str) if data[c].dtype == object
+                  else data[c].values for c in data.columns}
+        try:
+            np.savez(cache_file, source=stamp, loader=loader.__name__, index=data.index.values,
+                     columns=np.array(data.columns, dtype=str), **arrays)
+        except OSError:
+            _logger.warning(f"Could not write the wheel cache {cache_file}")
+        return data
+    return cached_loader
+
+
+@_wheel_file_cache
 def _load_encoder_positions_file_lt5(file_path):
     """
     File loader without the session overhead
@@ -200,18 +497,24 @@ def _load_encoder_positions_file_lt5(file_path):
     return _groom_wheel_data_lt5(data, label='_iblrig_encoderPositions.raw.ssv', path=file_path)
 
 
+@_wheel_file_cache
 def _load_encoder_positions_file_ge5(file_path):
     """
     File loader without the session overhead
     :param file_path:
     :return: dataframe of encoder events
     """
+    columns = _parse_encoder_ssv_ge5(file_path, names=['re_ts', 're_pos'])
+    data = None if columns is None else _groom_wheel_data_ge5_fast(columns)
+    if data is not None:
+        return data
     data = _load_encoder_ssv_file(file_path,
                                   names=['re_ts', 're_pos', '_'],
                                   usecols=['re_ts', 're_pos'])
     return _groom_wheel_data_ge5(data, label='_iblrig_encoderPositions.raw.ssv', path=file_path)
 
 
+@_wheel_file_cache
 def _load_encoder_events_file_lt5(file_path):
     """
     File loader without the session overhead
@@ -224,12 +527,17 @@ def _load_encoder_events_file_lt5(file_path):
     return _groom_wheel_data_lt5(data, label='_iblrig_encoderEvents.raw.ssv', path=file_path)
 
 
+@_wheel_file_cache
 def _load_encoder_events_file_ge5(file_path):
     """
     File loader without the session overhead
     :param file_path:
     :return: dataframe of encoder events
     """
+    columns = _parse_encoder_ssv_ge5(file_path, names=['re_ts', 'sm_ev'])
+    data = None if columns is None else _groom_wheel_data_ge5_fast(columns)
+    if data is not None:
+        return data
     data = _load_encoder_ssv_file(file_path,
                                   names=['re_ts', 'sm_ev', '_'],
                                   usecols=['re_ts', 'sm_ev'])
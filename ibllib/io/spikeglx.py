@@ -1,27 +1,95 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import hashlib
 import json
 import logging
+import multiprocessing
+import os
 from pathlib import Path
+import queue
 import re
+import tempfile
+import threading
+import urllib.parse
+import zlib
 
 import numpy as np
+import requests
 
 import mtscomp
 from brainbox.core import Bunch
+from ibllib.dsp.utils import WindowGenerator
 from ibllib.ephys import neuropixel as neuropixel
 from ibllib.io import hashfile
 
 SAMPLE_SIZE = 2  # int16
 DEFAULT_BATCH_SIZE = 1e6
+MTSCOMP_CACHE_BYTES = 2 ** 28  # max memory used to keep decompressed chunks, ~11 AP chunks
+CHANNELS_BLOCK_BYTES = 2 ** 26  # size of the contiguous blocks read to extract a few channels
+REMOTE_CACHE_BYTES = 2 ** 32  # disk space used to keep compressed chunks of remote files
 _logger = logging.getLogger('ibllib')
 
 
+class ChunkCache:
+    """
+    Least recently used cache of decompressed mtscomp chunks, keyed by chunk index and bounded
+    by the total size of the chunks in memory. Hits and misses are counted for profiling.
+    The cached arrays are read-only as they may be shared by several reads.
+    """
+    def __init__(self, max_bytes=MTSCOMP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def get(self, chunk_idx, read_chunk):
+        """
+        Returns the chunk from the cache, or decompress it using read_chunk() on a miss
+        :param chunk_idx: index of the chunk in the compressed file
+        :param read_chunk: function without argument returning the decompressed chunk
+        :return: numpy array (ns_chunk, nc)
+        """
+        with self._lock:
+            if chunk_idx in self._chunks:
+                self.hits += 1
+                self._chunks.move_to_end(chunk_idx)
+                return self._chunks[chunk_idx]
+            self.misses += 1
+        chunk = read_chunk()
+        chunk.flags.writeable = False
+        with self._lock:
+            if chunk_idx not in self._chunks:
+                self._chunks[chunk_idx] = chunk
+                self.nbytes += chunk.nbytes
+            # evict the least recently used chunks, always keeping the current one
+            while self.nbytes > self.max_bytes and len(self._chunks) > 1:
+                _, old = self._chunks.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return chunk
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+
+
 class Reader:
     """
     Class for SpikeGLX reading purposes
     Some format description was found looking at the Matlab SDK here
     https://github.com/billkarsh/SpikeGLX/blob/master/MATLAB-SDK/DemoReadSGLXData.m
     """
-    def __init__(self, sglx_file):
+    def __init__(self, sglx_file, cache_bytes=MTSCOMP_CACHE_BYTES):
+        """
+        :param sglx_file: path to the binary file (.bin or .cbin)
+        :param cache_bytes: for compressed files only, memory used to cache decompressed chunks
+        """
         self.file_bin = Path(sglx_file)
         self.nbytes = self.file_bin.stat().st_size
         file_meta_data = Path(sglx_file).with_suffix('.meta')
@@ -39,6 +107,9 @@ class Reader:
         if self.is_mtscomp:
             self._raw = mtscomp.Reader()
             self._raw.open(self.file_bin, self.file_bin.with_suffix('.ch'))
+            # replace the mtscomp cache (fixed number of chunks) by a memory bounded LRU cache
+            self.chunk_cache = ChunkCache(max_bytes=cache_bytes)
+            self._raw.read_chunk = self._read_chunk_cached
         else:
             if self.nc * self.ns * 2 != self.nbytes:
                 ftsec = self.file_bin.stat().st_size / 2 / self.nc / self.fs
@@ -51,6 +122,11 @@ class Reader:
                 self.meta['fileTimeSecs'] = ftsec
             self._raw = np.memmap(sglx_file, dtype='int16', mode='r', shape=(self.ns, self.nc))
 
+    def _read_chunk_cached(self, chunk_idx, chunk_start, chunk_length):
+        read_chunk = partial(type(self._raw).read_chunk, self._raw, chunk_idx, chunk_start,
+                             chunk_length)
+        return self.chunk_cache.get(chunk_idx, read_chunk)
+
     def __getitem__(self, item):
         if isinstance(item, int) or isinstance(item, slice):
             return self.read(nsel=item, sync=False)
@@ -100,15 +176,36 @@ class Reader:
             return
         return int(np.round(self.meta.get('fileTimeSecs') * self.fs))
 
-    def read(self, nsel=slice(0, 10000), csel=slice(None), sync=True):
+    def read(self, nsel=slice(0, 10000), csel=slice(None), sync=True, out=None, scale=True,
+             dtype=np.float32):
         """
         Read from slices or indexes
-        :param slice_n: slice or sample indices
-        :param slice_c: slice or channel indices
+        >>> data = sr.read(slice(0, 3000), sync=False)  # float32 array in Volts
+        >>> sr.read(slice(0, 3000), sync=False, out=buffer)  # writes in a pre-allocated array
+        >>> raw = sr.read(slice(0, 3000), sync=False, scale=False, dtype=np.int16)  # no copy
+
+        :param nsel: slice or sample indices
+        :param csel: slice or channel indices
+        :param sync: (True) if True, returns the sync traces as well
+        :param out: (None) pre-allocated float32 array with the shape of the selection. The
+         samples are converted to Volts directly into it, avoiding allocations within loops
+        :param scale: (True) if False, the samples are not converted to Volts
+        :param dtype: (np.float32) output type when scale=False. With np.int16 the raw samples are
+         returned without copy: a read-only view of the memmap for binary files read by slices
         :return: float32 array
         """
-        darray = np.float32(self._raw[nsel, csel])
-        darray *= self.channel_conversion_sample2v[self.type][csel]
+        raw = self._raw[nsel, csel]
+        if out is not None:
+            if scale:
+                np.multiply(raw, self.channel_conversion_sample2v[self.type][csel], out=out)
+            else:
+                np.copyto(out, raw)
+            darray = out
+        elif not scale:
+            darray = raw if raw.dtype == np.dtype(dtype) else raw.astype(dtype)
+        else:
+            darray = np.float32(raw)
+            darray *= self.channel_conversion_sample2v[self.type][csel]
         if sync:
             return darray, self.read_sync(nsel)
         else:
@@ -129,6 +226,104 @@ class Reader:
             channels = slice(None)
         return self.read(slice(first_sample, last_sample), channels)
 
+    def iter_chunks(self, nswin, overlap=0, channels=None, sync=False, nbuffers=2,
+                    first_window=0):
+        """
+        Generator that reads the whole file by windows, following dsp.WindowGenerator semantics.
+        The next window is read on a background thread while the current one is being processed.
+        >>> for first, last, data in sr.iter_chunks(nswin=30000, overlap=0):
+        ...     rms = np.sqrt(np.mean(data ** 2, axis=0))
+
+        NB: the data arrays yielded are views on a ring of pre-allocated buffers that get
+        overwritten by subsequent reads. Copy them if they need to outlive the iteration step.
+
+        :param nswin: number of samples of each window
+        :param overlap: number of samples overlapping between consecutive windows
+        :param channels: slice or numpy array of channel indices (defaults to all channels)
+        :param sync: (False) if True, also yields the sync array for each window
+        :param nbuffers: (2) number of buffers in the ring, bounds the memory usage
+        :param first_window: (0) index of the first window read, ie. to resume a previous pass
+        :return: generator of tuples (first, last, data) or (first, last, data, sync) where
+         data is a float32 array (last - first, nc) in Volts
+        """
+        wg = WindowGenerator(ns=self.ns, nswin=nswin, overlap=overlap)
+        channels = slice(None) if channels is None else channels
+        nc = np.arange(self.nc)[channels].size
+        free, ready = queue.Queue(), queue.Queue()
+        for _ in range(max(nbuffers, 2)):
+            free.put(np.zeros((wg.nswin, nc), dtype=np.float32))
+        stop = threading.Event()
+
+        def _prefetch():
+            try:
+                for first, last in wg.firstlast:
+                    if wg.iw < first_window:
+                        continue
+                    buffer = free.get()
+                    if stop.is_set():
+                        return
+                    data = self.read(slice(first, last), channels, sync=False,
+                                     out=buffer[:last - first])
+                    _sync = self.read_sync(slice(first, last)) if sync else None
+                    ready.put((buffer, (first, last, data, _sync)))
+            except Exception as e:
+                ready.put((None, e))
+            else:
+                ready.put((None, None))
+
+        thread = threading.Thread(target=_prefetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                buffer, item = ready.get()
+                if isinstance(item, Exception):
+                    raise item
+                elif item is None:
+                    break
+                yield item if sync else item[:3]
+                free.put(buffer)
+        finally:
+            # unblocks the reading thread if the generator is closed before the end of the file
+            stop.set()
+            free.put(None)
+            thread.join()
+
+    def read_channels(self, nsel, channels):
+        """
+        Reads the raw int16 samples of a few channels only, typically the sync traces.
+        For flat binary files, large contiguous blocks of samples are read and the requested
+        channels copied out of each block, rather than a strided access to the memmap.
+        For compressed files, only the chunks overlapping the selection are decompressed.
+        >>> sync_int16 = sr.read_channels(slice(0, 10000), [384])
+        :param nsel: slice of samples
+        :param channels: list of channel indices
+        :return: int16 array (ns, len(channels))
+        """
+        if not isinstance(nsel, slice) or nsel.step not in (None, 1):
+            return self._raw[nsel, channels]
+        first, last, _ = nsel.indices(self._raw.shape[0])
+        out = np.zeros((max(last - first, 0), len(channels)), dtype=np.int16)
+        if first >= last:
+            return out
+        if self.is_mtscomp:
+            first_chunk, last_chunk = self._raw._chunks_for_interval(first, last)
+            for ichunk, start, length in self._raw.iter_chunks(first_chunk, last_chunk):
+                c0, c1 = self._raw.chunk_bounds[ichunk:ichunk + 2]
+                i0, i1 = (max(first, c0), min(last, c1))
+                chunk = self._raw.read_chunk(ichunk, start, length)
+                out[i0 - first:i1 - first] = chunk[i0 - c0:i1 - c0, channels]
+            return out
+        nblock = max(int(CHANNELS_BLOCK_BYTES / self.nc / SAMPLE_SIZE), 1)
+        buffer = np.empty((min(nblock, last - first), self.nc), dtype=np.int16)
+        with open(self.file_bin, 'rb') as fid:
+            for i0 in range(first, last, nblock):
+                i1 = min(i0 + nblock, last)
+                block = buffer[:i1 - i0]
+                fid.seek(i0 * self.nc * SAMPLE_SIZE)
+                fid.readinto(block)
+                out[i0 - first:i1 - first] = block[:, channels]
+        return out
+
     def read_sync_digital(self, _slice=slice(0, 10000)):
         """
         Reads only the digital sync trace at specified samples using slicing syntax
@@ -136,7 +331,7 @@ class Reader:
         """
         if not self.meta:
             _logger.warning('Sync trace not labeled in metadata. Assuming last trace')
-        return split_sync(self._raw[_slice, _get_sync_trace_indices_from_meta(self.meta)])
+        return split_sync(self.read_channels(_slice, _get_sync_trace_indices_from_meta(self.meta)))
 
     def read_sync_analog(self, _slice=slice(0, 10000)):
         """
@@ -149,7 +344,9 @@ class Reader:
         if not csel:
             return
         else:
-            return self.read(nsel=_slice, csel=csel, sync=False)
+            analog = np.float32(self.read_channels(_slice, csel))
+            analog *= self.channel_conversion_sample2v[self.type][csel]
+            return analog
 
     def read_sync(self, _slice=slice(0, 10000), threshold=1.2, floor_percentile=10):
         """
@@ -170,23 +367,21 @@ class Reader:
         analog[np.where(analog >= threshold)] = 1
         return np.concatenate((digital, np.int8(analog)), axis=1)
 
-    def compress_file(self, keep_original=True, **kwargs):
+    def compress_file(self, keep_original=True, n_workers=None, **kwargs):
         """
-        Compresses
+        Compresses the file. The md5 and sha1 hashes of the uncompressed and compressed data
+        are computed while compressing and stored in the .ch metadata file
         :param keep_original: defaults True. If False, the original uncompressed file is deleted
          and the current spikeglx.Reader object is modified in place
+        :param n_workers: (None) if > 1, chunks are compressed in a pool of n_workers processes.
+         The output files are identical to the single process compression.
         :param kwargs:
         :return: pathlib.Path of the compressed *.cbin file
         """
         file_tmp = self.file_bin.with_suffix('.cbin_tmp')
         assert not self.is_mtscomp
-        mtscomp.compress(self.file_bin,
-                         out=file_tmp,
-                         outmeta=self.file_bin.with_suffix('.ch'),
-                         sample_rate=self.fs,
-                         n_channels=self.nc,
-                         dtype=np.int16,
-                         **kwargs)
+        _compress(self.file_bin, out=file_tmp, outmeta=self.file_bin.with_suffix('.ch'),
+                  sample_rate=self.fs, n_channels=self.nc, n_workers=n_workers, **kwargs)
         file_out = file_tmp.with_suffix('.cbin')
         file_tmp.rename(file_out)
         if not keep_original:
@@ -194,18 +389,23 @@ class Reader:
             self.file_bin = file_out
         return file_out
 
-    def decompress_file(self, keep_original=True, **kwargs):
+    def decompress_file(self, keep_original=True, n_workers=None, **kwargs):
         """
         Decompresses a mtscomp file
         :param keep_original: defaults True. If False, the original compressed file (input)
         is deleted and the current spikeglx.Reader object is modified in place
         NB: This is not equivalent to overwrite (which replaces the output file)
+        :param n_workers: (None) if > 1, chunks are decompressed in a pool of n_workers processes
         :return: pathlib.Path of the decompressed *.bin file
         """
         if 'out' not in kwargs:
             kwargs['out'] = self.file_bin.with_suffix('.bin')
         assert self.is_mtscomp
-        mtscomp.decompress(self.file_bin, self.file_bin.with_suffix('.ch'), **kwargs)
+        if n_workers and n_workers > 1:
+            _decompress_pool(self.file_bin, self.file_bin.with_suffix('.ch'),
+                             n_workers=n_workers, **kwargs)
+        else:
+            mtscomp.decompress(self.file_bin, self.file_bin.with_suffix('.ch'), **kwargs)
         if not keep_original:
             self.file_bin.unlink()
             self.file_bin.with_suffix('.ch').unlink()
@@ -215,27 +415,392 @@ class Reader:
     def verify_hash(self):
         """
         Computes SHA-1 hash and returns True if it matches metadata, False otherwise
+        For compressed files, the compressed file is hashed against the hash computed during
+        compression and, if available, the SHA-1 of the uncompressed data computed during
+        compression is compared to the acquisition metadata.
         :return: boolean
         """
-        if self.is_mtscomp:
-            with open(self.file_bin.with_suffix('.ch')) as fid:
-                mtscomp_params = json.load(fid)
-            sm = mtscomp_params.get('sha1_compressed', None)
-            if sm is None:
-                _logger.warning("SHA1 hash is not implemented for compressed ephys. To check "
-                                "the spikeglx acquisition hash, uncompress the file first !")
-                return True
-            sm = sm.upper()
+        if not self.is_mtscomp:
+            return _compare_hashes(self.meta.fileSHA1, hashfile.sha1(self.file_bin).upper())
+        with open(self.file_bin.with_suffix('.ch')) as fid:
+            mtscomp_params = json.load(fid)
+        sc = mtscomp_params.get('sha1_uncompressed', None)
+        ok = True
+        if sc and self.meta.get('fileSHA1'):
+            ok = _compare_hashes(self.meta.fileSHA1, sc.upper())
+        if mtscomp_params.get('sha1_compressed', None):
+            sm, hash_fcn = (mtscomp_params['sha1_compressed'], hashfile.sha1)
+        elif mtscomp_params.get('md5_compressed', None):
+            sm, hash_fcn = (mtscomp_params['md5_compressed'], hashfile.md5)
         else:
-            sm = self.meta.fileSHA1
-        sc = hashfile.sha1(self.file_bin).upper()
-        if sm == sc:
-            log_func = _logger.info
+            _logger.warning("SHA1 hash is not implemented for compressed ephys. To check "
+                            "the spikeglx acquisition hash, uncompress the file first !")
+            return ok
+        return _compare_hashes(sm.upper(), hash_fcn(self.file_bin).upper()) and ok
+
+
+class RemoteReader(Reader):
+    """
+    Random access to a compressed spikeglx file served over HTTP, with the same reading API
+    as the Reader. Only the compressed chunks needed by a read are downloaded, using HTTP range
+    requests, and consecutive missing chunks are fetched in a single request.
+    The .ch and .meta files and the compressed chunks are kept in a bounded on-disk cache
+    >>> sr = RemoteReader(url_cbin, url_ch=url_ch, url_meta=url_meta, auth=(login, password))
+    >>> data = sr[3000000:3030000, :-1]
+    """
+    def __init__(self, url_cbin, url_ch=None, url_meta=None, cache_dir=None, auth=None,
+                 cache_bytes=MTSCOMP_CACHE_BYTES, disk_cache_bytes=REMOTE_CACHE_BYTES):
+        """
+        :param url_cbin: url of the compressed binary file (.cbin)
+        :param url_ch: url of the mtscomp metadata file, defaults to the .cbin url with .ch suffix
+        :param url_meta: url of the spikeglx metadata file, defaults to the .cbin url with
+         .meta suffix
+        :param cache_dir: root of the on-disk cache, defaults to the system temporary directory
+        :param auth: (None) authentication for the http server, ie. (login, password)
+        :param cache_bytes: memory used to cache decompressed chunks
+        :param disk_cache_bytes: disk space used to cache compressed chunks
+        """
+        self.url_cbin = url_cbin
+        self.session = requests.Session()
+        self.session.auth = auth
+        cache_dir = Path(cache_dir or Path(tempfile.gettempdir()).joinpath('spikeglx_remote'))
+        cache_dir = cache_dir.joinpath(hashlib.md5(url_cbin.encode()).hexdigest())
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # the binary file is never written locally, its path only carries the file name
+        self.file_bin = cache_dir.joinpath(Path(urllib.parse.urlparse(url_cbin).path).name)
+        self.file_meta_data = self._download(url_meta or _url_with_suffix(url_cbin, '.meta'),
+                                             self.file_bin.with_suffix('.meta'))
+        file_ch = self._download(url_ch or _url_with_suffix(url_cbin, '.ch'),
+                                 self.file_bin.with_suffix('.ch'))
+        self.meta = read_meta_data(self.file_meta_data)
+        self.channel_conversion_sample2v = _conversion_sample2v_from_meta(self.meta)
+        self._raw = _RemoteMtscompReader()
+        self._raw.open(url_cbin, file_ch, self.session,
+                       _ChunkFileCache(cache_dir.joinpath('chunks'), max_bytes=disk_cache_bytes))
+        self.nbytes = self._raw.chunk_offsets[-1]
+        self.chunk_cache = ChunkCache(max_bytes=cache_bytes)
+        self._raw.read_chunk = self._read_chunk_cached
+
+    def _download(self, url, file_out):
+        if file_out.exists():
+            return file_out
+        response = self.session.get(url)
+        response.raise_for_status()
+        file_out.with_suffix('.part').write_bytes(response.content)
+        file_out.with_suffix('.part').replace(file_out)
+        return file_out
+
+
+def _url_with_suffix(url, suffix):
+    parsed = urllib.parse.urlparse(url)
+    return parsed._replace(path=str(Path(parsed.path).with_suffix(suffix))).geturl()
+
+
+class _ChunkFileCache:
+    """
+    Least recently used cache of compressed chunks on disk, one file per chunk, bounded by the
+    total size of the files. The usage order persists between sessions through file times
+    """
+    def __init__(self, cache_dir, max_bytes=REMOTE_CACHE_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()
+        for f in sorted(self.cache_dir.glob('*.zlib'), key=lambda f: f.stat().st_mtime):
+            self._files[int(f.stem)] = f.stat().st_size
+        self.nbytes = sum(self._files.values())
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, chunk_idx):
+        return chunk_idx in self._files
+
+    def _path(self, chunk_idx):
+        return self.cache_dir.joinpath(f'{chunk_idx:06d}.zlib')
+
+    def get(self, chunk_idx):
+        """
+        :param chunk_idx: index of the chunk in the compressed file
+        :return: compressed bytes, None if the chunk is not in the cache
+        """
+        with self._lock:
+            if chunk_idx not in self._files:
+                return
+            self._files.move_to_end(chunk_idx)
+        try:
+            cbuffer = self._path(chunk_idx).read_bytes()
+            os.utime(self._path(chunk_idx))
+        except FileNotFoundError:  # evicted by another thread meanwhile
+            return
+        return cbuffer
+
+    def put(self, chunk_idx, cbuffer):
+        file_chunk = self._path(chunk_idx)
+        file_chunk.with_suffix('.part').write_bytes(cbuffer)
+        file_chunk.with_suffix('.part').replace(file_chunk)
+        with self._lock:
+            if chunk_idx not in self._files:
+                self._files[chunk_idx] = len(cbuffer)
+                self.nbytes += len(cbuffer)
+            # evict the least recently used chunks, always keeping the current one
+            while self.nbytes > self.max_bytes and len(self._files) > 1:
+                old_idx, old_bytes = self._files.popitem(last=False)
+                self._path(old_idx).unlink(missing_ok=True)
+                self.nbytes -= old_bytes
+
+
+class _RemoteMtscompReader(mtscomp.Reader):
+    """
+    mtscomp reader fetching the compressed chunks over HTTP instead of reading a local file
+    """
+    def open(self, url, cmeta, session, file_cache):
+        super(_RemoteMtscompReader, self).open(None, cmeta=cmeta)
+        self.url = url
+        self.session = session
+        self.file_cache = file_cache
+        self.n_requests = 0
+        self._fetch_lock = threading.Lock()
+
+    def _chunks_for_interval(self, i0, i1):
+        # all the chunks needed by a slice are downloaded at once before being read one by one
+        first_chunk, last_chunk = super(_RemoteMtscompReader, self)._chunks_for_interval(i0, i1)
+        self.fetch_chunks(first_chunk, last_chunk)
+        return first_chunk, last_chunk
+
+    def fetch_chunks(self, first_chunk, last_chunk):
+        """
+        Downloads the chunks of the interval missing from the disk cache, one range request per
+        run of consecutive missing chunks
+        """
+        with self._fetch_lock:
+            missing = [i for i in range(first_chunk, last_chunk + 1) if i not in self.file_cache]
+            # split the missing chunks into runs of consecutive indices
+            for run in np.split(missing, np.where(np.diff(missing) != 1)[0] + 1):
+                if run.size == 0:
+                    continue
+                for chunk_idx, cbuffer in self._request(run[0], run[-1]):
+                    self.file_cache.put(chunk_idx, cbuffer)
+
+    def _request(self, first_chunk, last_chunk):
+        """
+        Streams a range of compressed chunks from the server
+        :return: generator of (chunk_idx, compressed bytes)
+        """
+        first_byte = self.chunk_offsets[first_chunk]
+        last_byte = self.chunk_offsets[last_chunk + 1]
+        self.n_requests += 1
+        with self.session.get(self.url, stream=True,
+                              headers={'Range': f'bytes={first_byte}-{last_byte - 1}'}) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise IOError(f"{self.url}: the server doesn't support range requests")
+            chunk_idx = int(first_chunk)
+            buffer = bytearray()
+            for block in resp.iter_content(chunk_size=2 ** 20):
+                buffer += block
+                while chunk_idx <= last_chunk:
+                    length = self.chunk_offsets[chunk_idx + 1] - self.chunk_offsets[chunk_idx]
+                    if len(buffer) < length:
+                        break
+                    yield chunk_idx, bytes(buffer[:length])
+                    del buffer[:length]
+                    chunk_idx += 1
+        if chunk_idx <= last_chunk:
+            raise IOError(f"{self.url}: incomplete download of chunks {first_chunk}-{last_chunk}")
+
+    def read_chunk(self, chunk_idx, chunk_start, chunk_length):
+        cbuffer = self.file_cache.get(chunk_idx)
+        if cbuffer is None:
+            for _, cbuffer in self._request(chunk_idx, chunk_idx):
+                self.file_cache.put(chunk_idx, cbuffer)
+        assert len(cbuffer) == chunk_length
+        try:
+            buffer = zlib.decompress(cbuffer)
+        except Exception:
+            raise IOError("Compressed chunk #%d is corrupted." % chunk_idx)
+        # same as mtscomp.Reader.read_chunk once the compressed chunk is in memory
+        i0, i1 = self.chunk_bounds[chunk_idx:chunk_idx + 2]
+        chunk = np.frombuffer(buffer, self.dtype).reshape(
+            (i1 - i0, self.n_channels), order=self.chunk_order)
+        chunk = mtscomp.cumsum_along_axis(chunk, axis=1 if self.cmeta.do_spatial_diff else None)
+        chunk = mtscomp.cumsum_along_axis(chunk, axis=0 if self.cmeta.do_time_diff else None)
+        return np.ascontiguousarray(chunk)
+
+
+def _compare_hashes(sm, sc):
+    if sm == sc:
+        log_func = _logger.info
+    else:
+        log_func = _logger.error
+    log_func(f"SHA1 metadata: {sm}")
+    log_func(f"SHA1 computed: {sc}")
+    return sm == sc
+
+
+def get_mtscomp_hash(file_cbin, hash_key='md5_compressed'):
+    """
+    Returns a hash computed during compression and stored in the mtscomp .ch metadata file.
+    :param file_cbin: path to the compressed *.cbin file
+    :param hash_key: 'md5_compressed', 'md5_uncompressed', 'sha1_compressed', 'sha1_uncompressed'
+    :return: hexdigest string, None if not available or if the file size doesn't match
+    """
+    file_cbin = Path(file_cbin)
+    file_ch = file_cbin.with_suffix('.ch')
+    if file_cbin.suffix != '.cbin' or not file_ch.exists():
+        return
+    with open(file_ch) as fid:
+        cmeta = json.load(fid)
+    if cmeta.get('chunk_offsets', [None])[-1] != file_cbin.stat().st_size:
+        return
+    return cmeta.get(hash_key)
+
+
+# state of the compression worker processes: the mtscomp objects are opened once per process
+_pool_state = {}
+
+
+def _pool_initializer(**kwargs):
+    _pool_state.clear()
+    _pool_state.update(kwargs)
+
+
+def _pool_writer():
+    if 'writer' not in _pool_state:
+        w = mtscomp.Writer(quiet=True, **{**_pool_state['config'], 'n_threads': 1})
+        w.open(_pool_state['file_bin'], sample_rate=_pool_state['sample_rate'],
+               n_channels=_pool_state['n_channels'], dtype=np.int16)
+        _pool_state['writer'] = w
+    return _pool_state['writer']
+
+
+def _pool_reader():
+    if 'reader' not in _pool_state:
+        r = mtscomp.Reader(quiet=True, **{**_pool_state['config'], 'cache_size': 1})
+        r.open(_pool_state['file_cbin'], _pool_state['file_ch'])
+        _pool_state['reader'] = r
+    return _pool_state['reader']
+
+
+def _pool_compress_chunk(chunk_idx):
+    """Compresses one chunk with the mtscomp code, returns only the compressed bytes"""
+    return chunk_idx, _pool_writer()._compress_chunk(chunk_idx)[1][1]
+
+
+def _pool_decompress_chunk(chunk_idx):
+    return _pool_reader()._decompress_chunk(chunk_idx)
+
+
+def _pool_check_chunk(chunk_idx):
+    """Checks that a decompressed chunk matches exactly the original data"""
+    r = _pool_reader()
+    if 'data' not in _pool_state:
+        _pool_state['data'] = np.memmap(_pool_state['file_bin'], dtype=np.int16, mode='r')\
+            .reshape(-1, r.n_channels)
+    i0, i1 = r.chunk_bounds[chunk_idx:chunk_idx + 2]
+    return np.array_equal(r._decompress_chunk(chunk_idx)[1], _pool_state['data'][i0:i1])
+
+
+def _pool_check(executor, n_chunks):
+    if not all(executor.map(_pool_check_chunk, range(n_chunks))):
+        raise RuntimeError("CRITICAL ERROR: mtscomp automatic integrity check failed")
+
+
+def _pool_executor(n_workers, **kwargs):
+    # spawn rather than fork as the pools may be started from several threads
+    return ProcessPoolExecutor(max_workers=n_workers,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=partial(_pool_initializer, **kwargs))
+
+
+class _Writer(mtscomp.Writer):
+    """
+    mtscomp Writer that computes the md5 hashes of the uncompressed and compressed data while
+    streaming, on top of the mtscomp sha1 hashes, and writes them in the .ch metadata file.
+    If an executor is set, the batches of chunks are compressed in a process pool.
+    """
+    executor = None
+
+    def open(self, *args, **kwargs):
+        super().open(*args, **kwargs)
+        self.md5_compressed = hashlib.md5()
+        self.md5_uncompressed = hashlib.md5()
+
+    def compress_batch(self, first_chunk, last_chunk):
+        if self.executor is None:
+            chunks = super().compress_batch(first_chunk, last_chunk)
         else:
-            log_func = _logger.error
-        log_func(f"SHA1 metadata: {sm}")
-        log_func(f"SHA1 computed: {sc}")
-        return sm == sc
+            chunks = self.executor.map(_pool_compress_chunk, range(first_chunk, last_chunk))
+            chunks = {i: (self.get_chunk(i), cchunk) for i, cchunk in chunks}
+        # batches are compressed in order, so are the chunks within the batch
+        for chunk_idx in sorted(chunks.keys()):
+            uncompressed_chunk, compressed_chunk = chunks[chunk_idx]
+            self.md5_uncompressed.update(uncompressed_chunk)
+            self.md5_compressed.update(compressed_chunk)
+        return chunks
+
+    def get_cmeta(self):
+        cmeta = super().get_cmeta()
+        cmeta['md5_compressed'] = self.md5_compressed.hexdigest()
+        cmeta['md5_uncompressed'] = self.md5_uncompressed.hexdigest()
+        return cmeta
+
+
+class _PoolReader(mtscomp.Reader):
+    """
+    mtscomp Reader that decompresses the batches of chunks in a process pool
+    """
+    executor = None
+
+    def decompress_chunks(self, chunk_ids, pool=None):
+        if self.executor is None:
+            return super().decompress_chunks(chunk_ids, pool=pool)
+        return dict(self.executor.map(_pool_decompress_chunk, chunk_ids))
+
+
+def _compress(file_bin, out, outmeta, sample_rate, n_channels, n_workers=None, **kwargs):
+    """
+    Compresses a raw int16 file, computing the hashes of input and output in the same pass.
+    If n_workers > 1, the chunks are compressed in a pool of processes. The compression itself
+    is done by the mtscomp code so that the output is byte-identical in both cases.
+    """
+    if not (n_workers and n_workers > 1):
+        # mtscomp defaults to one thread per cpu, a single worker compresses on a single thread
+        w = _Writer(**{**kwargs, 'n_threads': n_workers} if n_workers else kwargs)
+        w.open(file_bin, sample_rate=sample_rate, n_channels=n_channels, dtype=np.int16)
+        w.write(out, outmeta)
+        w.close()
+        return
+    w = _Writer(**{**kwargs, 'n_threads': n_workers})
+    check = w.check_after_compress
+    w.check_after_compress = False
+    w.open(file_bin, sample_rate=sample_rate, n_channels=n_channels, dtype=np.int16)
+    with _pool_executor(n_workers, file_bin=file_bin, file_cbin=out, file_ch=outmeta,
+                        sample_rate=sample_rate, n_channels=n_channels,
+                        config=kwargs) as executor:
+        w.executor = executor
+        w.write(out, outmeta)
+        w.close()
+        if check:
+            _pool_check(executor, w.n_chunks)
+
+
+def _decompress_pool(cdata, cmeta, out, n_workers, overwrite=False, **kwargs):
+    """
+    Decompresses a mtscomp file in a pool of processes
+    """
+    r = _PoolReader(**{**kwargs, 'n_threads': n_workers})
+    check = r.check_after_decompress
+    r.check_after_decompress = False
+    r.open(cdata, cmeta)
+    with _pool_executor(n_workers, file_bin=out, file_cbin=cdata, file_ch=cmeta,
+                        config=kwargs) as executor:
+        r.executor = executor
+        r.tofile(out, overwrite=overwrite)
+        if check:
+            _pool_check(executor, r.n_chunks)
+    r.close()
 
 
 def read(sglx_file, first_sample=0, last_sample=10000):
@@ -1 +1,2 @@
-from .misc import (pprint, structarr, logger_config, print_progress)
+from .misc import (pprint, structarr, logger_config, print_progress, spawn_pool,
+                   run_with_log_prefix)
@@ -1,10 +1,15 @@
 # library of small functions
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import json
 import logging
+import logging.handlers
+import multiprocessing
 
 import numpy as np
 
 _logger = logging.getLogger('ibllib')
+_worker_log_handler = None  # handler forwarding the logs of a spawn_pool worker to the parent
 
 
 def pprint(my_dict):
@@ -74,3 +79,71 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1, length=10
     # Print New Line on Complete
     if iteration == total:
         print()
+
+
+@contextmanager
+def spawn_pool(n_workers, logger_name='ibllib'):
+    """
+    Process pool using the spawn start method, safe to use from threads. The records of the
+    logger in the worker processes are forwarded to the parent process where they are handled
+    by the logger as if emitted in the parent. See run_with_log_prefix to label the records.
+    >>> with spawn_pool(4) as executor:
+    >>>     results = list(executor.map(fcn, files))
+    :param n_workers: number of worker processes
+    :param logger_name: ('ibllib') name of the logger to forward
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    listener = logging.handlers.QueueListener(queue, _ParentLogHandler())
+    listener.start()
+    level = logging.getLogger(logger_name).getEffectiveLevel()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                 initializer=_forward_logs, initargs=(queue, logger_name, level)
+                                 ) as executor:
+            yield executor
+    finally:
+        listener.stop()
+
+
+def run_with_log_prefix(prefix, fcn, *args, **kwargs):
+    """
+    Runs a function in a spawn_pool worker, prefixing the messages it logs, ie. with a probe label
+    >>> executor.submit(run_with_log_prefix, 'probe00', fcn, bin_file)
+    """
+    prefix_filter = _PrefixFilter(prefix)
+    if _worker_log_handler is not None:
+        _worker_log_handler.addFilter(prefix_filter)
+    try:
+        return fcn(*args, **kwargs)
+    finally:
+        if _worker_log_handler is not None:
+            _worker_log_handler.removeFilter(prefix_filter)
+
+
+class _PrefixFilter(logging.Filter):
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def filter(self, record):
+        record.msg = f'{self.prefix}: {record.getMessage()}'
+        record.args = ()
+        return True
+
+
+class _ParentLogHandler(logging.Handler):
+    """Handles the records forwarded from the worker processes with the logger of the record"""
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _forward_logs(queue, logger_name, level):
+    """Initializer of the spawn_pool worker processes"""
+    global _worker_log_handler
+    _worker_log_handler = logging.handlers.QueueHandler(queue)
+    log = logging.getLogger(logger_name)
+    log.handlers = [_worker_log_handler]
+    log.setLevel(level)
+    log.propagate = False
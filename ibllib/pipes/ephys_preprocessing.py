@@ -1,8 +1,10 @@
 import logging
+import os
 import re
 import shutil
 import subprocess
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 from pathlib import Path
 
@@ -50,13 +52,14 @@ class RawEphysQC(tasks.Task):
     Computes raw electrophysiology QC
     """
 
-    cpu = 2
+    cpu = 4  # one process per ap / lf file
     io_charge = 30  # this jobs reads raw ap files
     priority = 10  # a lot of jobs depend on this one
     level = 0  # this job doesn't depend on anything
 
     def _run(self, overwrite=False):
-        qc_files = ephysqc.raw_qc_session(self.session_path, overwrite=overwrite)
+        qc_files = ephysqc.raw_qc_session(self.session_path, overwrite=overwrite,
+                                          n_workers=self.cpu)
         return qc_files
 
 
@@ -355,21 +358,44 @@ class EphysCellsQc(tasks.Task):
         return out_files
 
 
+def _split_cores(sizes, n_cores):
+    """
+    Splits a budget of cores between concurrent jobs proportionally to their size, each job
+    getting at least one core. The number of cores sums to at most n_cores provided there are
+    no more jobs than cores: otherwise at most n_cores jobs should run at once.
+    :param sizes: list of job sizes (ie. bytes to compress)
+    :param n_cores: number of cores available
+    :return: list of number of cores per job
+    """
+    sizes = np.array(sizes, dtype=float)
+    n_extra = max(n_cores - sizes.size, 0)
+    # the cores beyond the first one of each job are attributed by largest remainder
+    shares = n_extra * sizes / sizes.sum() if sizes.sum() else np.zeros_like(sizes)
+    extra = np.floor(shares).astype(int)
+    iremainder = np.argsort(extra - shares, kind='stable')[:n_extra - extra.sum()]
+    extra[iremainder] += 1
+    return list(1 + extra)
+
+
 class EphysMtscomp(tasks.Task):
     priority = 50  # ideally after spike sorting
     level = 0
 
-    def _run(self):
+    def _run(self, n_cores=None):
         """
         Compress ephys files looking for `compress_ephys.flag` whithin the probes folder
         Original bin file will be removed
         The registration flag created contains targeted file names at the root of the session
+        The files are compressed concurrently, the cores budget being split between files
+        proportionally to their size
+        :param n_cores: (None) number of cores available for compression, defaults to all
         """
         out_files = []
         ephys_files = spikeglx.glob_ephys_files(self.session_path)
         ephys_files += spikeglx.glob_ephys_files(self.session_path, ext="ch")
         ephys_files += spikeglx.glob_ephys_files(self.session_path, ext="meta")
 
+        to_compress = {}  # index in the output list: spikeglx reader
         for ef in ephys_files:
             for typ in ["ap", "lf", "nidq"]:
                 bin_file = ef.get(typ)
@@ -380,12 +406,22 @@ class EphysMtscomp(tasks.Task):
                     if sr.is_mtscomp:
                         out_files.append(bin_file)
                     else:
-                        _logger.info(f"Compressing binary file {bin_file}")
-                        out_files.append(sr.compress_file(keep_original=False))
-                        out_files.append(bin_file.with_suffix('.ch'))
+                        to_compress[len(out_files)] = sr
+                        out_files.extend([None, bin_file.with_suffix('.ch')])
                 else:
                     out_files.append(bin_file)
 
+        if to_compress:
+            n_cores = n_cores or os.cpu_count()
+            cores = _split_cores([sr.nbytes for sr in to_compress.values()], n_cores)
+            with ThreadPoolExecutor(max_workers=min(len(to_compress), n_cores)) as executor:
+                futures = {}
+                for (i, sr), n_workers in zip(to_compress.items(), cores):
+                    _logger.info(f"Compressing binary file {sr.file_bin} on {n_workers} cores")
+                    futures[i] = executor.submit(sr.compress_file, keep_original=False,
+                                                 n_workers=n_workers)
+                for i, future in futures.items():
+                    out_files[i] = future.result()
         return out_files
 
 
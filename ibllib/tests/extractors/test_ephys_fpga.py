@@ -3,6 +3,8 @@ import tempfile
 from pathlib import Path
 import pickle
 import logging
+import sys
+from unittest.mock import patch
 
 import numpy as np
 
@@ -73,6 +75,150 @@ class TestSyncExtraction(unittest.TestCase):
                 self.assertEqual(len(log.output), 1)
                 self.assertIn('SGLX sync found', log.output[0])
 
+    def test_fronts_buffer(self):
+        fronts = ephys_fpga._FrontsBuffer(capacity=4)
+        samples = np.arange(0, 30, 3) + 2 ** 40
+        for i in range(0, 10, 3):
+            fronts.append(samples[i:i + 3], np.arange(10)[i:i + 3], (-1) ** np.arange(10)[i:i + 3])
+        self.assertEqual(fronts.data.size, 10)
+        self.assertEqual(fronts.data.itemsize, 10)
+        np.testing.assert_array_equal(fronts.data['sample'], samples)
+        np.testing.assert_array_equal(fronts.data['channel'], np.arange(10))
+        np.testing.assert_array_equal(fronts.data['polarity'], (-1) ** np.arange(10))
+
+    def test_sync_multiple_files(self):
+        # a 3B session with a nidq and 2 probes extracted concurrently and sequentially
+        with tempfile.TemporaryDirectory() as tdir:
+            raw_path = Path(tdir).joinpath('raw_ephys_data')
+            files = {'': ('sample3B_g0_t0.nidq.meta', 2, 8)}
+            files.update({f'probe0{i}': ('sample3B_g0_t0.imec1.ap.meta', 385, 16)
+                          for i in range(2)})
+            for label, (fn, nc, sync_depth) in files.items():
+                raw_path.joinpath(label).mkdir(parents=True, exist_ok=True)
+                # the probe01 meta data doesn't match the file size and issues a warning
+                spikeglx._mock_spikeglx_file(raw_path.joinpath(label, fn).with_suffix('.bin'),
+                                             self.workdir / fn, ns=32, nc=nc,
+                                             sync_depth=sync_depth, corrupt=label == 'probe01')
+            with self.assertLogs('ibllib', level='INFO') as log:
+                syncs, out_files = ephys_fpga.extract_sync(tdir, n_workers=3)
+            # the logs of the worker processes reach the parent logger, labelled per probe
+            warnings = [r.getMessage() for r in log.records if r.levelno == logging.WARNING]
+            self.assertTrue(any(w.startswith('probe01: ') and 'do not checkout' in w
+                                for w in warnings))
+            self.assertIn('INFO:ibllib:probe00: Extracting sync for probe probe00: '
+                          f'{raw_path.joinpath("probe00", "sample3B_g0_t0.imec1.ap.bin")}',
+                          log.output)
+            self.assertEqual(len(syncs), 3)
+            self.assertEqual(len(out_files), 9)
+            syncs_, out_files_ = ephys_fpga.extract_sync(tdir, overwrite=True, n_workers=1)
+            self.assertEqual(out_files, out_files_)
+            for sync, sync_ in zip(syncs, syncs_):
+                for k in sync:
+                    np.testing.assert_array_equal(sync[k], sync_[k])
+
+
+class TestSyncIndex(unittest.TestCase):
+
+    def test_sync_index(self):
+        rng = np.random.default_rng(1)
+        n = 1000
+        sync = {'times': np.sort(rng.uniform(0, 100, n)),
+                'channels': rng.integers(0, 8, n).astype(float) * 2,
+                'polarities': rng.choice([-1., 1.], n)}
+        sidx = ephys_fpga.SyncIndex(sync)
+        self.assertEqual(set(sidx.keys()), set(sync.keys()))
+        self.assertTrue(sidx.times is sync['times'])
+        for ch in [0, 1, 6, 14, 20]:
+            for tmin, tmax in [(None, None), (20.5, None), (None, 60.3), (10, 15), (80, 20)]:
+                expected = ephys_fpga._get_sync_fronts(sync, ch, tmin=tmin, tmax=tmax)
+                fronts = ephys_fpga._get_sync_fronts(sidx, ch, tmin=tmin, tmax=tmax)
+                np.testing.assert_array_equal(fronts.times, expected.times)
+                np.testing.assert_array_equal(fronts.polarities, expected.polarities)
+        # the time bounds are inclusive
+        t = sidx.fronts(2).times
+        np.testing.assert_array_equal(sidx.fronts(2, tmin=t[3], tmax=t[7]).times, t[3:8])
+
+
+def _stage_fcn(x, calls):
+    calls.append(x)
+    return {'x': x * 2, 'empty': None, 'nested': {'sum': np.sum(x), 'scalar': 3.5}}
+
+
+class TestStageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ephys_fpga.StageCache(Path(self.tmp.name).joinpath('.fpga_stages'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_run(self):
+        calls = []
+        x = np.arange(5)
+        out = self.cache.run('wheel', _stage_fcn, [x], x, calls)
+        cached = self.cache.run('wheel', _stage_fcn, [x], x, calls)
+        self.assertEqual(len(calls), 1)
+        np.testing.assert_array_equal(cached['x'], out['x'])
+        self.assertIsNone(cached['empty'])
+        self.assertEqual(cached.nested['sum'], 10)
+        self.assertEqual(cached.nested['scalar'], 3.5)
+        # the stage is re-computed if its dependencies change
+        self.cache.run('wheel', _stage_fcn, [x + 1], x + 1, calls)
+        self.assertEqual(len(calls), 2)
+        # a file dependency is hashed by content
+        file_dep = Path(self.tmp.name).joinpath('settings.json')
+        file_dep.write_text('{"a": 1}')
+        self.cache.run('wheel', _stage_fcn, [file_dep], x, calls)
+        self.cache.run('wheel', _stage_fcn, [file_dep], x, calls)
+        self.assertEqual(len(calls), 3)
+        file_dep.write_text('{"a": 2}')
+        self.cache.run('wheel', _stage_fcn, [file_dep], x, calls)
+        self.assertEqual(len(calls), 4)
+        # a corrupt checkpoint is re-computed
+        self.cache.cache_dir.joinpath('wheel.npz').write_bytes(b'corrupt')
+        self.cache.run('wheel', _stage_fcn, [file_dep], x, calls)
+        self.assertEqual(len(calls), 5)
+        # without cache folder the stage is always computed
+        ephys_fpga.StageCache().run('wheel', _stage_fcn, [x], x, calls)
+        self.assertEqual(len(calls), 6)
+
+    def test_run_callees(self):
+        calls = []
+        x = np.arange(5)
+        # a module called by the stage, its source is part of the key
+        sys.path.insert(0, self.tmp.name)
+        self.addCleanup(sys.path.remove, self.tmp.name)
+        file_module = Path(self.tmp.name).joinpath('_stage_callee.py')
+        file_module.write_text('THRESHOLD = 1\n')
+        with patch.dict(ephys_fpga.FPGA_STAGES_MODULES, {'wheel': ['_stage_callee']}):
+            self.cache.run('wheel', _stage_fcn, [x], x, calls)
+            self.cache.run('wheel', _stage_fcn, [x], x, calls)
+            self.assertEqual(len(calls), 1)
+            # a fix in the callee invalidates the stage
+            file_module.write_text('THRESHOLD = 2\n')
+            self.cache.run('wheel', _stage_fcn, [x], x, calls)
+            self.assertEqual(len(calls), 2)
+            # so does a new ibllib version
+            with patch('ibllib.misc.version.ibllib', return_value='100.0.0'):
+                self.cache.run('wheel', _stage_fcn, [x], x, calls)
+            self.assertEqual(len(calls), 3)
+
+    def test_bpod_stage_depends(self):
+        raw_path = Path(self.tmp.name).joinpath('session', 'raw_behavior_data')
+        raw_path.mkdir(parents=True)
+        file_data = raw_path.joinpath('_iblrig_taskData.raw.jsonable')
+        file_settings = raw_path.joinpath('_iblrig_taskSettings.raw.json')
+        file_data.write_text('{"trial_num": 1}\n')
+        file_settings.write_text('{"IBLRIG_VERSION_TAG": "6.4.0"}')
+        raw_path.joinpath('_iblrig_encoderEvents.raw.ssv').write_text('1 2 \n')
+        depends = ephys_fpga._bpod_stage_depends(raw_path.parent)
+        self.assertEqual([d[0] for d in depends], [file_data.name, file_settings.name])
+        # appending a trial to the task data changes the key of the stage
+        with open(file_data, 'a') as fid:
+            fid.write('{"trial_num": 2}\n')
+        self.assertNotEqual(ephys_fpga._bpod_stage_depends(raw_path.parent), depends)
+
 
 class TestIblChannelMaps(unittest.TestCase):
 
@@ -6,6 +6,15 @@ import ibllib.io.extractors.ephys_fpga as ephys_fpga
 import ibllib.io.raw_data_loaders as raw
 
 
+def setUpModule():
+    # the tests don't write caches in the fixtures folders
+    raw.CACHE_RAW_DATA = False
+
+
+def tearDownModule():
+    raw.CACHE_RAW_DATA = True
+
+
 class TestEphysSyncExtraction(unittest.TestCase):
 
     def test_bpod_trace_extraction(self):
@@ -89,6 +98,12 @@ class TestEphysSyncExtraction(unittest.TestCase):
         t_event_nans = ephys_fpga._assign_events_to_trial(t_trial_start, t_event, take=1)
         desired_out = np.array([4, 13, np.nan, 33, np.nan])
         self.assertTrue(np.allclose(desired_out, t_event_nans, equal_nan=True, atol=0, rtol=0))
+        t_event_nans = ephys_fpga._assign_events_to_trial(t_trial_start, t_event, take=-4)
+        desired_out = np.array([np.nan, np.nan, np.nan, 32, np.nan])
+        self.assertTrue(np.allclose(desired_out, t_event_nans, equal_nan=True, atol=0, rtol=0))
+        # no events in trials
+        t_event_nans = ephys_fpga._assign_events_to_trial(t_trial_start, np.array([]), take=1)
+        self.assertTrue(np.all(np.isnan(t_event_nans)))
 
     def test_wheel_trace_from_sync(self):
         pos_ = - np.array([-1, 0, -1, -2, -1, -2]) * (np.pi / ephys_fpga.WHEEL_TICKS)
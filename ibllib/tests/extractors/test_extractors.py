@@ -2,15 +2,28 @@ import functools
 import logging
 import shutil
 import tempfile
+import time
 import unittest
 from pathlib import Path
+from unittest.mock import patch
 
 import alf.io
 import numpy as np
 import pandas as pd
+from scipy import signal
 from ibllib.io import extractors
+from ibllib.io.extractors import training_audio
 from ibllib.io import raw_data_loaders as raw
-from ibllib.io.extractors.base import BaseExtractor
+from ibllib.io.extractors.base import BaseExtractor, run_extractor_classes
+
+
+def setUpModule():
+    # the tests don't write caches in the fixtures folders, the cache tests use temporary copies
+    raw.CACHE_RAW_DATA = False
+
+
+def tearDownModule():
+    raw.CACHE_RAW_DATA = True
 
 
 def wheelMoves_fixture(func):
@@ -494,6 +507,24 @@ class TestExtractTrialData(unittest.TestCase):
         out, files = extractors.biased_trials.extract_all(
             self.biased_ge5['path'], save=True)
 
+    def test_extract_all_wheel_inputs(self):
+        from ibllib.io.extractors import bpod_trials, training_wheel
+        # the wheel and trials extractors run together: the go cue and feedback times are
+        # extracted once and passed to the wheel extractor
+        go_cue = extractors.training_trials.GoCueTimes._extract
+        wheel = training_wheel.Wheel._extract
+        with patch.object(extractors.training_trials.GoCueTimes, '_extract', autospec=True,
+                          side_effect=go_cue) as go_cue_extract, \
+                patch.object(training_wheel.Wheel, '_extract', autospec=True,
+                             side_effect=wheel) as wheel_extract:
+            trials, wheel, files = bpod_trials.extract_all(self.biased_ge5['path'], save=False)
+        go_cue_extract.assert_called_once()
+        np.testing.assert_array_equal(wheel_extract.call_args.kwargs['goCue_times'],
+                                      trials['goCue_times'])
+        self.assertEqual(set(wheel), set(training_wheel.Wheel.var_names))
+        self.assertFalse(set(trials).intersection(wheel))
+        self.assertIsNone(files)
+
     def test_encoder_positions_clock_reset(self):
         # TRAINING SESSIONS
         # only for training?
@@ -637,6 +668,157 @@ class TestWheelLoaders(unittest.TestCase):
             dy = raw._load_encoder_positions_file_lt5(file_position)
             self.assertTrue(dy.size > 18)
 
+    @patch.object(raw, 'CACHE_RAW_DATA', True)
+    def test_encoder_cache(self):
+        with tempfile.TemporaryDirectory() as td:
+            for version, loader in [('ge5', raw._load_encoder_positions_file_ge5),
+                                    ('lt5', raw._load_encoder_positions_file_lt5)]:
+                file_raw = next(self.main_path.joinpath('data', 'wheel', version).rglob(
+                    '_iblrig_encoderPositions.raw.*'))
+                file_raw = Path(shutil.copy(file_raw, td))
+                file_cache = file_raw.parent.joinpath(f'.{file_raw.name}.npz')
+                dy = loader(file_raw)
+                self.assertTrue(file_cache.exists())
+                pd.testing.assert_frame_equal(dy, loader(file_raw))
+                # modifying the raw file invalidates the cache
+                with open(file_raw) as fid:
+                    lines = fid.readlines()
+                with open(file_raw, 'w') as fid:
+                    fid.writelines(lines[:-1])
+                self.assertEqual(loader(file_raw).shape[0], dy.shape[0] - 1)
+                # changing the cache version invalidates the cache
+                with patch.object(raw, 'WHEEL_CACHE_VERSION', raw.WHEEL_CACHE_VERSION + 1):
+                    loader(file_raw)
+                with np.load(file_cache) as npz:
+                    self.assertEqual(npz['source'][-1], raw.WHEEL_CACHE_VERSION + 1)
+
+    def test_encoder_ge5_fast(self):
+        """The numpy parsing and grooming of ge5 files matches the pandas one"""
+        def _pandas(file_raw, name):
+            data = raw._load_encoder_ssv_file(file_raw, names=['re_ts', name, '_'],
+                                              usecols=['re_ts', name])
+            return raw._groom_wheel_data_ge5(data, label=file_raw.name, path=file_raw)
+
+        # the ge5 fixtures and corrupted copies of them: missing trailing spaces, duplicate
+        # rows, clock resets, truncated and garbled lines
+        corruptions = {
+            'no_trailing_space': lambda lines: lines[:-3] + [ln[:-2] + '\n' for ln in lines[-3:]],
+            'duplicates': lambda lines: lines[:5] + lines[3:],
+            'clock_reset': lambda lines: lines[10:] + lines[:10],
+            'truncated': lambda lines: lines[:-1] + [lines[-1][:3]],
+            'garbled': lambda lines: lines[:4] + ['12 a4 \n'] + lines[4:],
+        }
+        files = [f for f in self.main_path.joinpath('data').rglob('_iblrig_encoder[PE]*.ssv')
+                 if 'ge5' in str(f)]
+        self.assertTrue(len(files) >= 6)
+        nfast = 0
+        with tempfile.TemporaryDirectory() as td:
+            for i, file_orig in enumerate(files):
+                positions = 'Positions' in file_orig.name
+                name = 're_pos' if positions else 'sm_ev'
+                loader = (raw._load_encoder_positions_file_ge5 if positions
+                          else raw._load_encoder_events_file_ge5)
+                with open(file_orig) as fid:
+                    lines = fid.readlines()
+                for label, corrupt in {'orig': lambda x: x, **corruptions}.items():
+                    file_raw = Path(td).joinpath(f'{i}_{label}', file_orig.name)
+                    file_raw.parent.mkdir()
+                    with open(file_raw, 'w') as fid:
+                        fid.writelines(corrupt(lines))
+                    expected = _pandas(file_raw, name)
+                    columns = raw._parse_encoder_ssv_ge5(file_raw, names=['re_ts', name])
+                    fast = None if columns is None else raw._groom_wheel_data_ge5_fast(columns)
+                    if fast is not None:
+                        nfast += 1
+                        pd.testing.assert_frame_equal(fast, expected)
+                    pd.testing.assert_frame_equal(loader(file_raw), expected)
+        # both the fast path and the fall back were exercised
+        self.assertTrue(0 < nfast < len(files) * (len(corruptions) + 1))
+
+
+class TestTrialsTable(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.session_path = Path(self.tmp.name).joinpath('session_training_ge5')
+        shutil.copytree(Path(__file__).parent.joinpath('data', 'session_training_ge5'),
+                        self.session_path)
+        cache_patch = patch.object(raw, 'CACHE_RAW_DATA', True)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_trials_table(self):
+        data = raw.load_data(self.session_path)
+        table = raw.TrialsTable.from_trials(data)
+        self.assertEqual(len(table), len(data))
+        for i, tr in enumerate(data):
+            st = tr['behavior_data']['States timestamps']
+            ev = tr['behavior_data']['Events timestamps']
+            self.assertEqual(table.fields['position'][i], tr['position'])
+            np.testing.assert_array_equal(table.state('closed_loop')[i], st['closed_loop'][0])
+            self.assertEqual(table.event('BNC1High', -1)[i], ev['BNC1High'][-1])
+            values, offsets = table.port_events('BNC1')
+            self.assertEqual(list(values[offsets[i]:offsets[i + 1]]),
+                             raw.get_port_events(tr, 'BNC1'))
+        # events out of range and missing states are NaNs
+        self.assertTrue(np.all(np.isnan(table.event('BNC1High', 1000))))
+        self.assertTrue(np.all(np.isnan(table.state('not_a_state'))))
+        # the table is cached next to the raw data and invalidated when the data changes
+        cache_file = self.session_path.joinpath('raw_behavior_data', raw.TRIALS_TABLE_CACHE)
+        table = raw.load_trials_table(self.session_path)
+        self.assertTrue(cache_file.exists())
+        cached = raw.load_trials_table(self.session_path)
+        for k in table.events:
+            np.testing.assert_array_equal(table.events[k][0], cached.events[k][0])
+            np.testing.assert_array_equal(table.events[k][1], cached.events[k][1])
+        np.testing.assert_array_equal(table.fields['contrast_type'],
+                                      cached.fields['contrast_type'])
+        # the table read from the trials keys only is the table of the full trials
+        full = raw.TrialsTable.from_trials(data)
+        for k in full.fields:
+            np.testing.assert_array_equal(table.fields[k], full.fields[k])
+        for k in full.states:
+            np.testing.assert_array_equal(table.states[k], full.states[k])
+        file_jsonable = next(self.session_path.joinpath('raw_behavior_data').glob(
+            '_iblrig_taskData.raw*.jsonable'))
+        with open(file_jsonable) as fid:
+            lines = fid.readlines()
+        with open(file_jsonable, 'w') as fid:
+            fid.writelines(lines[:3])
+        self.assertEqual(len(raw.load_trials_table(self.session_path)), 3)
+        # a new version of the table voids the caches
+        with patch.object(raw, 'TRIALS_TABLE_VERSION', raw.TRIALS_TABLE_VERSION + 1), \
+                patch.object(raw.TrialsTable, 'load') as load:
+            raw.load_trials_table(self.session_path)
+            load.assert_not_called()
+            with np.load(cache_file) as npz:
+                self.assertEqual(npz['source'][-1], raw.TRIALS_TABLE_VERSION)
+        # the extractors give the same results from the trials or from the cached table
+        out, _ = extractors.training_trials.extract_all(self.session_path, save=False)
+        out_, _ = extractors.training_trials.extract_all(
+            self.session_path, bpod_trials=raw.load_data(self.session_path), save=False)
+        for k in out:
+            np.testing.assert_array_equal(out[k], out_[k])
+
+    def test_extract_all_cached_table(self):
+        from ibllib.io.extractors import bpod_trials
+        trials_, wheel_, _ = bpod_trials.extract_all(
+            self.session_path, bpod_trials=raw.load_data(self.session_path), save=False)
+        raw.load_trials_table(self.session_path)  # writes the cache
+        # the table is read from the cache, only the wheel resets need the raw trials
+        with patch.object(raw.TrialsTable, 'from_trials') as from_trials, \
+                patch.object(raw, 'load_data', wraps=raw.load_data) as load_data:
+            trials, wheel, _ = bpod_trials.extract_all(self.session_path, save=False)
+            from_trials.assert_not_called()
+            self.assertLessEqual(load_data.call_count, 1)
+        for k in trials_:
+            np.testing.assert_array_equal(trials[k], trials_[k])
+        for k in wheel_:
+            np.testing.assert_array_equal(wheel[k], wheel_[k])
+
 
 class MockExtracor(BaseExtractor):
     save_names = (
@@ -672,6 +854,98 @@ class TestBaseExtractorSavingMethods(unittest.TestCase):
         self.assertTrue(all([x.exists() for x in paths]))
 
 
+class MockExtractorA(BaseExtractor):
+    var_names = ('a', 'b')
+
+    def _extract(self, **kwargs):
+        time.sleep(0.1)
+        return np.arange(3), np.arange(4)
+
+
+class MockExtractorB(BaseExtractor):
+    var_names = 'c'
+    input_names = ('a', 'd')
+
+    def _extract(self, a=None, **kwargs):
+        return a * 2
+
+
+class MockExtractorC(BaseExtractor):
+    var_names = 'd'
+    input_names = ('c',)
+
+    def _extract(self, c=None, **kwargs):
+        return c
+
+
+class TestRunExtractorClasses(unittest.TestCase):
+
+    def test_run_extractor_classes(self):
+        # B runs after A and gets its output even if it comes first in the list
+        for n_workers in [1, 3]:
+            out, files = run_extractor_classes(
+                [MockExtractorB, MockExtractorA, MockExtracor], session_path=Path('/tmp'),
+                n_workers=n_workers)
+            self.assertEqual(list(out.keys()), ['c', 'a', 'b', 'csv', 'ssv', 'tsv', 'npy'])
+            np.testing.assert_array_equal(out['c'], np.arange(3) * 2)
+            self.assertEqual(files, [])
+        with self.assertRaises(ValueError):
+            run_extractor_classes([MockExtractorB, MockExtractorC, MockExtractorA],
+                                  session_path=Path('/tmp'))
+
+
+class TestTrainingAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = 200000
+        ns = int(self.fs * 3.3)
+        t = np.arange(ns) / self.fs
+        wav = np.random.default_rng(42).normal(size=ns) * 300
+        self.onsets = np.array([0.5, 1.234, 2.9])
+        for onset in self.onsets:
+            sel = np.logical_and(t >= onset, t < onset + 0.1)
+            wav[sel] += 4000 * np.sin(2 * np.pi * training_audio.FTONE * t[sel])
+        self.wav = np.int16(wav)
+
+    @staticmethod
+    def _detect_ready_tone(w, fs):
+        """Time domain ready tone detection, on envelopes of the signal and of the tone band"""
+        h = np.abs(signal.hilbert(w - np.median(w)))
+        fh = np.abs(signal.hilbert(training_audio.dsp.bp(
+            w, si=1 / fs, b=training_audio.FTONE * np.array([0.9, 0.95, 1.15, 1.1]))))
+        dtect = training_audio._running_mean(fh / (h + 1e-3), int(fs * 0.1)) > 0.8
+        return np.where(np.diff(dtect.astype(int)) == 1)[0]
+
+    def _reference(self, nswin, overlap):
+        """Window by window welch estimates and ready tone detection"""
+        wg = training_audio.dsp.WindowGenerator(ns=self.wav.size, nswin=nswin, overlap=overlap)
+        W, detect = ([], [])
+        for first, last in wg.firstlast:
+            w = np.float64(self.wav[first:last])
+            detect += [d + first for d in self._detect_ready_tone(w, self.fs)]
+            W.append(signal.welch(w, self.fs, window='hann', nperseg=training_audio.NS_WELCH,
+                                  detrend='constant', return_onesided=True, scaling='density',
+                                  axis=-1)[1])
+        detect = np.sort(np.array(detect)) / self.fs
+        ind = np.where(np.diff(detect) < 0.1)[0]
+        detect[ind] = (detect[ind] + detect[ind + 1]) / 2
+        return np.array(W), np.delete(detect, ind + 1)
+
+    def test_welchogram(self):
+        # the second set of windows doesn't start on the welch segments grid
+        for nswin, overlap in [(training_audio.NS_WIN, training_audio.OVERLAP), (50000, 10100)]:
+            tscale, fscale, W, detect = training_audio.welchogram(
+                self.fs, self.wav, nswin=nswin, overlap=overlap)
+            W_, detect_ = self._reference(nswin, overlap)
+            for iw in range(W_.shape[0]):
+                np.testing.assert_allclose(W[iw, :], W_[iw], rtol=1e-3,
+                                           atol=np.max(W_[iw]) * 1e-5)
+            # the ready tones onsets detected on the spectra match the time domain detection
+            self.assertEqual(detect.size, self.onsets.size)
+            self.assertEqual(detect_.size, self.onsets.size)
+            np.testing.assert_allclose(detect, detect_, rtol=0, atol=1e-2)
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
     print('.')
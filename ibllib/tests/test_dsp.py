@@ -1,8 +1,12 @@
+from pathlib import Path
+import tempfile
 import unittest
 import numpy as np
 import scipy.signal
 
 import ibllib.dsp.fourier as ft
+import ibllib.dsp.voltage as voltage
+from ibllib.io import spikeglx
 from ibllib.dsp import WindowGenerator, rms, rises, falls, fronts, smooth, shift, fit_phase,\
     fcn_cosine
 from ibllib.dsp.utils import parabolic_max, sync_timestamps
@@ -37,6 +41,19 @@ class TestSyncTimestamps(unittest.TestCase):
         _fcn, _drift, _ia, _ib = sync_timestamps(tsa[imiss], tsb[imiss2], return_indices=True)
         assert np.all(np.isclose(_fcn(tsa[imiss[_ia]]), tsb[imiss2[_ib]]))
 
+    def test_timestamps_large(self):
+        # 10^5 events with 1% missing on each side and a jitter, in under a second
+        np.random.seed(4132)
+        n = 100000
+        tsa = np.cumsum(np.random.random(n) * 3.6e-3 + 1.8e-3)
+        tsb = tsa * (1 + 0.1 / 1e6) + 12.3 + np.random.randn(n) * 2e-5
+        ia, ib = (np.where(np.random.random(n) > 0.01)[0] for _ in range(2))
+        _fcn, _drift, _ia, _ib = sync_timestamps(tsa[ia], tsb[ib], tbin=1e-3,
+                                                 return_indices=True)
+        assert np.all(ia[_ia] == ib[_ib])
+        assert np.intersect1d(ia, ib).size - _ia.size < 10
+        assert np.abs(_drift - 0.1) < 0.01
+
 
 class TestParabolicMax(unittest.TestCase):
     # expected values
@@ -210,6 +227,25 @@ class TestFFT(unittest.TestCase):
         out2 = ft.hp(ts1, 1, [.1, .2])
         self.assertTrue(np.allclose(out1, ts1 - out2))
 
+    def test_frequency_filter(self):
+        ts = np.random.randn(11, 512)
+        hpf = ft.FrequencyFilter(1, [.1, .2], typ='hp', ns=512)
+        # for efficient fft lengths, no padding and results are the same as the hp function
+        self.assertTrue(np.allclose(hpf(ts), ft.hp(ts, 1, [.1, .2])))
+        self.assertTrue(np.allclose(hpf(ts.T, axis=0), ft.hp(ts.T, 1, [.1, .2], axis=0)))
+        # float32 inputs are filtered in single precision
+        out = hpf(np.float32(ts))
+        self.assertEqual(out.dtype, np.float32)
+        self.assertTrue(np.allclose(out, ft.hp(ts, 1, [.1, .2]), atol=1e-4))
+        # the transfer function is computed once per fft length
+        self.assertTrue(hpf.transfer_function(512) is hpf.transfer_function(512))
+        self.assertEqual(len(hpf._transfer_functions), 2)
+        # other lengths are padded to the next efficient fft size
+        out = ft.FrequencyFilter(1, [.1, .2, .3, .4], typ='bp')(ts[:, :500])
+        self.assertEqual(out.shape, (11, 500))
+        self.assertTrue(np.allclose(out[:, 100:-100], ft.bp(ts[:, :500], 1, [.1, .2, .3, .4])
+                                    [:, 100:-100], atol=0.1))
+
     def test_dft(self):
         # test 1D complex
         x = np.array([1, 2 - 1j, -1j, -1 + 2j])
@@ -277,6 +313,32 @@ class TestWindowGenerator(unittest.TestCase):
             my_rms_[wg.iw] = rms(my_sig[sl])
         self.assertTrue(np.all(my_rms_ == my_rms))
 
+    def test_map(self):
+        my_sig = np.random.rand(5000, 3)
+        wg = WindowGenerator(ns=5000, nswin=100, overlap=10)
+        expected = [rms(my_sig[first:last], axis=0) for first, last in wg.firstlast]
+        # results are yielded in windows order by default
+        res = list(wg.map(lambda w: rms(w, axis=0), reader=my_sig, n_workers=4, progress=False))
+        self.assertTrue(np.all(np.array(res) == np.array(expected)))
+        # without reader the function gets the windows indices
+        res = list(wg.map(lambda first, last: first, n_workers=4, ordered=False, progress=False))
+        self.assertEqual(sorted(res), [first for first, _ in wg.firstlast])
+        # with processes, the function needs to be picklable
+        res = list(wg.map(rms, reader=my_sig[:, 0], n_workers=2, processes=True, progress=False))
+        self.assertTrue(np.allclose(np.array(res), np.array(expected)[:, 0]))
+        # the number of windows in flight is bounded
+        count = {'submitted': 0, 'yielded': 0, 'max': 0}
+
+        def _count(first, last):
+            count['submitted'] += 1
+            count['max'] = max(count['max'], count['submitted'] - count['yielded'])
+            return first
+
+        for _ in wg.map(_count, n_workers=2, max_inflight=3, progress=False):
+            count['yielded'] += 1
+        self.assertTrue(count['max'] <= 3)
+        self.assertEqual(count['yielded'], wg.nwin)
+
     def test_tscale(self):
         wg = WindowGenerator(ns=500, nswin=100, overlap=50)
         ts = wg.tscale(fs=1000)
@@ -316,3 +378,54 @@ class TestWindowGenerator(unittest.TestCase):
 
 if __name__ == "__main__":
     unittest.main(exit=False)
+
+
+class TestVoltageStream(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.workdir = Path(self._tempdir.name)
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3A_short_g0_t0.imec.ap.meta')
+        self.file_bin = spikeglx._mock_spikeglx_file(
+            self.workdir.joinpath('sample3A_short_g0_t0.imec.ap.bin'), file_meta, ns=40000,
+            nc=385, sync_depth=16, random=True)['bin_file']
+        self.sr = spikeglx.Reader(self.file_bin)
+        # small memory budget so that the file is processed in 5 windows
+        self.kwargs = dict(overlap=1000, memory_bytes=8 * 4 * 385 * 9000)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_overlap_add(self):
+        # without processing stage, the overlap-add reconstruction returns the input
+        file_out = voltage.stream_filter(self.sr, self.workdir.joinpath('out.ap.bin'), [],
+                                         **self.kwargs)
+        sr = spikeglx.Reader(file_out)
+        self.assertEqual(sr.shape, self.sr.shape)
+        self.assertTrue(np.all(sr._raw[:] == self.sr._raw[:]))
+        self.assertTrue(sr.verify_hash())
+        # a sample-wise stage has no edge effects
+        file_out = voltage.stream_filter(self.sr, self.workdir.joinpath('car.ap.bin'),
+                                         [voltage.CommonAverageReference(operation='mean')],
+                                         **self.kwargs)
+        raw = np.float32(self.sr._raw[:, :-1])
+        expected = np.clip(np.round(raw - np.mean(raw, axis=1)[:, np.newaxis]), -32768, 32767)
+        self.assertTrue(np.all(np.abs(spikeglx.Reader(file_out)._raw[:, :-1] - expected) <= 1))
+
+    def test_filter_decimate(self):
+        # sine wave at 500 Hz over a DC offset, with a random noise above 6 kHz
+        fs = 30000
+        tscale = np.arange(40000) / fs
+        data = np.tile(200 * np.sin(2 * np.pi * 500 * tscale)[:, np.newaxis] + 1000, (1, 16))
+        data += ft.hp(np.random.randn(*data.shape), 1 / fs, [6000, 7000], axis=0) * 200
+        stages = [voltage.Filter([100, 200], typ='hp'), voltage.Decimate(3)]
+        file_out = voltage.stream_filter(np.int16(data), self.workdir.joinpath('dec.bin'),
+                                         stages, fs=fs, **self.kwargs)
+        out = np.fromfile(file_out, dtype=np.int16).reshape(-1, 16)
+        self.assertEqual(out.shape, (13334, 16))
+        expected = 200 * np.sin(2 * np.pi * 500 * tscale[::3])
+        # away from the file edges, the output is the sine wave, across windows boundaries
+        self.assertTrue(np.all(np.abs(out[500:-500] - expected[500:-500, np.newaxis]) <= 2))
+        with self.assertRaises(ValueError):
+            voltage.stream_filter(data, self.workdir.joinpath('dec.bin'), stages)
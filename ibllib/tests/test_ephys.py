@@ -1,9 +1,20 @@
 # Mock dataset
+import os
+from pathlib import Path
+import shutil
+import tempfile
 import unittest
+from unittest.mock import patch
 
 import numpy as np
+from scipy import signal
+from scipy.interpolate import interp1d
 
-from ibllib.ephys import ephysqc, neuropixel
+import alf.io
+import ibllib.dsp as dsp
+
+from ibllib.ephys import ephysqc, neuropixel, sync_probes
+from ibllib.io import spikeglx
 
 
 class TestNeuropixel(unittest.TestCase):
@@ -54,3 +65,239 @@ class TestFpgaTask(unittest.TestCase):
 
 if __name__ == "__main__":
     unittest.main(exit=False)
+
+
+class TestClockConverter(unittest.TestCase):
+
+    def test_convert(self):
+        sync_points = np.c_[np.linspace(0, 100, 11), np.linspace(0, 100, 11) * 1.0001 + 0.5]
+        sync_points[5, 1] += 0.01
+        converter = sync_probes.ClockConverter(sync_points)
+        times = np.random.default_rng(0).uniform(-20, 120, (3, 1000))
+        expected = interp1d(sync_points[:, 0], sync_points[:, 1], fill_value='extrapolate')
+        np.testing.assert_allclose(converter.forward(times), expected(times), rtol=1e-12)
+        expected = interp1d(sync_points[:, 1], sync_points[:, 0], fill_value='extrapolate')
+        np.testing.assert_allclose(converter.inverse(times), expected(times), rtol=1e-12)
+        self.assertTrue(np.isscalar(converter.forward(45.)))
+        # in-place conversion, by chunks, and of non contiguous arrays
+        with patch.object(sync_probes, 'CLOCK_CHUNK_SIZE', 128):
+            expected = converter.forward(times)
+            converter.forward(times, out=times)
+        np.testing.assert_array_equal(times, expected)
+        np.testing.assert_allclose(converter.inverse(times[:, ::3]), converter.inverse(
+            np.copy(times[:, ::3])))
+
+    def test_from_file(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            sync_file = Path(tdir).joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy')
+            np.save(sync_file, np.array([[0, 0], [10, 10.1]]))
+            converter = sync_probes.ClockConverter.from_file(sync_file)
+            self.assertIs(converter, sync_probes.ClockConverter.from_file(str(sync_file)))
+            self.assertEqual(sync_probes.apply_sync(sync_file, 20.), 20.2)
+            # the converter is reloaded when the file is modified
+            np.save(sync_file, np.array([[0, 0], [10, 10.2]]))
+            os.utime(sync_file, ns=(0, 0))
+            self.assertEqual(sync_probes.apply_sync(sync_file, 20., forward=False), 20 / 1.02)
+
+
+class TestTimeBase(unittest.TestCase):
+
+    def test_convert(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            session_path = Path(tdir)
+            file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                       'sample3B_g0_t0.imec1.ap.meta')
+            # probe00 is 0.5 secs late on the fpga with a 20 ppm drift
+            probe_path = session_path.joinpath('raw_ephys_data', 'probe00')
+            probe_path.mkdir(parents=True)
+            shutil.copy(file_meta, probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.ap.meta'))
+            np.save(probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy'),
+                    np.array([[0, 0.5], [1000, 1000.5 + 1000 * 20e-6]]))
+            # bpod starts 10 secs after the fpga, with missing events on both sides
+            tb = sync_probes.TimeBase(session_path)
+            bpod = np.cumsum(np.random.default_rng(0).uniform(1, 5, 200))
+            fpga = bpod * (1 - 50e-6) + 10
+            drift, ibpod, ifpga = tb.fit('bpod', np.delete(bpod, 50), np.delete(fpga, 120))
+            self.assertEqual(ibpod.size, 198)
+            self.assertTrue(np.abs(drift + 50) < 1)
+            self.assertTrue(tb.sync_file('bpod').exists())
+            # conversions are composed through the fpga clock, from the saved files
+            tb = sync_probes.TimeBase(session_path)
+            t = np.linspace(10, 500, 50)
+            expected = ((t * (1 + 20e-6) + 0.5) - 10) / (1 - 50e-6)
+            np.testing.assert_allclose(tb.convert(t, 'probe00', 'bpod'), expected)
+            np.testing.assert_allclose(tb.convert(expected, 'bpod', 'probe00'), t)
+            self.assertTrue(np.isscalar(tb.convert(20., 'probe00', 'bpod')))
+            np.testing.assert_array_equal(tb.convert(t, 'bpod', 'bpod'), t)
+            tb.convert(t, 'probe00', 'bpod', out=t)
+            np.testing.assert_allclose(t, expected)
+            with self.assertRaises(FileNotFoundError):
+                tb.convert(t, 'probe01', 'fpga')
+
+    def test_probe_sync_3B(self):
+        with tempfile.TemporaryDirectory() as tdir:
+            session_path = Path(tdir)
+            fixtures = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx')
+            raw_path = session_path.joinpath('raw_ephys_data')
+            raw_path.joinpath('probe00').mkdir(parents=True)
+            shutil.copy(fixtures.joinpath('sample3B_g0_t0.nidq.meta'),
+                        raw_path.joinpath('_spikeglx_ephysData_g0_t0.nidq.meta'))
+            shutil.copy(fixtures.joinpath('sample3B_g0_t0.imec1.ap.meta'),
+                        raw_path.joinpath('probe00', '_spikeglx_ephysData_g0_t0.imec.ap.meta'))
+            # probe00 is 0.5 secs late on the nidq with a 20 ppm drift
+            tref = np.arange(1, 600, 0.5)
+            tprobe = (tref - 0.5) / (1 + 20e-6)
+            for path, times, channel in [(raw_path, tref, 3),
+                                         (raw_path.joinpath('probe00'), tprobe, 6)]:
+                sync = {'times': times, 'channels': np.ones_like(times) * channel,
+                        'polarities': (-1.) ** np.arange(times.size)}
+                alf.io.save_object_npy(path, sync, 'sync', namespace='spikeglx')
+            qc, out_files = sync_probes.version3B(session_path, display=False)
+            self.assertTrue(qc)
+            # the probe clock is registered and saved through the session time base
+            tb = sync_probes.TimeBase(session_path)
+            self.assertIn(tb.sync_file('probe00'), out_files)
+            t = np.linspace(10, 500, 50)
+            np.testing.assert_allclose(tb.convert(t, 'probe00', 'fpga'), t * (1 + 20e-6) + 0.5,
+                                       atol=1e-6)
+
+
+class TestSessionReader(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.session_path = Path(self._tempdir.name)
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3B_g0_t0.imec1.ap.meta')
+        # probe01 starts 0.5 secs after probe00 and has a 20 ppm drift
+        sync_points = {'probe00': np.array([[0, 0], [10, 10]]),
+                       'probe01': np.array([[0, 0.5], [10, 10.5 + 10 * 20e-6]])}
+        for label, sp in sync_points.items():
+            probe_path = self.session_path.joinpath('raw_ephys_data', label)
+            probe_path.mkdir(parents=True)
+            file_bin = probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.ap.bin')
+            spikeglx._mock_spikeglx_file(file_bin, file_meta, ns=60000, nc=385, sync_depth=16,
+                                         random=True)
+            np.save(file_bin.parent.joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy'), sp)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_read(self):
+        ssr = sync_probes.SessionReader(self.session_path)
+        self.assertEqual(ssr.labels, ['probe00', 'probe01'])
+        data, times = ssr.read(1.2, 1.3, csel={'probe01': slice(10, 20)})
+        # probe00 is on the session clock, probe01 starts later
+        sr = spikeglx.Reader(ssr.readers['probe00'].file_bin)
+        first, last = np.int64(np.round(np.array([1.2, 1.3]) * sr.fs))
+        self.assertTrue(np.all(data['probe00'] == sr.read(slice(first, last), sync=False)))
+        self.assertTrue(np.allclose(times['probe00'], np.arange(first, last) / sr.fs))
+        first, last = np.int64(np.round((np.array([1.2, 1.3]) - 0.5) / (1 + 20e-6) * sr.fs))
+        self.assertEqual(ssr.time2sample('probe01', 1.2), first)
+        sr = spikeglx.Reader(ssr.readers['probe01'].file_bin)
+        d = sr.read(slice(first, last), csel=slice(10, 20), sync=False)
+        self.assertEqual(data['probe01'].shape, (last - first, 10))
+        self.assertTrue(np.all(data['probe01'] == d))
+        self.assertTrue(np.abs(times['probe01'][0] - 1.2) < 1 / sr.fs)
+        self.assertTrue(np.allclose(np.diff(times['probe01']), (1 + 20e-6) / sr.fs))
+        # times beyond the recording are clipped
+        data, times = ssr.read(1.9, 5, labels=['probe01'])
+        self.assertEqual(list(data.keys()), ['probe01'])
+        self.assertEqual(data['probe01'].shape[0], 60000 - ssr.time2sample('probe01', 1.9))
+
+    def test_read_lf_only(self):
+        # probe02 has only the lf binary file, its sync file is found from the lf file name
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3B_g0_t0.imec1.lf.meta')
+        probe_path = self.session_path.joinpath('raw_ephys_data', 'probe02')
+        probe_path.mkdir(parents=True)
+        shutil.copy(file_meta.parent.joinpath('sample3B_g0_t0.imec1.ap.meta'),
+                    probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.ap.meta'))
+        spikeglx._mock_spikeglx_file(probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.lf.bin'),
+                                     file_meta, ns=5000, nc=385, sync_depth=16, random=True)
+        np.save(probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy'),
+                np.array([[0, 1], [10, 11]]))
+        ssr = sync_probes.SessionReader(self.session_path, band='ap')
+        self.assertEqual(ssr.labels, ['probe00', 'probe01'])
+        ssr = sync_probes.SessionReader(self.session_path, band='lf', labels=['probe02'])
+        self.assertEqual(ssr.labels, ['probe02'])
+        fs = ssr.readers['probe02'].fs
+        self.assertEqual(ssr.time2sample('probe02', 1.5), np.round(0.5 * fs))
+        self.assertEqual(sync_probes.TimeBase(self.session_path).sync_file('probe02'),
+                         probe_path.joinpath('_spikeglx_ephysData_g0_t0.imec.sync.npy'))
+
+
+class TestRawQC(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.workdir = Path(self._tempdir.name)
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3B_g0_t0.imec1.lf.meta')
+        self.file_bin = spikeglx._mock_spikeglx_file(
+            self.workdir.joinpath('_spikeglx_ephysData_g0_t0.imec1.lf.bin'), file_meta,
+            ns=40000, nc=385, sync_depth=16, random=True)['bin_file']
+        spikeglx._mock_spikeglx_file(
+            self.workdir.joinpath('_spikeglx_ephysData_g0_t0.imec1.ap.bin'),
+            file_meta.parent.joinpath('sample3B_g0_t0.imec1.ap.meta'),
+            ns=40000, nc=385, sync_depth=16, random=True)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_rmsmap_resume(self):
+        expected = ephysqc.rmsmap(self.file_bin)
+        checkpoint_file = self.workdir.joinpath('checkpoint.npz')
+
+        def _interrupt(file_bin, iw, nwin):
+            if iw == 2:
+                raise KeyboardInterrupt
+
+        # interrupt the computation on the third window, after the second window checkpoint
+        with patch.object(ephysqc, 'RMS_CHECKPOINT_WINDOWS', 2), \
+                patch.object(ephysqc, '_log_progress', side_effect=_interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                ephysqc.rmsmap(self.file_bin, checkpoint_file=checkpoint_file)
+        self.assertTrue(checkpoint_file.exists())
+        with patch.object(ephysqc, '_log_progress') as progress:
+            resumed = ephysqc.rmsmap(self.file_bin, checkpoint_file=checkpoint_file)
+        self.assertEqual(progress.call_args_list[0][0][1], 2)
+        for k in expected:
+            self.assertTrue(np.all(resumed[k] == expected[k]))
+
+    def test_rmsmap_reference(self):
+        # the QC outputs are identical to the window by window computation
+        sr = spikeglx.Reader(self.file_bin)
+        win = ephysqc.rmsmap(self.file_bin)
+        nswin = 2 ** np.ceil(np.log2(sr.fs * ephysqc.RMS_WIN_LENGTH_SECS))
+        wg = dsp.WindowGenerator(ns=sr.ns, nswin=nswin, overlap=0)
+        spectral_density, peak = (0, 0)
+        for iw, (first, last) in enumerate(wg.firstlast):
+            D = sr.read_samples(first_sample=first, last_sample=last)[0].transpose()
+            D = dsp.hp(D, 1 / sr.fs, [0, 1])
+            np.testing.assert_array_equal(win['TRMS'][iw], dsp.rms(D))
+            peak = np.maximum(peak, np.max(np.abs(D), axis=1))
+            if last - first >= ephysqc.WELCH_WIN_LENGTH_SAMPLES:
+                spectral_density += signal.welch(
+                    D, fs=sr.fs, window='hann', nperseg=ephysqc.WELCH_WIN_LENGTH_SAMPLES,
+                    detrend='constant', return_onesided=True, scaling='density', axis=-1)[1].T
+        np.testing.assert_array_equal(win['spectral_density'], spectral_density)
+        # the per channel statistics are computed in the same pass
+        np.testing.assert_array_equal(win['peak'], peak)
+        raw = sr.read(slice(None), sync=False)
+        np.testing.assert_allclose(win['mean'], np.mean(raw, axis=0, dtype=np.float64))
+
+    def test_raw_qc_session(self):
+        with self.assertLogs('ibllib', 'INFO') as log:
+            qc_files = ephysqc.raw_qc_session(self.workdir, n_workers=2)
+        # the logs of the worker processes reach the parent logger, labelled per file
+        self.assertTrue(any(m.endswith(f' lf: Computing QC for {self.file_bin}')
+                            for m in log.output))
+        self.assertEqual(len(qc_files), 8)
+        rms = np.load(self.workdir.joinpath('_iblqc_ephysTimeRmsLF.rms.npy'))
+        # the progress is logged rather than printed, so that it reaches the parent as well
+        nwin = rms.shape[0]
+        self.assertTrue(any(m.endswith(f' lf: {self.file_bin.name}: QC window {nwin}/{nwin}')
+                            for m in log.output))
+        self.assertTrue(np.all(rms == ephysqc.rmsmap(self.file_bin)['TRMS'].astype(np.single)))
+        self.assertEqual(list(self.workdir.glob('*checkpoint*')), [])
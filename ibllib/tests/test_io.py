@@ -1,8 +1,13 @@
 import unittest
 from unittest.mock import patch
+from functools import partial
+import http.server
+import json
 import os
+import re
 import uuid
 import tempfile
+import threading
 from pathlib import Path
 import shutil
 import sys
@@ -10,6 +15,7 @@ import sys
 import numpy as np
 
 from ibllib.io import params, flags, jsonable, spikeglx, hashfile, misc, globus
+import ibllib.dsp as dsp
 import ibllib.io.raw_data_loaders as raw
 
 
@@ -170,6 +176,46 @@ class TestsJsonable(unittest.TestCase):
         tfile.close()
         os.unlink(tfile.name)
 
+    def testIter(self):
+        with tempfile.TemporaryDirectory() as td:
+            file = Path(td).joinpath('data.jsonable')
+            data = [{'a': i, 'b': {'c': [i, 'd"}']}, 'e': 'x' * i} for i in range(20)]
+            jsonable.write(file, data)
+            self.assertEqual(list(jsonable.read_iter(file)), data)
+            self.assertEqual(list(jsonable.read_iter(file, start=5, stop=8)), data[5:8])
+            self.assertEqual(list(jsonable.read_iter(file, start=-2)), data[-2:])
+            self.assertEqual(list(jsonable.read_iter(file, fields=['b', 'f'], stop=2)),
+                             [{'b': d['b']} for d in data[:2]])
+            # the line index is persisted and updated when the file changes
+            offsets = jsonable.index(file)
+            self.assertEqual(offsets.size, 21)
+            self.assertTrue(Path(td).joinpath('.data.jsonable.index.npy').exists())
+            jsonable.append(file, data[:3])
+            self.assertEqual(jsonable.index(file).size, 24)
+            self.assertEqual(list(jsonable.read_iter(file, start=20)), data[:3])
+            # a corrupt index file is re-computed
+            index_file = Path(td).joinpath('.data.jsonable.index.npy')
+            index_file.write_bytes(index_file.read_bytes()[:100])
+            self.assertEqual(list(jsonable.read_iter(file, start=20)), data[:3])
+
+    def testIterProjection(self):
+        with tempfile.TemporaryDirectory() as td:
+            file = Path(td).joinpath('data.jsonable')
+            data = [{'a': {'b': [{'c': i}, '}]"\\'], 'd': None}, 'e': -1.5e-3, 'f': True,
+                     'g': {'h': i}, 'i': [[], {}, 'x']} for i in range(5)]
+            jsonable.write(file, data)
+            # the skipped values are scanned, only the requested values build python objects
+            objects = []
+            decoder = json.JSONDecoder(object_hook=lambda o: objects.append(o) or o)
+            with patch.object(jsonable, '_DECODER', decoder):
+                self.assertEqual(list(jsonable.read_iter(file, fields=['f', 'g'])),
+                                 [{'f': d['f'], 'g': d['g']} for d in data])
+            self.assertEqual(objects, [d['g'] for d in data])
+            self.assertEqual(list(jsonable.read_iter(file, fields=['e', 'i'])),
+                             [{'e': d['e'], 'i': d['i']} for d in data])
+            # the full reads don't write the line index
+            self.assertFalse(Path(td).joinpath('.data.jsonable.index.npy').exists())
+
 
 class TestSpikeGLX_glob_ephys(unittest.TestCase):
     """
@@ -293,6 +339,114 @@ class TestsSpikeGLX_compress(unittest.TestCase):
         self.assertTrue(np.all(np.isclose(sr._raw[55] * s2mv, sr[55])))
         self.assertTrue(np.all(np.isclose(sr._raw[5:500] * s2mv, sr[5:500])[:, :-1]))
 
+    def test_read_modes(self):
+        sr = self.sr
+        ref = sr.read(slice(100, 5100), sync=False)
+        # raw int16 samples are a view of the memmap
+        raw = sr.read(slice(100, 5100), sync=False, scale=False, dtype=np.int16)
+        self.assertTrue(np.shares_memory(raw, sr._raw))
+        self.assertTrue(np.all(raw == sr._raw[100:5100]))
+        unscaled = sr.read(slice(100, 5100), sync=False, scale=False)
+        self.assertEqual(unscaled.dtype, np.float32)
+        self.assertTrue(np.all(unscaled == raw))
+        # scaled samples written in a pre-allocated buffer are identical to the allocating read
+        buffer = np.zeros((5000, sr.nc), dtype=np.float32)
+        out = sr.read(slice(100, 5100), sync=False, out=buffer)
+        self.assertTrue(out is buffer)
+        self.assertTrue(np.all(buffer == ref))
+        out, sync = sr.read(slice(100, 5100), csel=slice(10, 20), out=buffer[:, :10])
+        self.assertTrue(np.all(out == ref[:, 10:20]))
+        self.assertTrue(np.all(sync == sr.read_sync(slice(100, 5100))))
+
+    def test_iter_chunks(self):
+        sr = self.sr
+        wg = dsp.WindowGenerator(ns=sr.ns, nswin=10000, overlap=100)
+        chunks = list(sr.iter_chunks(nswin=10000, overlap=100, channels=slice(10, 20), sync=True))
+        self.assertEqual(len(chunks), wg.nwin)
+        for (first, last, data, sync), (f, l) in zip(chunks, wg.firstlast):
+            self.assertEqual((first, last), (f, l))
+            self.assertEqual(data.shape, (l - f, 10))
+            self.assertTrue(np.all(sync == sr.read_sync(slice(f, l))))
+        # the buffers are recycled so only the last window is still valid after the loop
+        first, last, data, _ = chunks[-1]
+        self.assertTrue(np.all(data == sr.read_samples(first, last, slice(10, 20))[0]))
+        for first, last, data in sr.iter_chunks(nswin=10000, overlap=100):
+            self.assertTrue(np.all(data == sr.read(slice(first, last), sync=False)))
+        # closing the generator early should stop the reading thread
+        gen = sr.iter_chunks(nswin=1000)
+        next(gen)
+        gen.close()
+
+    def test_chunk_cache(self):
+        file_cbin = self.sr.compress_file()
+        sc = spikeglx.Reader(file_cbin)
+        # the test file is 2.5 secs long, ie. 3 chunks of 1 sec
+        self.assertEqual(sc._raw.n_chunks, 3)
+        for i in range(50):
+            self.assertTrue(np.all(sc[i * 10:i * 10 + 5] == self.sr[i * 10:i * 10 + 5]))
+        self.assertEqual((sc.chunk_cache.hits, sc.chunk_cache.misses), (49, 1))
+        # reading across 2 chunks
+        self.assertTrue(np.all(sc[29990:30010, 5] == self.sr[29990:30010, 5]))
+        self.assertEqual((sc.chunk_cache.hits, sc.chunk_cache.misses), (50, 2))
+        with self.assertRaises(ValueError):
+            sc.chunk_cache.get(0, None)[0, 0] = 1
+        # with a cache smaller than a chunk, only the last chunk read is kept
+        sc = spikeglx.Reader(file_cbin, cache_bytes=1)
+        sc.read_samples(0, 76104)
+        self.assertEqual(len(sc.chunk_cache), 1)
+        self.assertEqual(sc.chunk_cache.nbytes, (76104 - sc._raw.chunk_bounds[2]) * 385 * 2)
+
+    def test_read_channels(self):
+        sc = spikeglx.Reader(self.sr.compress_file())
+        for sr in (self.sr, sc):
+            for sl in (slice(0, 10), slice(29990, 30010), slice(None), slice(76000, 80000),
+                       slice(100, 50), slice(-500, None), slice(0, 1000, 3)):
+                expected = self.sr._raw[sl, [5, 384]]
+                # reads several blocks on the flat binary file
+                with patch.object(spikeglx, 'CHANNELS_BLOCK_BYTES', 385 * 2 * 1000):
+                    self.assertTrue(np.all(sr.read_channels(sl, [5, 384]) == expected))
+            self.assertTrue(np.all(sr.read_sync(slice(0, 100)) ==
+                                   spikeglx.split_sync(self.sr._raw[0:100, [384]])))
+
+    def test_compress_pool(self):
+        # the process pool compression output is identical to the mtscomp output
+        file_cbin = self.sr.compress_file()
+        cbin, ch = (file_cbin.read_bytes(), file_cbin.with_suffix('.ch').read_bytes())
+        file_cbin.with_suffix('.ch').unlink()
+        file_cbin.unlink()
+        self.assertEqual(self.sr.compress_file(n_workers=2), file_cbin)
+        self.assertEqual(cbin, file_cbin.read_bytes())
+        self.assertEqual(ch, file_cbin.with_suffix('.ch').read_bytes())
+        # same for decompression
+        sc = spikeglx.Reader(file_cbin)
+        file_out = self.workdir.joinpath('decompressed.bin')
+        sc.decompress_file(out=file_out, n_workers=2)
+        self.assertEqual(self.file_bin.read_bytes(), file_out.read_bytes())
+
+    def test_compress_hashes(self):
+        file_cbin = self.sr.compress_file()
+        self.assertEqual(spikeglx.get_mtscomp_hash(file_cbin, 'md5_compressed'),
+                         hashfile.md5(file_cbin))
+        self.assertEqual(spikeglx.get_mtscomp_hash(file_cbin, 'md5_uncompressed'),
+                         hashfile.md5(self.file_bin))
+        self.assertEqual(spikeglx.get_mtscomp_hash(file_cbin, 'sha1_compressed'),
+                         hashfile.sha1(file_cbin))
+        self.assertIsNone(spikeglx.get_mtscomp_hash(self.file_bin))
+        # the verification of the acquisition hash doesn't need to decompress the file
+        sc = spikeglx.Reader(file_cbin)
+        self.assertFalse(sc.verify_hash())
+        sc.meta['fileSHA1'] = hashfile.sha1(self.file_bin).upper()
+        self.assertTrue(sc.verify_hash())
+        # a corruption of the compressed file is detected
+        data = bytearray(file_cbin.read_bytes())
+        data[len(data) // 2] ^= 0xFF
+        file_cbin.write_bytes(bytes(data))
+        self.assertFalse(sc.verify_hash())
+        # if the file size changed, the stored hash is not returned
+        with open(file_cbin, 'ab') as fid:
+            fid.write(b'0')
+        self.assertIsNone(spikeglx.get_mtscomp_hash(file_cbin))
+
     def test_compress(self):
 
         def compare_data(sr0, sr1):
@@ -334,6 +488,81 @@ class TestsSpikeGLX_compress(unittest.TestCase):
         compare_data(sr_ref, self.sc)
 
 
+class _RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Minimal static file handler supporting single HTTP range requests"""
+
+    def do_GET(self):
+        byte_range = self.headers.get('Range')
+        if byte_range is None:
+            return super(_RangeRequestHandler, self).do_GET()
+        self.server.range_requests.append(byte_range)
+        first, last = map(int, re.match(r'bytes=(\d+)-(\d+)', byte_range).groups())
+        with open(self.translate_path(self.path), 'rb') as fid:
+            fid.seek(first)
+            data = fid.read(last - first + 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {first}-{first + len(data) - 1}/*')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestsSpikeGLX_remote(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.workdir = Path(self._tempdir.name)
+        self.workdir.joinpath('server').mkdir()
+        file_meta = Path(__file__).parent.joinpath('fixtures', 'io', 'spikeglx',
+                                                   'sample3A_short_g0_t0.imec.ap.meta')
+        file_bin = spikeglx._mock_spikeglx_file(
+            self.workdir.joinpath('server', 'sample3A_short_g0_t0.imec.ap.bin'), file_meta,
+            ns=76104, nc=385, sync_depth=16, random=True)['bin_file']
+        self.sr = spikeglx.Reader(spikeglx.Reader(file_bin).compress_file())
+        handler = partial(_RangeRequestHandler, directory=str(file_bin.parent))
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.range_requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/{file_bin.name}'
+        self.url = self.url.replace('.bin', '.cbin')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._tempdir.cleanup()
+
+    def test_remote_reader(self):
+        cache_dir = self.workdir.joinpath('cache')
+        rr = spikeglx.RemoteReader(self.url, cache_dir=cache_dir)
+        self.assertEqual(rr.shape, self.sr.shape)
+        self.assertTrue(np.all(rr.read_sync(slice(0, 1000)) == self.sr.read_sync(slice(0, 1000))))
+        # the 3 chunks of the file are needed and fetched in a single range request
+        self.server.range_requests.clear()
+        self.assertTrue(np.all(rr[100:70000, :-1] == self.sr[100:70000, :-1]))
+        self.assertEqual(len(self.server.range_requests), 1)
+        d0, s0 = rr.read(slice(29000, 31000), csel=slice(10, 20))
+        d1, s1 = self.sr.read(slice(29000, 31000), csel=slice(10, 20))
+        self.assertTrue(np.all(d0 == d1) and np.all(s0 == s1))
+        self.assertEqual(len(self.server.range_requests), 1)
+        # a new reader uses the disk cache without requesting data
+        rr = spikeglx.RemoteReader(self.url, cache_dir=cache_dir)
+        self.assertTrue(np.all(rr[50000:50010] == self.sr[50000:50010]))
+        self.assertEqual(len(self.server.range_requests), 1)
+
+    def test_remote_reader_disk_cache(self):
+        rr = spikeglx.RemoteReader(self.url, cache_dir=self.workdir.joinpath('cache'),
+                                   disk_cache_bytes=1, cache_bytes=1)
+        for first in range(0, rr.ns - 10000, 10000):
+            self.assertTrue(np.all(rr[first:first + 10000] == self.sr[first:first + 10000]))
+            self.assertEqual(len(rr._raw.file_cache), 1)
+        # the least recently used chunks got evicted and are requested again
+        self.assertTrue(np.all(rr[0:10] == self.sr[0:10]))
+        self.assertEqual(len(self.server.range_requests), 4)
+
+
 class TestsSpikeGLX_Meta(unittest.TestCase):
 
     def setUp(self):
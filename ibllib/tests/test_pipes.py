@@ -417,5 +417,20 @@ class TestScanFixPassiveFiles(unittest.TestCase):
         self.tmp_dir.cleanup()
 
 
+class TestEphysMtscompCores(unittest.TestCase):
+
+    def test_split_cores(self):
+        from ibllib.pipes.ephys_preprocessing import _split_cores
+        # 2 AP files, 2 LF files and a nidq
+        sizes = [100, 100, 8, 8, 1]
+        for n_cores in [1, 4, 5, 8, 16, 33]:
+            cores = _split_cores(sizes, n_cores)
+            self.assertTrue(all(c >= 1 for c in cores))
+            self.assertEqual(sum(cores), max(n_cores, len(sizes)))
+            self.assertTrue(cores[0] >= cores[2] >= cores[4])
+        self.assertEqual(_split_cores([100, 100, 8, 8, 1], 16), [6, 6, 2, 1, 1])
+        self.assertEqual(_split_cores([0, 0], 4), [2, 2])
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
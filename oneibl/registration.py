@@ -12,7 +12,7 @@ from oneibl.one import ONE
 from ibllib.misc import version
 import ibllib.time
 import ibllib.io.raw_data_loaders as raw
-from ibllib.io import flags, hashfile
+from ibllib.io import flags, hashfile, spikeglx
 import ibllib.exceptions
 
 _logger = logging.getLogger('ibllib.alf')
@@ -71,12 +71,13 @@ def register_dataset(file_list, one=None, created_by=None, repository=None, serv
     assert isinstance(versions, list) and len(versions) == len(file_list)
 
     # computing the md5 can be very long, so this is an option to skip if the file is bigger
-    # than a certain threshold
+    # than a certain threshold. Compressed ephys files hashes are computed during compression
+    hashes = [spikeglx.get_mtscomp_hash(p, 'md5_compressed') for p in file_list]
     if max_md5_size:
-        hashes = [hashfile.md5(p) if
-                  p.stat().st_size < max_md5_size else None for p in file_list]
+        hashes = [h or (hashfile.md5(p) if p.stat().st_size < max_md5_size else None)
+                  for h, p in zip(hashes, file_list)]
     else:
-        hashes = [hashfile.md5(p) for p in file_list]
+        hashes = [h or hashfile.md5(p) for h, p in zip(hashes, file_list)]
 
     session_path = alf.io.get_session_path(file_list[0])
     # first register the file